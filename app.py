@@ -1,51 +1,335 @@
+import time
+STARTUP_T0 = time.monotonic()
+
 import os
-import json
+import sys
 import uuid
-import time
 import threading
-from queue import Queue, Empty
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_from_directory, g
 from flask_cors import CORS
-from llama_cpp import Llama
 from pdf_handler import pdf_bp 
 from email_reader import email_bp  # Nuovo import
+from conversation_store import open_store, migrate_json
+from model_manager import ModelManager
+from model_registry import ModelRegistry
+from inference_client import InferenceClient
+from autotune import load_profile
+from context_window import ContextManager, MESSAGE_OVERHEAD
+from scheduler import (
+    InferenceScheduler, SchedulerFullError,
+    PRIORITY_INTERACTIVE,
+)
+from topic_filter import TopicFilter
+from response_cache import ResponseCache
+from stream_broker import StreamBroker
+import metrics
+from metrics import span, TimedProxy, STORE_LATENCY, CHAT_TTFT, HTTP_REQUEST
+from profiler import SamplingProfiler, parse_interval
 
 # ---------------------------------------------------
 # CONFIGURAZIONE
 # ---------------------------------------------------
 MODELS_DIR = "./models"
 MODEL_FILENAME = "Phi-3-mini-4k-instruct-q4.gguf"
-MODEL_PATH = os.path.join(MODELS_DIR, MODEL_FILENAME)
+# Parametri per modello e modello di ogni route (chat, pdf, email)
+MODEL_CONFIG = os.environ.get("MODEL_CONFIG", os.path.join(MODELS_DIR, "models.json"))
+# Profilo di n_threads/n_batch/n_ctx misurato su questa macchina (python autotune.py)
+TUNING_PROFILE = os.environ.get("TUNING_PROFILE", os.path.join(MODELS_DIR, "tuning.json"))
+# Memoria massima per i modelli caricati insieme (0 = nessun limite)
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("MODEL_MEMORY_BUDGET_MB", 0))
+# Server di inferenza esterno (unix:///percorso.sock o http://host:porta): i modelli non si caricano qui
+INFERENCE_URL = os.environ.get("INFERENCE_URL")
+# Chiamate contemporanee al server di inferenza per worker web (la coda vera è sul server)
+INFERENCE_CLIENT_CONCURRENCY = int(os.environ.get("INFERENCE_CLIENT_CONCURRENCY", 4))
 CONV_FILE = "conversations.json"
+# Backend conversazioni: "sqlite" (default) oppure "json" (file unico storico)
+CONV_BACKEND = os.environ.get("CONV_BACKEND", "sqlite")
+CONV_DB = os.environ.get("CONV_DB", "conversations.db")
+CONV_PAGE_SIZE = 100           # elementi per pagina di /conversations
+CONV_PAGE_MAX = 500
+
+# Scheduler di inferenza (un solo llm condiviso)
+SCHEDULER_MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", 8))
+CHAT_QUEUE_TIMEOUT = 30        # secondi massimi di attesa in coda per la chat
+
+# Continuous batching: generazioni contemporanee per modello (1 = disattivato)
+# e cache KV condivisa tra le sequenze (token)
+BATCH_MAX_SEQUENCES = int(os.environ.get("BATCH_MAX_SEQUENCES", 1))
+BATCH_N_CTX = int(os.environ.get("BATCH_N_CTX", 8192))
+
+# Cache KV per prefisso (0 MB in RAM = disattivata)
+KV_CACHE_RAM_MB = int(os.environ.get("KV_CACHE_RAM_MB", 1024))
+KV_CACHE_DISK_MB = int(os.environ.get("KV_CACHE_DISK_MB", 4096))
+KV_CACHE_DIR = os.environ.get("KV_CACHE_DIR", os.path.join(".cache", "kv"))
+
+# Caricamento del modello: in background all'avvio (MODEL_PRELOAD=0 = al primo uso)
+MODEL_PRELOAD = os.environ.get("MODEL_PRELOAD", "1") == "1"
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "1") == "1"
+MODEL_USE_MMAP = os.environ.get("MODEL_USE_MMAP", "1") == "1"
+MODEL_USE_MLOCK = os.environ.get("MODEL_USE_MLOCK", "0") == "1"
+
+# Contesto del modello e budget del prompt di chat
+N_CTX = 4096
+CHAT_MAX_TOKENS = 400
+CHAT_TEMPERATURE = 0.7
+# Budget fisso opzionale; di default segue n_ctx del modello della chat (anche dal profilo di tuning)
+CONTEXT_BUDGET = int(os.environ["CONTEXT_BUDGET"]) if os.environ.get("CONTEXT_BUDGET") else None
+
+SYSTEM_PROMPT = """
+Sei un assistente specializzato esclusivamente in ambito informatico.
+Rispondi sempre in modo tecnico, conciso e accurato.
+"""
 
-# Streaming
-stream_queues = {}
+# Cache delle risposte alle domande di primo turno (0 voci = disattivata)
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 512))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+# Modello GGUF per gli embedding: abilita il riuso per domande simili
+RESPONSE_CACHE_EMBED_MODEL = os.environ.get("RESPONSE_CACHE_EMBED_MODEL")
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", 0.92))
+
+# Documenti caricati nella conversazione: chunk pertinenti inseriti nel prompt di chat
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 4))
+RETRIEVAL_MAX_TOKENS = int(os.environ.get("RETRIEVAL_MAX_TOKENS", 1024))
+# Modello GGUF per gli embedding dei chunk (default: quello della cache delle risposte; assente = solo BM25)
+RETRIEVAL_EMBED_MODEL = os.environ.get("RETRIEVAL_EMBED_MODEL", RESPONSE_CACHE_EMBED_MODEL)
+
+# Profiler a campionamento (attivabile anche a runtime da /profiler)
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", 0.01))
+# Endpoint /profiler (stack dei thread, avvio/arresto): esposto solo se abilitato
+PROFILER_ENDPOINT = os.environ.get("PROFILER_ENDPOINT", "0") == "1"
+
+# Streaming SSE: heartbeat, eventi conservati per la ripresa, durata degli stream finiti
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", 15))
+SSE_REPLAY_EVENTS = int(os.environ.get("SSE_REPLAY_EVENTS", 4096))
+SSE_RETENTION = float(os.environ.get("SSE_RETENTION", 60))
+
+streams = StreamBroker(replay_size=SSE_REPLAY_EVENTS, heartbeat=SSE_HEARTBEAT, retention=SSE_RETENTION)
+# Generazione in corso per conversazione (rimossa quando finisce)
 stream_threads = {}
 
-# File conversazioni
-if not os.path.exists(CONV_FILE):
-    with open(CONV_FILE, "w", encoding="utf-8") as f:
-        json.dump({}, f)
-
-# Caricamento modello
-print("⏳ Caricamento modello...")
-llm = Llama(
-    model_path=MODEL_PATH,
-    n_ctx=4096,
-    n_threads=6,
-    n_batch=256,
-    n_gpu_layers=0,
-    verbose=False
+# Store conversazioni (al primo avvio importa conversations.json)
+if CONV_BACKEND == "json":
+    store = open_store("json", CONV_FILE)
+else:
+    store = open_store(CONV_BACKEND, CONV_DB)
+    migrate_json(CONV_FILE, store)
+store = TimedProxy(store, STORE_LATENCY, (
+    "create", "append", "get", "load_all", "list_summaries", "version", "get_summary", "set_summary",
+))
+
+# Modelli: caricati al primo uso o in background, mai durante l'import
+if INFERENCE_URL:
+    # Stessa interfaccia del registry, ma i modelli vivono nel server di inferenza
+    registry = InferenceClient(INFERENCE_URL)
+else:
+    _monkey = sys.modules.get("gevent.monkey")
+    if _monkey and _monkey.is_module_patched("threading"):
+        # Il decode di llama_cpp non cede mai il controllo: una generazione fermerebbe ogni stream SSE
+        raise RuntimeError("Worker gevent con il modello nel processo: impostare INFERENCE_URL "
+                           "(server di inferenza separato, vedi README)")
+    registry = ModelRegistry(
+        MODELS_DIR,
+        MODEL_CONFIG,
+        default_model=MODEL_FILENAME,
+        defaults={"n_ctx": N_CTX, "n_threads": 6, "n_batch": 256, "n_gpu_layers": 0,
+                  "use_mmap": MODEL_USE_MMAP, "use_mlock": MODEL_USE_MLOCK},
+        memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+        warmup_prompt=f"System: {SYSTEM_PROMPT}\nUser: ciao\nAssistant:" if MODEL_WARMUP else None,
+        profile=load_profile(TUNING_PROFILE),
+    )
+# Ogni uso risolve il modello corrente della route
+llm = registry.route("chat")
+
+embedder = None
+if RESPONSE_CACHE_EMBED_MODEL:
+    cache_embed_model = ModelManager(RESPONSE_CACHE_EMBED_MODEL, embedding=True, n_threads=2)
+    embedder = lambda text: cache_embed_model.embed(text)
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    embedder=embedder,
+    similarity=RESPONSE_CACHE_SIMILARITY,
 )
-print("✅ Modello caricato!")
 
-from pdf_handler import set_llm_model
-set_llm_model(llm)
+# Cache KV per modello: un turno successivo valuta solo il nuovo messaggio utente
+kv_caches = {}
+
+def setup_kv_cache(name, model):
+    """Eseguita a modello caricato, prima del riscaldamento"""
+    if KV_CACHE_RAM_MB <= 0:
+        return
+    from kv_cache import ConversationKVCache
+    kv_cache = ConversationKVCache(
+        ram_bytes=KV_CACHE_RAM_MB << 20,
+        disk_dir=os.path.join(KV_CACHE_DIR, name),
+        disk_bytes=KV_CACHE_DISK_MB << 20,
+    )
+    n_prefix = kv_cache.warm_prefix(model, f"System: {SYSTEM_PROMPT}", model.model_path)
+    model.set_cache(kv_cache)
+    kv_caches[name] = kv_cache
+    print(f"✅ Cache KV pronta per {name} (prefisso di sistema: {n_prefix} token)")
+
+def setup_batch_engine(name, model):
+    """Le generazioni sul modello condividono i passi di decode (continuous batching)"""
+    from batch_engine import BatchEngine
+    # Stessi n_batch e thread del modello (profilo di tuning, models.json, override)
+    params = registry.params(name)
+    engine = BatchEngine.from_llama(model, max_sequences=BATCH_MAX_SEQUENCES, n_ctx=BATCH_N_CTX,
+                                    n_batch=params.get("n_batch", 512), n_threads=params.get("n_threads"),
+                                    n_threads_batch=params.get("n_threads_batch"))
+    # Il system prompt si valuta una volta e si copia nella cache KV di ogni sequenza
+    engine.set_prefix(f"System: {SYSTEM_PROMPT}")
+    registry.set_engine(name, engine)
+    print(f"✅ Continuous batching per {name}: {BATCH_MAX_SEQUENCES} sequenze, {BATCH_N_CTX} token di contesto")
+
+if INFERENCE_URL:
+    # Il server tiene in cache KV il prefisso comune dei prompt di chat
+    if KV_CACHE_RAM_MB > 0:
+        registry.pin_prefix("chat", f"System: {SYSTEM_PROMPT}")
+elif BATCH_MAX_SEQUENCES > 1:
+    # Le generazioni passano dal contesto del motore: una cache KV sul Llama non servirebbe
+    registry.on_load(setup_batch_engine)
+else:
+    registry.on_load(setup_kv_cache)
+
+# Un worker per generazione contemporanea: con il batching i job girano insieme nel motore,
+# con il server di inferenza lo scheduler locale limita solo le chiamate in corso del worker
+if INFERENCE_URL:
+    SCHEDULER_WORKERS = INFERENCE_CLIENT_CONCURRENCY
+else:
+    SCHEDULER_WORKERS = BATCH_MAX_SEQUENCES
+scheduler = InferenceScheduler(max_queue=SCHEDULER_MAX_QUEUE, workers=SCHEDULER_WORKERS)
+def model_n_ctx(model):
+    """Contesto del modello corrente di una route (N_CTX se non si riesce a leggerlo)"""
+    try:
+        return registry.n_ctx(model.model_name) or N_CTX
+    except Exception:
+        return N_CTX
+
+def chat_context_budget():
+    """Token di prompt della chat: contesto del modello corrente meno risposta e margine"""
+    budget = model_n_ctx(llm) - CHAT_MAX_TOKENS - 64
+    # CONTEXT_BUDGET può solo ridurlo: oltre n_ctx il prompt non starebbe nel contesto
+    return min(budget, CONTEXT_BUDGET) if CONTEXT_BUDGET else budget
+
+context = ContextManager(llm, store, scheduler, budget_tokens=chat_context_budget)
+
+from pdf_handler import set_llm_model, set_embedder, document_index
+pdf_llm = registry.route("pdf")
+set_llm_model(pdf_llm, scheduler, n_ctx=lambda: model_n_ctx(pdf_llm))
 print("✅ Modello condiviso con pdf_handler!")
 
+if RETRIEVAL_EMBED_MODEL:
+    from retrieval import LlamaEmbedder
+    if RETRIEVAL_EMBED_MODEL == RESPONSE_CACHE_EMBED_MODEL:
+        retrieval_embed_model = cache_embed_model
+    else:
+        # Modello diverso: la cache delle risposte resta sul proprio (soglie di similarità sue)
+        retrieval_embed_model = ModelManager(RETRIEVAL_EMBED_MODEL, embedding=True, n_threads=2)
+    retrieval_embedder = LlamaEmbedder(retrieval_embed_model)
+    if RETRIEVAL_EMBED_MODEL == RESPONSE_CACHE_EMBED_MODEL:
+        # Stesso modello: le chiamate della cache delle risposte passano dallo stesso lock
+        response_cache.embedder = lambda text: retrieval_embedder.embed([text])[0]
+    set_embedder(retrieval_embedder)
+
+from email_reader import set_llm_model as set_email_llm_model
+set_email_llm_model(registry.route("email"), scheduler)
+print("✅ Modello condiviso con email_reader!")
+
 app = Flask(__name__, static_folder="static", template_folder="templates")
 CORS(app)
 
+# Tempi di avvio: import dell'app e prima richiesta accettata
+startup = {"import_s": round(time.monotonic() - STARTUP_T0, 3), "first_request_s": None}
+
+@app.before_request
+def record_first_request():
+    if startup["first_request_s"] is None:
+        startup["first_request_s"] = round(time.monotonic() - STARTUP_T0, 3)
+        print(f"✅ Prima richiesta accettata dopo {startup['first_request_s']}s dall'avvio")
+
+# ---------------------------------------------------
+# METRICHE E TRACCIAMENTO
+# ---------------------------------------------------
+profiler = SamplingProfiler(interval=PROFILER_INTERVAL)
+if PROFILER_ENABLED:
+    profiler.start()
+
+metrics.gauge("scheduler_queue_depth", "Job in coda per classe di priorità",
+              lambda: scheduler.stats()["queue_depth_by_priority"], label="priority")
+metrics.gauge("sse_subscribers", "Client SSE collegati", lambda: streams.stats()["subscribers"])
+metrics.gauge("chat_generations_running", "Generazioni di chat in corso", lambda: len(stream_threads))
+metrics.gauge("model_loaded", "Modelli caricati in memoria",
+              lambda: {name: int(m["state"] == "ready") for name, m in registry.stats()["models"].items()},
+              label="model")
+
+@app.before_request
+def start_request_trace():
+    g.started_at = time.perf_counter()
+    metrics.start_trace()
+
+@app.after_request
+def end_request_trace(response):
+    started = g.get("started_at")
+    spans = metrics.end_trace()
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    # Per gli stream SSE conta il tempo fino all'invio degli header
+    HTTP_REQUEST.observe(elapsed, endpoint=request.url_rule.rule if request.url_rule else "unmatched",
+                         method=request.method, status=response.status_code)
+    response.headers["Server-Timing"] = metrics.server_timing(spans, elapsed)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/profiler", methods=["GET"])
+def profiler_report():
+    """Stack campionati: JSON riassuntivo o formato collapsed (?format=collapsed) per i flame graph"""
+    if not PROFILER_ENDPOINT:
+        return jsonify({"error": "not found"}), 404
+    if request.args.get("format") == "collapsed":
+        return app.response_class(profiler.collapsed(), mimetype="text/plain")
+    return jsonify(profiler.stats())
+
+@app.route("/profiler", methods=["POST"])
+def profiler_toggle():
+    if not PROFILER_ENDPOINT:
+        return jsonify({"error": "not found"}), 404
+    data = request.json or {}
+    interval = None
+    if data.get("interval") is not None:
+        try:
+            interval = parse_interval(data["interval"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    if data.get("reset"):
+        profiler.reset()
+    if "enabled" in data:
+        if data["enabled"]:
+            profiler.start(interval)
+        else:
+            profiler.stop()
+    return jsonify(profiler.stats())
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Il processo risponde (anche se il modello non è ancora pronto)"""
+    return jsonify({"status": "ok", "startup": startup})
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """Pronto a generare: modello caricato e riscaldato"""
+    manager = llm.manager
+    status = 200 if manager.ready else 503
+    return jsonify({"ready": manager.ready, "model": manager.stats(), "startup": startup}), status
+
+if MODEL_PRELOAD:
+    registry.load_async(llm.model_name)
+
 # Registra il blueprint PDF
 app.register_blueprint(pdf_bp, url_prefix='/api')
 # Registra il blueprint Email
@@ -55,75 +339,121 @@ app.register_blueprint(email_bp, url_prefix='/api')  # Nuovo
 # FUNZIONI DI STORAGE
 # ---------------------------------------------------
 def load_conversations():
-    with open(CONV_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return store.load_all()
 
-def save_conversations(data):
-    with open(CONV_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def get_conversation_data(conv_id):
+    return store.get(conv_id)
 
 def create_conversation(title="New chat"):
-    convs = load_conversations()
     conv_id = str(uuid.uuid4())
-    convs[conv_id] = {"title": title, "messages": []}
-    save_conversations(convs)
+    store.create(conv_id, title)
     return conv_id
 
 def append_message(conv_id, role, text):
-    convs = load_conversations()
-    if conv_id not in convs:
-        convs[conv_id] = {"title": "Chat", "messages": []}
-    convs[conv_id]["messages"].append({
-        "role": role,
-        "text": text,
-        "ts": time.time()
-    })
-    save_conversations(convs)
+    store.append(conv_id, role, text, time.time())
 
 # ---------------------------------------------------
 # FILTRO DOMANDE INFORMATICHE
 # ---------------------------------------------------
-ALLOWED_KEYWORDS = [
-    "software", "programmazione", "python", "javascript", "java", "c++", "c#", "rust",
-    "react", "next.js", "node", "backend", "frontend", "full stack", "database", "sql",
-    "mysql", "postgres", "mongodb", "server", "linux", "windows", "ubuntu",
-    "docker", "kubernetes", "devops", "ci/cd", "git", "github", "gitlab",
-    "network", "rete", "tcp", "udp", "http", "tls", "api",
-    "ai", "intelligenza artificiale", "llm", "machine learning",
-    "hardware", "cpu", "gpu", "ram", "ssd",
-]
-
 REFUSAL_MESSAGE = "Mi dispiace, posso rispondere solo a domande di ambito informatico."
 
+# File di parole chiave del deployment (ricaricato a caldo) e punteggio minimo
+TOPIC_KEYWORDS_FILE = os.environ.get("TOPIC_KEYWORDS_FILE")
+TOPIC_MIN_SCORE = float(os.environ.get("TOPIC_MIN_SCORE", 1))
+topic_filter = TopicFilter(TOPIC_KEYWORDS_FILE, min_score=TOPIC_MIN_SCORE)
+
 def is_informatics_question(text: str) -> bool:
-    t = text.lower()
-    return any(kw in t for kw in ALLOWED_KEYWORDS)
+    return topic_filter.is_allowed(text)
 
 # ---------------------------------------------------
 # STREAMING MODELLO
 # ---------------------------------------------------
-def generate_and_stream(conv_id, prompt, stop_event):
-    q = stream_queues.get(conv_id)
-    if q is None:
-        return
-
+def chat_params():
+    """Tutto ciò che, oltre alla domanda, determina la risposta (chiave della cache)"""
+    return (llm.model_name, SYSTEM_PROMPT, CHAT_MAX_TOKENS, CHAT_TEMPERATURE)
+
+def stream_text(conv_id, text):
+    """Risposta già pronta: stream già completo, senza thread né attese"""
+    previous = stream_threads.pop(conv_id, None)
+    if previous is not None:
+        previous["stop"].set()
+    stream = streams.open(conv_id)
+    stream.publish({"type": "token", "text": text})
+    stream.publish({"type": "done"})
+    append_message(conv_id, "assistant", text)
+
+def finish_job(conv_id, stop_event):
+    # Solo se nel frattempo non è partita un'altra generazione sulla conversazione
+    current = stream_threads.get(conv_id)
+    if current is not None and current["stop"] is stop_event:
+        stream_threads.pop(conv_id, None)
+
+def document_excerpts(conv_id, question):
+    """Chunk dei documenti della conversazione pertinenti alla domanda, entro RETRIEVAL_MAX_TOKENS"""
+    if not RETRIEVAL_TOP_K:
+        return ""
     try:
-        out = llm(prompt, max_tokens=400, temperature=0.7)
-        text = out["choices"][0]["text"].strip()
-        append_message(conv_id, "assistant", text)
+        hits = document_index.search(question, k=RETRIEVAL_TOP_K, conv_id=conv_id)
+    except Exception as e:
+        print(f"⚠️ Ricerca nei documenti fallita: {e}")
+        return ""
+    parts, used = [], 0
+    for hit in hits:
+        part = f"[{hit['filename']}, pag. {hit['page']}] {hit['text']}"
+        tokens = context.count_tokens(part)
+        if used + tokens > RETRIEVAL_MAX_TOKENS:
+            break
+        parts.append(part)
+        used += tokens
+    return "\n".join(parts)
+
+def build_prompt(history, summary="", excerpts=""):
+    # Il prefisso "System: ..." è identico a ogni turno: la cache KV lo riusa
+    prompt_parts = [f"System: {SYSTEM_PROMPT}"]
+    if summary:
+        prompt_parts.append("System: Riassunto della conversazione precedente: " + summary)
+    if excerpts:
+        prompt_parts.append("System: Estratti dei documenti caricati (usali se pertinenti):\n" + excerpts)
+    for m in history:
+        if m["role"] == "user":
+            prompt_parts.append("User: " + m["text"])
+        else:
+            prompt_parts.append("Assistant: " + m["text"])
+    return "\n".join(prompt_parts) + "\nAssistant:"
 
-        # Streaming chunk-by-chunk
-        chunk_size = 12
-        for i in range(0, len(text), chunk_size):
-            if stop_event.is_set():
-                break
-            q.put({"type": "token", "text": text[i:i+chunk_size]})
-            time.sleep(0.03)
+def generate_and_stream(conv_id, stream, prompt, stop_event, question=None, started=None):
+    parts = []
+    try:
+        # Streaming reale: ogni token del modello viene pubblicato subito
+        tokens = llm(prompt, max_tokens=CHAT_MAX_TOKENS, temperature=CHAT_TEMPERATURE, stream=True)
+        try:
+            for chunk in tokens:
+                if stop_event.is_set():
+                    break
+                token = chunk["choices"][0]["text"]
+                if not token:
+                    continue
+                if not parts and started is not None:
+                    CHAT_TTFT.observe(time.perf_counter() - started)
+                parts.append(token)
+                stream.publish({"type": "token", "text": token})
+        finally:
+            # Chiudere il generatore interrompe il ciclo di decode di llama_cpp
+            tokens.close()
+
+        text = "".join(parts).strip()
+        if text:
+            append_message(conv_id, "assistant", text)
+            # Solo risposte complete: una generazione interrotta non va in cache
+            if question is not None and not stop_event.is_set():
+                response_cache.put(question, chat_params(), text)
 
-        q.put({"type": "done"})
+        stream.publish({"type": "done"})
 
     except Exception as e:
-        q.put({"type": "error", "text": str(e)})
+        stream.publish({"type": "error", "text": str(e)})
+    finally:
+        finish_job(conv_id, stop_event)
 
 # ---------------------------------------------------
 # ROUTES
@@ -138,27 +468,35 @@ def static_files(p):
 
 @app.route("/conversations", methods=["GET"])
 def get_conversations():
-    convs = load_conversations()
-    sorted_list = sorted(
-        [
-            {
-                "id": k,
-                "title": v["title"],
-                "last_ts": v["messages"][-1]["ts"] if v["messages"] else 0
-            }
-            for k, v in convs.items()
-        ],
-        key=lambda x: x["last_ts"],
-        reverse=True,
-    )
-    return jsonify(sorted_list)
+    # Lista dall'indice riassuntivo: niente caricamento dei messaggi
+    limit = min(request.args.get("limit", CONV_PAGE_SIZE, type=int), CONV_PAGE_MAX)
+    cursor = request.args.get("cursor")
+
+    tag = f'{store.version()}-{limit}-{cursor or ""}'
+    etag = f'W/"{tag}"'
+    # Confronto debole tra entity tag interi (lista separata da virgole o "*")
+    if request.if_none_match.contains_weak(tag):
+        return "", 304, {"ETag": etag}
+
+    try:
+        items, next_cursor = store.list_summaries(limit=limit, cursor=cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    resp = jsonify(items)
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = "no-cache"
+    if next_cursor:
+        resp.headers["X-Next-Cursor"] = next_cursor
+        resp.headers["Link"] = f'</conversations?limit={limit}&cursor={next_cursor}>; rel="next"'
+    return resp
 
 @app.route("/conversation/<conv_id>", methods=["GET"])
 def get_conversation(conv_id):
-    convs = load_conversations()
-    if conv_id not in convs:
+    conv = get_conversation_data(conv_id)
+    if conv is None:
         return jsonify({"error": "not found"}), 404
-    return jsonify(convs[conv_id])
+    return jsonify(conv)
 
 @app.route("/conversation", methods=["POST"])
 def new_conversation():
@@ -183,90 +521,135 @@ def send_message():
 # ---------------------------------------------------
 @app.route("/start_stream", methods=["POST"])
 def start_stream():
+    started = g.get("started_at")
     data = request.json or {}
     conv_id = data.get("conv_id") or create_conversation()
 
-    convs = load_conversations()
-    history = convs.get(conv_id, {}).get("messages", [])
+    with span("history"):
+        history = (get_conversation_data(conv_id) or {}).get("messages", [])
     last_user_msg = history[-1]["text"] if history else ""
 
     # ❗ CONTROLLO PRIMA DEL MODELLO
-    if not is_informatics_question(last_user_msg):
-        q = Queue()
-        stream_queues[conv_id] = q
-
-        def stream_refusal():
-            text = REFUSAL_MESSAGE
-            chunk_size = 12
-            for i in range(0, len(text), chunk_size):
-                q.put({"type": "token", "text": text[i:i+chunk_size]})
-                time.sleep(0.03)
-            q.put({"type": "done"})
-            append_message(conv_id, "assistant", text)
-
-        threading.Thread(target=stream_refusal, daemon=True).start()
+    with span("topic_filter"):
+        allowed = is_informatics_question(last_user_msg)
+    if not allowed:
+        stream_text(conv_id, REFUSAL_MESSAGE)
         return jsonify({"conv_id": conv_id})
 
-    # Domanda informatica → usa il modello
-    SYSTEM_PROMPT = """
-Sei un assistente specializzato esclusivamente in ambito informatico.
-Rispondi sempre in modo tecnico, conciso e accurato.
-"""
-
-    prompt_parts = [f"System: {SYSTEM_PROMPT}"]
-    for m in history:
-        if m["role"] == "user":
-            prompt_parts.append("User: " + m["text"])
-        else:
-            prompt_parts.append("Assistant: " + m["text"])
-    prompt = "\n".join(prompt_parts) + "\nAssistant:"
+    # Solo i chunk pertinenti dei documenti caricati, non i documenti interi
+    with span("retrieval"):
+        excerpts = document_excerpts(conv_id, last_user_msg)
+
+    # Prima domanda della conversazione: la risposta non dipende da altro contesto
+    question = None
+    if RESPONSE_CACHE_SIZE and not excerpts and len(history) == 1 and history[0]["role"] == "user":
+        question = last_user_msg
+        with span("response_cache"):
+            cached = response_cache.get(question, chat_params())
+        if cached is not None:
+            stream_text(conv_id, cached)
+            return jsonify({"conv_id": conv_id, "cached": True})
+
+    # Domanda informatica → usa il modello, con i soli turni che stanno nel budget
+    with span("context"):
+        reserved = context.count_tokens(SYSTEM_PROMPT) + MESSAGE_OVERHEAD
+        if excerpts:
+            reserved += context.count_tokens(excerpts) + MESSAGE_OVERHEAD
+        summary, window = context.select(conv_id, history, reserved_tokens=reserved)
+        prompt = build_prompt(window, summary, excerpts)
+
+    # Una nuova richiesta sulla stessa conversazione annulla la generazione precedente
+    previous = stream_threads.get(conv_id)
+    if previous is not None:
+        previous["stop"].set()
+
+    # Stream nuovo: eventuali token della generazione annullata restano nel vecchio
+    stream = streams.open(conv_id)
+    stop_event = threading.Event()
 
-    # Queue
-    if conv_id not in stream_queues:
-        stream_queues[conv_id] = Queue()
-    else:
-        try:
-            while True:
-                stream_queues[conv_id].get_nowait()
-        except Empty:
-            pass
+    def drop_stream(job, exc):
+        stream.publish({"type": "error", "text": str(exc)})
+        finish_job(conv_id, stop_event)
 
-    stop_event = threading.Event()
-    t = threading.Thread(target=generate_and_stream, args=(conv_id, prompt, stop_event), daemon=True)
-    stream_threads[conv_id] = {"thread": t, "stop": stop_event}
-    t.start()
+    # Registrata prima dell'invio: il job può finire prima che submit ritorni
+    entry = stream_threads[conv_id] = {"job": None, "stop": stop_event}
+    try:
+        entry["job"] = scheduler.submit(
+            lambda: generate_and_stream(conv_id, stream, prompt, stop_event, question, started),
+            priority=PRIORITY_INTERACTIVE,
+            timeout=CHAT_QUEUE_TIMEOUT,
+            cancel_event=stop_event,
+            on_drop=drop_stream,
+        )
+    except SchedulerFullError as e:
+        finish_job(conv_id, stop_event)
+        streams.discard(stream)
+        return jsonify({"error": str(e)}), 429, {"Retry-After": "5"}
 
     return jsonify({"conv_id": conv_id})
 
+@app.route("/scheduler/stats", methods=["GET"])
+def scheduler_stats():
+    return jsonify(scheduler.stats())
+
+@app.route("/models", methods=["GET"])
+def list_models():
+    return jsonify(registry.stats())
+
+@app.route("/models/route", methods=["POST"])
+def set_model_route():
+    """Cambia a caldo il modello di una route; gli stream in corso finiscono con il vecchio"""
+    data = request.json or {}
+    route = data.get("route")
+    if not route:
+        return jsonify({"error": "route mancante"}), 400
+    try:
+        registry.set_route(route, data.get("model"))
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 404
+    if MODEL_PRELOAD:
+        registry.load_async(registry.route_model(route))
+    return jsonify({"route": route, "model": registry.route_model(route)})
+
+@app.route("/models/params", methods=["POST"])
+def set_model_params():
+    """Override a runtime di n_threads/n_batch/n_ctx... di un modello (params null = profilo e configurazione)"""
+    data = request.json or {}
+    model = data.get("model")
+    if not model:
+        return jsonify({"error": "model mancante"}), 400
+    try:
+        params = registry.set_model_params(model, data.get("params"))
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"model": model, "params": params})
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "kv_cache": {name: cache.stats() for name, cache in kv_caches.items()},
+        "responses": response_cache.stats(),
+    })
+
 # ---------------------------------------------------
 # EVENTS STREAM
 # ---------------------------------------------------
 @app.route("/events/<conv_id>")
 def events(conv_id):
-    def gen():
-        q = stream_queues.get(conv_id)
-        timeout_wait = 0
-        while q is None and timeout_wait < 5:
-            time.sleep(0.1)
-            timeout_wait += 0.1
-            q = stream_queues.get(conv_id)
-
-        if q is None:
-            yield "data: " + json.dumps({"type": "error", "text": "no stream queue"}) + "\n\n"
-            return
-
-        while True:
-            try:
-                item = q.get(timeout=60)
-            except Empty:
-                yield "data: " + json.dumps({"type": "done"}) + "\n\n"
-                break
-
-            yield "data: " + json.dumps(item, ensure_ascii=False) + "\n\n"
-            if item.get("type") in ("done", "error"):
-                break
-
-    return app.response_class(gen(), mimetype="text/event-stream")
+    """Eventi SSE della generazione; alla riconnessione riprende da Last-Event-ID"""
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or 0
+    try:
+        last_id = int(last_id)
+    except ValueError:
+        last_id = 0
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return app.response_class(streams.subscribe(conv_id, last_id), mimetype="text/event-stream", headers=headers)
+
+@app.route("/streams/stats", methods=["GET"])
+def stream_stats():
+    return jsonify({**streams.stats(), "generations": len(stream_threads)})
 
 # ---------------------------------------------------
 # AVVIO SERVER
@@ -276,7 +659,6 @@ if __name__ == "__main__":
         os.makedirs(MODELS_DIR)
     
     # Fix per Windows 11 - disabilita output colorato
-    import sys
     os.environ['PYTHONIOENCODING'] = 'utf-8'
     
     # Avvia senza debug per evitare problemi console
@@ -0,0 +1,277 @@
+"""Calibrazione di n_threads / n_batch / n_ctx per la CPU di questa macchina.
+
+Per ogni modello GGUF misura la valutazione del prompt (token/s) al variare
+di thread e n_batch e il decode (token/s) al variare dei thread, poi scrive
+un profilo JSON che app.py e inference_server.py caricano all'avvio:
+
+    python autotune.py                         # tutti i modelli in MODELS_DIR
+    python autotune.py --model qwen2-0_5b-instruct-q4_k_m.gguf --threads 2,4,8
+
+llama.cpp usa thread separati per prompt (n_threads_batch) e decode
+(n_threads): ciascuno prende il valore più veloce nel proprio carico.
+n_ctx è il più grande tra i candidati che rispetta il contesto di training
+del modello e una quota della RAM libera per la cache KV.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+MODELS_DIR = os.environ.get("MODELS_DIR", "./models")
+TUNING_PROFILE = os.environ.get("TUNING_PROFILE", os.path.join(MODELS_DIR, "tuning.json"))
+
+BATCH_SIZES = (64, 128, 256, 512)
+CTX_SIZES = (2048, 4096, 8192, 16384, 32768)
+
+# Testo per i probe: il contenuto non conta, serve solo un numero fisso di token
+PROBE_TEXT = ("Il server riceve le richieste HTTP, le mette in coda e genera le risposte "
+              "token per token con il modello quantizzato caricato in memoria. ")
+
+
+# ---------------------------------------------------
+# MACCHINA
+# ---------------------------------------------------
+def host_info():
+    """Identifica la CPU: un profilo misurato altrove non vale qui"""
+    model = platform.processor()
+    physical = set()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            core = {}
+            for line in f:
+                key, _, value = line.partition(":")
+                key, value = key.strip(), value.strip()
+                if key == "model name":
+                    model = value
+                elif key in ("physical id", "core id"):
+                    core[key] = value
+                elif not key and core:
+                    physical.add((core.get("physical id"), core.get("core id")))
+                    core = {}
+            if core:
+                physical.add((core.get("physical id"), core.get("core id")))
+    except OSError:
+        pass
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    return {
+        "machine": platform.machine(),
+        "cpu": model,
+        "cpus": cpus,
+        "physical_cores": min(len(physical), cpus) if physical else cpus,
+    }
+
+
+def thread_candidates(host):
+    """Potenze di 2 fino ai core disponibili, più core fisici e logici"""
+    cpus = host["cpus"]
+    values = {host["physical_cores"], cpus}
+    n = 1
+    while n < cpus:
+        values.add(n)
+        n *= 2
+    return sorted(values)
+
+
+def available_memory():
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) << 10
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def kv_bytes_per_token(llm):
+    """Byte di cache KV (f16) per token di contesto, dai metadati GGUF"""
+    meta = getattr(llm, "metadata", None) or {}
+    arch = meta.get("general.architecture")
+    try:
+        layers = int(meta[f"{arch}.block_count"])
+        embd = int(meta[f"{arch}.embedding_length"])
+        heads = int(meta[f"{arch}.attention.head_count"])
+        heads_kv = int(meta.get(f"{arch}.attention.head_count_kv", heads))
+    except (KeyError, TypeError, ValueError):
+        return None
+    return 2 * layers * (embd * heads_kv // heads) * 2
+
+
+def pick_n_ctx(n_ctx_train, kv_per_token, memory, max_ctx, kv_fraction=0.25):
+    best = CTX_SIZES[0]
+    for n_ctx in CTX_SIZES:
+        if n_ctx > max_ctx or (n_ctx_train and n_ctx > n_ctx_train):
+            break
+        if kv_per_token and memory and n_ctx * kv_per_token > memory * kv_fraction:
+            break
+        best = n_ctx
+    return best
+
+
+# ---------------------------------------------------
+# PROBE
+# ---------------------------------------------------
+def _set_threads(llm, n_threads):
+    import llama_cpp
+    llama_cpp.llama_set_n_threads(llm.ctx, n_threads, n_threads)
+
+
+def probe_prompt(llm, tokens, repeats):
+    """Token/s della valutazione di un prompt da zero (il migliore su `repeats`)"""
+    best = 0.0
+    for _ in range(repeats):
+        llm.reset()
+        t0 = time.perf_counter()
+        llm.eval(tokens)
+        best = max(best, len(tokens) / (time.perf_counter() - t0))
+    return best
+
+
+def probe_decode(llm, tokens, n_decode, repeats):
+    """Token/s del decode un token alla volta dopo un prompt corto"""
+    best = 0.0
+    prompt, feed = tokens[:16], tokens[16:16 + n_decode]
+    for _ in range(repeats):
+        llm.reset()
+        llm.eval(prompt)
+        t0 = time.perf_counter()
+        for token in feed:
+            llm.eval([token])
+        best = max(best, len(feed) / (time.perf_counter() - t0))
+    return best
+
+
+def calibrate(model_path, threads, batches=BATCH_SIZES, prompt_tokens=512, decode_tokens=64,
+              repeats=2, max_ctx=8192, log=print):
+    """Misura il modello e restituisce la voce del profilo"""
+    from llama_cpp import Llama
+
+    probes = []
+    decode = {}
+    prompt = {}
+    n_ctx_probe = max(prompt_tokens, 16 + decode_tokens) + 16
+    info = None
+    for n_batch in sorted(b for b in batches if b <= prompt_tokens) or [prompt_tokens]:
+        llm = Llama(model_path=model_path, n_ctx=n_ctx_probe, n_batch=n_batch, n_threads=threads[-1],
+                    n_gpu_layers=0, use_mmap=True, verbose=False)
+        try:
+            tokens = llm.tokenize(PROBE_TEXT.encode("utf-8"), add_bos=False)
+            tokens = (tokens * (n_ctx_probe // max(len(tokens), 1) + 1))[:max(prompt_tokens, 16 + decode_tokens)]
+            if info is None:
+                info = {"n_ctx_train": llm.n_ctx_train(), "kv_bytes_per_token": kv_bytes_per_token(llm)}
+                # Porta in memoria le pagine dei pesi prima di misurare
+                llm.eval(tokens[:prompt_tokens])
+            for n_threads in threads:
+                _set_threads(llm, n_threads)
+                tps = probe_prompt(llm, tokens[:prompt_tokens], repeats)
+                probes.append({"kind": "prompt", "n_threads": n_threads, "n_batch": n_batch, "tokens_per_s": round(tps, 1)})
+                log(f"  prompt  n_batch={n_batch:<4} n_threads={n_threads:<3} {tps:8.1f} tok/s")
+                if tps > prompt.get("tokens_per_s", 0):
+                    prompt = {"n_threads": n_threads, "n_batch": n_batch, "tokens_per_s": round(tps, 1)}
+                if not decode.get("done"):
+                    # Il decode elabora un token per passo: n_batch non conta, basta una serie
+                    tps = probe_decode(llm, tokens, decode_tokens, repeats)
+                    probes.append({"kind": "decode", "n_threads": n_threads, "tokens_per_s": round(tps, 1)})
+                    log(f"  decode  n_threads={n_threads:<3} {tps:8.1f} tok/s")
+                    if tps > decode.get("tokens_per_s", 0):
+                        decode.update({"n_threads": n_threads, "tokens_per_s": round(tps, 1)})
+            decode["done"] = True
+        finally:
+            if hasattr(llm, "close"):
+                llm.close()
+            del llm
+    decode.pop("done", None)
+
+    n_ctx = pick_n_ctx(info["n_ctx_train"], info["kv_bytes_per_token"], available_memory(), max_ctx)
+    return {
+        "params": {
+            "n_threads": decode["n_threads"],
+            "n_threads_batch": prompt["n_threads"],
+            "n_batch": prompt["n_batch"],
+            "n_ctx": n_ctx,
+        },
+        "prompt": prompt,
+        "decode": decode,
+        "n_ctx_train": info["n_ctx_train"],
+        "kv_bytes_per_token": info["kv_bytes_per_token"],
+        "size_mb": round(os.path.getsize(model_path) / (1 << 20), 1),
+        "probes": probes,
+        "measured_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+# ---------------------------------------------------
+# PROFILO
+# ---------------------------------------------------
+def read_profile(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_profile(path, profile):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp, path)
+
+
+def load_profile(path):
+    """Parametri calibrati per modello ({nome: params}); vuoto se il profilo è di un'altra CPU"""
+    profile = read_profile(path)
+    if not profile:
+        return {}
+    host, current = profile.get("host", {}), host_info()
+    if any(host.get(k) != current[k] for k in ("machine", "cpu", "cpus")):
+        print(f"⚠️ Profilo di tuning {path} misurato su un'altra CPU ({host.get('cpu')}, {host.get('cpus')} core): ignorato")
+        return {}
+    params = {name: dict(entry.get("params", {})) for name, entry in profile.get("models", {}).items()}
+    print(f"✅ Profilo di tuning caricato da {path} ({len(params)} modelli)")
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models-dir", default=MODELS_DIR)
+    parser.add_argument("--model", action="append", help="file GGUF da calibrare (ripetibile; default tutti)")
+    parser.add_argument("--output", default=TUNING_PROFILE)
+    parser.add_argument("--threads", help="thread da provare, es. 2,4,6,8 (default automatico)")
+    parser.add_argument("--batches", default=",".join(map(str, BATCH_SIZES)))
+    parser.add_argument("--prompt-tokens", type=int, default=512)
+    parser.add_argument("--decode-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--max-ctx", type=int, default=8192, help="n_ctx massimo da proporre")
+    args = parser.parse_args()
+
+    host = host_info()
+    threads = [int(t) for t in args.threads.split(",")] if args.threads else thread_candidates(host)
+    batches = [int(b) for b in args.batches.split(",")]
+    names = args.model or sorted(n for n in os.listdir(args.models_dir) if n.lower().endswith(".gguf"))
+    if not names:
+        sys.exit(f"Nessun modello GGUF in {args.models_dir}")
+
+    # Si aggiorna solo la voce dei modelli misurati; un profilo di un'altra CPU si scarta
+    profile = read_profile(args.output)
+    if profile.get("host") != host:
+        profile = {}
+    profile["host"] = host
+    models = profile.setdefault("models", {})
+    print(f"CPU: {host['cpu']} ({host['physical_cores']} core fisici, {host['cpus']} logici); thread {threads}")
+    for name in names:
+        print(f"⏱️ {name}")
+        entry = calibrate(os.path.join(args.models_dir, name), threads, batches, args.prompt_tokens,
+                          args.decode_tokens, args.repeats, args.max_ctx)
+        models[name] = entry
+        write_profile(args.output, profile)
+        print(f"✅ {name}: {entry['params']} (prompt {entry['prompt']['tokens_per_s']} tok/s, "
+              f"decode {entry['decode']['tokens_per_s']} tok/s)")
+    print(f"Profilo scritto in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import time
+import uuid
+import codecs
+import threading
+from queue import Queue
+
+import numpy as np
+
+# Fine dello stream di una sequenza
+_END = object()
+
+
+class LlamaBatchBackend:
+    """Contesto llama.cpp multi-sequenza creato sui pesi di un Llama già caricato.
+
+    I pesi (mappati in memoria) sono condivisi con il Llama; il contesto ha una
+    cache KV unificata di `n_ctx` token divisa tra `n_seq_max` sequenze.
+    """
+
+    def __init__(self, llm, n_ctx, n_seq_max, n_batch=512, n_threads=None, n_threads_batch=None):
+        import llama_cpp
+        from llama_cpp import _internals
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        params.n_ubatch = n_batch
+        params.n_seq_max = n_seq_max
+        threads = n_threads or llm.context_params.n_threads
+        params.n_threads = threads
+        params.n_threads_batch = n_threads_batch or llm.context_params.n_threads_batch or threads
+        self._llama_cpp = llama_cpp
+        self._model = llm._model
+        self._ctx = _internals.LlamaContext(model=llm._model, params=params, verbose=False)
+        self._batch = _internals.LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=n_seq_max)
+        self.n_batch = n_batch
+        self.n_vocab = llm.n_vocab()
+        self.eos = llm.token_eos()
+        self.tokenize = llm.tokenize
+        self.model_path = llm.model_path
+
+    def is_eog(self, token):
+        is_eog = getattr(self._llama_cpp, "llama_token_is_eog", None)
+        if is_eog is not None:
+            try:
+                return bool(is_eog(self._model.model, token))
+            except Exception:
+                pass
+        return token == self.eos
+
+    def token_to_piece(self, token):
+        return self._model.token_to_piece(token)
+
+    def decode(self, entries):
+        """entries: [(token, pos, seq, logits)]; restituisce i logits richiesti nello stesso ordine"""
+        batch = self._batch.batch
+        batch.n_tokens = len(entries)
+        for i, (token, pos, seq, logits) in enumerate(entries):
+            batch.token[i] = token
+            batch.pos[i] = pos
+            batch.seq_id[i][0] = seq
+            batch.n_seq_id[i] = 1
+            batch.logits[i] = logits
+        self._ctx.decode(self._batch)
+        out = []
+        for i, entry in enumerate(entries):
+            if entry[3]:
+                ptr = self._ctx.get_logits_ith(i)
+                out.append(np.ctypeslib.as_array(ptr, shape=(self.n_vocab,)).copy())
+        return out
+
+    def seq_rm(self, seq, p0=-1, p1=-1):
+        self._ctx.kv_cache_seq_rm(seq, p0, p1)
+
+    def seq_cp(self, src, dst, p0, p1):
+        self._ctx.kv_cache_seq_cp(src, dst, p0, p1)
+
+    def close(self):
+        for name in ("_batch", "_ctx"):
+            obj = getattr(self, name, None)
+            if obj is not None and hasattr(obj, "close"):
+                obj.close()
+
+
+class Sequence:
+    """Una generazione in corso dentro il motore"""
+
+    def __init__(self, prompt_tokens, max_tokens, params):
+        self.id = f"cmpl-{uuid.uuid4()}"
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = params.get("temperature", 0.8)
+        self.top_p = params.get("top_p", 0.95)
+        self.top_k = params.get("top_k", 40)
+        self.repeat_penalty = params.get("repeat_penalty", 1.1)
+        stop = params.get("stop") or []
+        self.stop = [stop] if isinstance(stop, str) else list(stop)
+        self.rng = np.random.default_rng(params.get("seed"))
+        self.out = Queue()
+        self.cancelled = threading.Event()
+        self.slot = None
+        self.pos = 0              # token già nella cache KV
+        self.prefill = 0          # token del prompt già inviati
+        self.generated = []
+        self.next_token = None
+        self.text = ""
+        self.sent = 0             # caratteri di text già inviati
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.finish_reason = None
+
+    @property
+    def reserved(self):
+        # Token di cache KV che la sequenza può arrivare a occupare
+        return len(self.prompt_tokens) + self.max_tokens
+
+
+class BatchEngine:
+    """Continuous batching: più generazioni condividono ogni passo di decode.
+
+    Un thread esegue il ciclo: a ogni passo il batch contiene un token per
+    ogni sequenza in decode più, nello spazio restante di `n_batch`, pezzi dei
+    prompt delle sequenze appena ammesse (prefill a blocchi). Le sequenze
+    entrano quando c'è uno slot libero e abbastanza cache KV per prompt +
+    max_tokens, ed escono appena finite o annullate, senza fermare le altre.
+    Si chiama come un Llama: llm(prompt, max_tokens=..., stream=True).
+
+    Con set_prefix() il prefisso comune dei prompt (system prompt) viene
+    valutato una volta nella sequenza 0 e copiato nelle altre.
+    """
+
+    def __init__(self, backend, max_sequences=4, n_ctx=8192):
+        self.backend = backend
+        self.model_path = getattr(backend, "model_path", "")
+        self.max_sequences = max_sequences
+        self.n_ctx = n_ctx
+        self._pending = []
+        self._active = []
+        self._free_slots = list(range(1, max_sequences + 1))
+        self._cond = threading.Condition()
+        self._closed = False
+        self._prefix = ()
+        self._prefix_ready = False
+        self.counters = {"sequences": 0, "steps": 0, "tokens": 0, "batched_tokens": 0}
+        self._thread = threading.Thread(target=self._loop, name="batch-engine", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_llama(cls, llm, max_sequences=4, n_ctx=8192, n_batch=512, n_threads=None, n_threads_batch=None):
+        """Motore sui pesi di un Llama caricato (nessuna copia del modello)"""
+        backend = LlamaBatchBackend(llm, n_ctx=n_ctx, n_seq_max=max_sequences + 1, n_batch=n_batch,
+                                    n_threads=n_threads, n_threads_batch=n_threads_batch)
+        return cls(backend, max_sequences=max_sequences, n_ctx=n_ctx)
+
+    # ---------------------------------------------------
+    # API
+    # ---------------------------------------------------
+    def set_prefix(self, text):
+        with self._cond:
+            self._prefix = tuple(self.backend.tokenize(text.encode("utf-8")))
+            self._prefix_ready = False
+            self._cond.notify()
+
+    def __call__(self, prompt, max_tokens=16, stream=False, **params):
+        tokens = self.backend.tokenize(prompt.encode("utf-8"))
+        max_tokens = max_tokens or 256
+        if len(tokens) + max_tokens + len(self._prefix) > self.n_ctx:
+            raise ValueError(f"Prompt troppo lungo: {len(tokens)} token + {max_tokens} da generare "
+                             f"superano il contesto di {self.n_ctx}")
+        seq = Sequence(tokens, max_tokens, params)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Motore di batching chiuso")
+            self._pending.append(seq)
+            self._cond.notify()
+        chunks = self._chunks(seq)
+        if stream:
+            return chunks
+        text = "".join(chunk["choices"][0]["text"] for chunk in chunks)
+        return {
+            "id": seq.id,
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": self.model_path,
+            "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": seq.finish_reason}],
+            "usage": {"prompt_tokens": len(seq.prompt_tokens), "completion_tokens": len(seq.generated),
+                      "total_tokens": len(seq.prompt_tokens) + len(seq.generated)},
+        }
+
+    def _chunks(self, seq):
+        try:
+            while True:
+                item = seq.out.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield {
+                    "id": seq.id,
+                    "object": "text_completion",
+                    "created": int(time.time()),
+                    "model": self.model_path,
+                    "choices": [{"text": item[0], "index": 0, "logprobs": None, "finish_reason": item[1]}],
+                }
+        finally:
+            # Stream chiuso dal consumatore: la sequenza esce al prossimo passo
+            seq.cancelled.set()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max_sequences": self.max_sequences,
+                "active": len(self._active),
+                "pending": len(self._pending),
+                "kv_reserved": self._reserved(),
+                "n_ctx": self.n_ctx,
+                "avg_batch": round(self.counters["batched_tokens"] / self.counters["steps"], 2)
+                if self.counters["steps"] else 0.0,
+                **self.counters,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.backend.close()
+
+    # ---------------------------------------------------
+    # CICLO DI DECODE
+    # ---------------------------------------------------
+    def _reserved(self):
+        return len(self._prefix) + sum(s.reserved for s in self._active)
+
+    def _admit(self):
+        # In ordine di arrivo, finché ci sono slot e cache KV
+        while self._pending and self._free_slots:
+            seq = self._pending[0]
+            if seq.cancelled.is_set():
+                self._pending.pop(0)
+                seq.out.put(_END)
+                continue
+            if self._active and self._reserved() + seq.reserved > self.n_ctx:
+                break
+            self._pending.pop(0)
+            seq.slot = self._free_slots.pop(0)
+            prefix = self._prefix if self._prefix_ready else ()
+            shared = _common_prefix(prefix, seq.prompt_tokens)
+            # Il prompt deve valutare almeno l'ultimo token per avere i logits
+            shared = min(shared, len(seq.prompt_tokens) - 1)
+            if shared > 0:
+                self.backend.seq_cp(0, seq.slot, 0, shared)
+            seq.pos = seq.prefill = shared
+            self._active.append(seq)
+            self.counters["sequences"] += 1
+
+    def _retire(self, seq, reason=None):
+        self.backend.seq_rm(seq.slot)
+        self._active.remove(seq)
+        self._free_slots.append(seq.slot)
+        seq.finish_reason = reason
+        tail = seq.text[seq.sent:]
+        seq.out.put((tail, reason or "stop"))
+        seq.out.put(_END)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._active and not self._pending and \
+                        (self._prefix_ready or not self._prefix):
+                    self._cond.wait()
+                if self._closed:
+                    for seq in self._active + self._pending:
+                        seq.out.put(RuntimeError("Motore di batching chiuso"))
+                        seq.out.put(_END)
+                    return
+                if self._prefix and not self._prefix_ready and not self._active:
+                    self._warm_prefix()
+                for seq in [s for s in self._active if s.cancelled.is_set()]:
+                    self._retire(seq, "cancelled")
+                self._admit()
+                active = list(self._active)
+            if active:
+                try:
+                    self._step(active)
+                except Exception as e:
+                    with self._cond:
+                        for seq in list(self._active):
+                            self.backend.seq_rm(seq.slot)
+                            self._active.remove(seq)
+                            self._free_slots.append(seq.slot)
+                            seq.out.put(e)
+                            seq.out.put(_END)
+
+    def _warm_prefix(self):
+        self.backend.seq_rm(0)
+        tokens = self._prefix
+        for start in range(0, len(tokens), self.backend.n_batch):
+            part = tokens[start:start + self.backend.n_batch]
+            self.backend.decode([(t, start + i, 0, False) for i, t in enumerate(part)])
+        self._prefix_ready = True
+
+    def _step(self, active):
+        entries = []
+        wants = []
+        # Prima un token per ogni sequenza già in decode
+        for seq in active:
+            if seq.next_token is not None:
+                entries.append((seq.next_token, seq.pos, seq.slot, True))
+                wants.append(seq)
+        # Poi i prompt a blocchi nello spazio rimasto
+        room = self.backend.n_batch - len(entries)
+        for seq in active:
+            if seq.next_token is not None or room <= 0:
+                continue
+            part = seq.prompt_tokens[seq.prefill:seq.prefill + room]
+            last = seq.prefill + len(part) == len(seq.prompt_tokens)
+            for i, token in enumerate(part):
+                entries.append((token, seq.prefill + i, seq.slot, last and i == len(part) - 1))
+            seq.prefill += len(part)
+            room -= len(part)
+            if last:
+                wants.append(seq)
+        if not entries:
+            return
+
+        logits = self.backend.decode(entries)
+        self.counters["steps"] += 1
+        self.counters["batched_tokens"] += len(entries)
+
+        finished = []
+        for seq, row in zip(wants, logits):
+            seq.pos = seq.prefill if seq.next_token is None else seq.pos + 1
+            token = _sample(row, seq)
+            seq.generated.append(token)
+            self.counters["tokens"] += 1
+            reason = self._emit(seq, token)
+            seq.next_token = token
+            if reason:
+                finished.append((seq, reason))
+        # Le sequenze in prefill non ancora completo avanzano solo di posizione
+        for seq in active:
+            if seq.next_token is None:
+                seq.pos = seq.prefill
+        if finished:
+            with self._cond:
+                for seq, reason in finished:
+                    self._retire(seq, reason)
+
+    def _emit(self, seq, token):
+        """Aggiunge il token al testo, invia la parte sicura; restituisce il motivo di fine"""
+        if self.backend.is_eog(token):
+            seq.generated.pop()
+            return "stop"
+        seq.text += seq.decoder.decode(self.backend.token_to_piece(token))
+        for stop in seq.stop:
+            i = seq.text.find(stop, max(0, seq.sent - len(stop)))
+            if i >= 0:
+                seq.text = seq.text[:i]
+                return "stop"
+        if len(seq.generated) >= seq.max_tokens:
+            return "length"
+        # Si trattiene la coda che potrebbe essere l'inizio di una stringa di stop
+        hold = max((len(s) - 1 for s in seq.stop), default=0)
+        end = len(seq.text) - hold
+        if end > seq.sent:
+            seq.out.put((seq.text[seq.sent:end], None))
+            seq.sent = end
+        return None
+
+
+def _common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _sample(logits, seq):
+    """Campionamento come llama.cpp: repeat penalty, top-k, top-p, temperatura"""
+    if seq.repeat_penalty and seq.repeat_penalty != 1.0 and seq.generated:
+        recent = np.unique(np.array(seq.generated[-64:]))
+        values = logits[recent]
+        logits[recent] = np.where(values > 0, values / seq.repeat_penalty, values * seq.repeat_penalty)
+    if not seq.temperature or seq.temperature <= 0:
+        return int(np.argmax(logits))
+    k = min(seq.top_k or len(logits), len(logits))
+    top = np.argpartition(logits, -k)[-k:]
+    top = top[np.argsort(logits[top])[::-1]]
+    scaled = logits[top] / seq.temperature
+    probs = np.exp(scaled - scaled.max())
+    probs /= probs.sum()
+    if seq.top_p and seq.top_p < 1.0:
+        keep = np.searchsorted(np.cumsum(probs), seq.top_p) + 1
+        top, probs = top[:keep], probs[:keep] / probs[:keep].sum()
+    return int(seq.rng.choice(top, p=probs))
@@ -0,0 +1,519 @@
+"""Benchmark end-to-end e test di carico con modello finto e server IMAP locale.
+
+Avvia l'app in-process (HTTP reale su una porta locale) con FakeLlama al posto
+di llama_cpp, storage e cache in una cartella temporanea, e simula utenti
+concorrenti su tre scenari:
+
+    chat   /send + /start_stream + /events (SSE) per più turni
+    pdf    /api/pdf/summary con PDF e DOCX generati
+    email  /api/email/connect, /list, /read, /summarize su FakeImapServer
+
+Riporta p50/p95/p99 di time-to-first-token, token/s, latenze degli endpoint e
+delle scritture dello storage, e la crescita della memoria (RSS). Con --output
+i risultati vanno in JSON; --compare li confronta con un file precedente.
+
+    python benchmarks/e2e_bench.py --users 8 --turns 3 --output bench.json
+    python benchmarks/e2e_bench.py --compare bench.json --fail-on-regression
+"""
+import os
+import sys
+import gc
+import json
+import time
+import uuid
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from contextlib import contextmanager
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_llama
+from fake_imap import FakeImapServer
+from sample_docs import make_pdf, make_docx
+
+SCENARIOS = ("chat", "pdf", "email")
+
+QUESTIONS = (
+    "Come configuro un indice composto in PostgreSQL?",
+    "Qual è la differenza tra processi e thread in Linux?",
+    "Come riduco la dimensione di un'immagine Docker?",
+    "Come funziona il garbage collector di Python?",
+    "Perché la mia query SQL non usa l'indice?",
+    "Come imposto una pipeline CI/CD su GitHub?",
+)
+
+
+# ---------------------------------------------------
+# STATISTICHE
+# ---------------------------------------------------
+def percentile(values, p):
+    """Percentile nearest-rank su valori già ordinati"""
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def summarize(values, scale=1.0, digits=4):
+    values = sorted(v * scale for v in values)
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "mean": round(sum(values) / len(values), digits),
+        "p50": round(percentile(values, 50), digits),
+        "p95": round(percentile(values, 95), digits),
+        "p99": round(percentile(values, 99), digits),
+        "max": round(values[-1], digits),
+    }
+
+
+def rss_mb():
+    """Memoria residente del processo (MB)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # Picco, non valore corrente: su macOS è in byte, su Linux in KB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+class Samples:
+    """Raccoglie durate per etichetta (thread-safe)"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value):
+        with self._lock:
+            self._values.setdefault(name, []).append(value)
+
+    def take(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+
+class StoreRecorder:
+    """Sostituisce l'istogramma dello store: tiene le durate grezze e le inoltra"""
+
+    def __init__(self, metric, samples):
+        self.metric = metric
+        self.samples = samples
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.samples.add(labels.get("op", ""), elapsed)
+            self.metric.observe(elapsed, **labels)
+
+
+# ---------------------------------------------------
+# CLIENT HTTP
+# ---------------------------------------------------
+class Client:
+    def __init__(self, port, timeout=300):
+        self.port = port
+        self.timeout = timeout
+
+    def _conn(self):
+        return http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """(status, json o None); la connessione si chiude a ogni richiesta"""
+        conn = self._conn()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            data = resp.read()
+            try:
+                return resp.status, json.loads(data) if data else None
+            except ValueError:
+                return resp.status, None
+        finally:
+            conn.close()
+
+    def post_json(self, path, payload):
+        return self.request("POST", path, json.dumps(payload), {"Content-Type": "application/json"})
+
+    def post_file(self, path, filename, content):
+        boundary = uuid.uuid4().hex
+        body = (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+        return self.request("POST", path, body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+    def events(self, path):
+        """Eventi SSE (dict) finché il server chiude lo stream"""
+        conn = self._conn()
+        try:
+            conn.request("GET", path, headers={"Accept": "text/event-stream"})
+            resp = conn.getresponse()
+            while True:
+                line = resp.readline()
+                if not line:
+                    return
+                if line.startswith(b"data: "):
+                    yield json.loads(line[6:])
+        finally:
+            conn.close()
+
+
+# ---------------------------------------------------
+# SCENARI
+# ---------------------------------------------------
+def chat_user(client, user, turns, samples):
+    conv_id = None
+    for turn in range(turns):
+        question = f"{QUESTIONS[(user + turn) % len(QUESTIONS)]} (utente {user}, turno {turn})"
+        t0 = time.perf_counter()
+        status, data = client.post_json("/send", {"conv_id": conv_id, "message": question})
+        samples.add("send_s", time.perf_counter() - t0)
+        if status != 200:
+            samples.add("errors", 1)
+            continue
+        conv_id = data["conv_id"]
+
+        t_start = time.perf_counter()
+        status, data = client.post_json("/start_stream", {"conv_id": conv_id})
+        samples.add("start_stream_s", time.perf_counter() - t_start)
+        if status == 429:
+            samples.add("rejected", 1)
+            continue
+        if status != 200:
+            samples.add("errors", 1)
+            continue
+
+        first = None
+        tokens = 0
+        for event in client.events(f"/events/{conv_id}"):
+            if event["type"] == "token":
+                if first is None:
+                    first = time.perf_counter()
+                    samples.add("ttft_s", first - t_start)
+                tokens += 1
+            elif event["type"] == "error":
+                samples.add("errors", 1)
+                break
+            elif event["type"] == "done":
+                end = time.perf_counter()
+                samples.add("response_s", end - t_start)
+                samples.add("tokens", tokens)
+                if tokens > 1 and end > first:
+                    samples.add("tokens_per_second", (tokens - 1) / (end - first))
+                break
+
+
+def pdf_user(client, user, turns, samples, pages):
+    for turn in range(turns):
+        seed = user * 1000 + turn
+        if turn % 2:
+            filename, content = f"doc_{seed}.docx", make_docx(paragraphs=pages * 40, seed=seed)
+        else:
+            filename, content = f"doc_{seed}.pdf", make_pdf(pages=pages, seed=seed)
+        t0 = time.perf_counter()
+        status, data = client.post_file("/api/pdf/summary", filename, content)
+        samples.add(f"{filename.rsplit('.', 1)[1]}_summary_s", time.perf_counter() - t0)
+        if status != 200:
+            samples.add("errors", 1)
+
+
+def email_user(client, user, turns, samples, imap):
+    account = {"email": f"utente{user}@example.com", "password": "bench",
+               "server": imap.host, "port": imap.port}
+    t0 = time.perf_counter()
+    status, data = client.post_json("/api/email/connect", account)
+    samples.add("connect_s", time.perf_counter() - t0)
+    if status != 200:
+        samples.add("errors", 1)
+        return
+    session = {"session_token": data["session_token"]}
+    # Con una connessione dello stesso account nel pool una password sbagliata va comunque rifiutata
+    status, _ = client.post_json("/api/email/connect", {**account, "password": "wrong"})
+    if status != 401:
+        samples.add("errors", 1)
+    for turn in range(turns):
+        t0 = time.perf_counter()
+        status, data = client.post_json("/api/email/list", {**session, "limit": 20})
+        samples.add("list_s", time.perf_counter() - t0)
+        if status != 200:
+            samples.add("errors", 1)
+            continue
+        emails = data["emails"]
+        if not emails:
+            continue
+        email_id = emails[(user + turn) % len(emails)]["id"]
+        t0 = time.perf_counter()
+        status, _ = client.post_json("/api/email/read", {**session, "email_id": email_id})
+        samples.add("read_s", time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        status, _ = client.post_json("/api/email/summarize", {**session, "email_id": email_id})
+        samples.add("summarize_s", time.perf_counter() - t0)
+        if status != 200:
+            samples.add("errors", 1)
+        # Il messaggio è ora nella cache locale: senza la password giusta non si legge
+        status, _ = client.post_json("/api/email/read", {**account, "password": "wrong", "email_id": email_id})
+        if status != 401:
+            samples.add("errors", 1)
+    client.post_json("/api/email/logout", session)
+
+
+def run_users(target, users, *args):
+    threads = [threading.Thread(target=target, args=(user, *args), daemon=True) for user in range(users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def run_scenario(name, env, args):
+    client, samples, store_samples = env["client"], Samples(), env["store_samples"]
+    store_samples.take()
+    gc.collect()
+    rss_before = rss_mb()
+    imap_commands = env["imap"].commands
+    t0 = time.perf_counter()
+
+    if name == "chat":
+        run_users(lambda u: chat_user(client, u, args.turns, samples), args.users)
+    elif name == "pdf":
+        run_users(lambda u: pdf_user(client, u, args.turns, samples, args.pdf_pages), args.users)
+    elif name == "email":
+        run_users(lambda u: email_user(client, u, args.turns, samples, env["imap"]), args.users)
+
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    rss_after = rss_mb()
+    values = samples.take()
+    result = {
+        "users": args.users,
+        "turns": args.turns,
+        "elapsed_s": round(elapsed, 3),
+        "errors": len(values.pop("errors", [])),
+        "rejected": len(values.pop("rejected", [])),
+        "memory": {"rss_before_mb": round(rss_before, 1), "rss_after_mb": round(rss_after, 1),
+                   "growth_mb": round(rss_after - rss_before, 1)},
+    }
+    tokens = values.pop("tokens", [])
+    if tokens:
+        result["tokens_total"] = sum(tokens)
+        result["throughput_tokens_per_second"] = round(sum(tokens) / elapsed, 2)
+    for key, vals in sorted(values.items()):
+        if key.endswith("_s"):
+            result[key[:-2] + "_ms"] = summarize(vals, scale=1000, digits=2)
+        else:
+            result[key] = summarize(vals, digits=2)
+    writes = store_samples.take()
+    result["store_ms"] = {op: summarize(vals, scale=1000, digits=3) for op, vals in sorted(writes.items())}
+    if name == "email":
+        result["imap_commands"] = env["imap"].commands - imap_commands
+    return result
+
+
+# ---------------------------------------------------
+# AVVIO DELL'APP
+# ---------------------------------------------------
+def start_app(args, workdir):
+    """Importa app.py con modello finto e percorsi temporanei; restituisce l'ambiente"""
+    os.environ.update({
+        "CONV_DB": os.path.join(workdir, "conversations.db"),
+        "DOC_CACHE_PATH": os.path.join(workdir, "cache", "documents.db"),
+        "RETRIEVAL_DIR": os.path.join(workdir, "cache", "retrieval"),
+        "EMAIL_CACHE_PATH": os.path.join(workdir, "cache", "email.db"),
+        "KV_CACHE_RAM_MB": "0",
+        "MODEL_PRELOAD": "1",
+        "IMAP_ALLOW_CUSTOM_SERVER": "1",
+        "IMAP_MAX_CONNECTIONS": str(max(32, args.users * 2)),
+        "SCHEDULER_MAX_QUEUE": str(args.max_queue),
+        "RESPONSE_CACHE_SIZE": str(args.response_cache),
+        "MODEL_CONFIG": os.path.join(workdir, "models", "models.json"),
+    })
+    # MODELS_DIR e conversations.json sono relativi alla cartella corrente
+    os.makedirs(os.path.join(workdir, "models"), exist_ok=True)
+    open(os.path.join(workdir, "models", "Phi-3-mini-4k-instruct-q4.gguf"), "wb").close()
+    os.chdir(workdir)
+
+    fake_llama.install(args.tokens_per_second, args.prompt_tokens_per_second)
+    t0 = time.perf_counter()
+    import app as chat_app
+    import_s = time.perf_counter() - t0
+    chat_app.CHAT_MAX_TOKENS = args.max_tokens
+
+    store_samples = Samples()
+    chat_app.store._metric = StoreRecorder(chat_app.store._metric, store_samples)
+
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, chat_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-http", daemon=True).start()
+    client = Client(server.server_port)
+
+    deadline = time.monotonic() + 60
+    while client.request("GET", "/readyz")[0] != 200:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Modello finto non pronto entro 60s")
+        time.sleep(0.05)
+
+    imap = FakeImapServer(messages=args.emails, latency=args.imap_latency).start()
+    return {"app": chat_app, "server": server, "client": client, "imap": imap,
+            "store_samples": store_samples, "import_s": import_s}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ---------------------------------------------------
+# CONFRONTO TRA ESECUZIONI
+# ---------------------------------------------------
+# Metriche dove un valore più alto è meglio; per tutte le altre (latenze, memoria) è peggio
+HIGHER_IS_BETTER = ("tokens_per_second", "throughput_tokens_per_second")
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, path)
+        elif isinstance(value, (int, float)) and key in ("p50", "p95", "p99", "growth_mb", "throughput_tokens_per_second"):
+            yield path, value
+
+
+def compare(current, baseline, threshold):
+    """Metriche peggiorate oltre `threshold` (frazione) rispetto al baseline"""
+    old = dict(_flatten(baseline.get("scenarios", {})))
+    rows = []
+    for path, value in _flatten(current.get("scenarios", {})):
+        before = old.get(path)
+        if before is None:
+            continue
+        higher_better = any(name in path for name in HIGHER_IS_BETTER)
+        if path.endswith("growth_mb"):
+            # Crescita della memoria: conta la differenza assoluta, non il rapporto
+            regressed = value - before > max(1.0, abs(before) * threshold)
+            change = None
+        else:
+            change = (value - before) / before if before else 0.0
+            regressed = (change < -threshold) if higher_better else (change > threshold)
+        rows.append({"metric": path, "baseline": before, "current": value,
+                     "change": None if change is None else round(change, 3), "regression": regressed})
+    return rows
+
+
+def print_results(results):
+    for name, r in results["scenarios"].items():
+        print(f"\n== {name}: {r['users']} utenti x {r['turns']} turni in {r['elapsed_s']}s "
+              f"(errori {r['errors']}, rifiutate {r['rejected']})")
+        for key, value in r.items():
+            if isinstance(value, dict) and "p50" in value:
+                print(f"  {key:<28} p50 {value['p50']:>9}  p95 {value['p95']:>9}  p99 {value['p99']:>9}  (n={value['n']})")
+        for op, value in r.get("store_ms", {}).items():
+            if value.get("n"):
+                print(f"  store.{op + '_ms':<22} p50 {value['p50']:>9}  p95 {value['p95']:>9}  p99 {value['p99']:>9}  (n={value['n']})")
+        if "throughput_tokens_per_second" in r:
+            print(f"  token totali {r['tokens_total']}, {r['throughput_tokens_per_second']} token/s complessivi")
+        if "imap_commands" in r:
+            print(f"  comandi IMAP {r['imap_commands']}")
+        m = r["memory"]
+        print(f"  RSS {m['rss_before_mb']} → {m['rss_after_mb']} MB ({m['growth_mb']:+} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="elenco separato da virgole")
+    parser.add_argument("--users", type=int, default=4, help="utenti simulati concorrenti")
+    parser.add_argument("--turns", type=int, default=3, help="richieste per utente e scenario")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="velocità di decode del modello finto")
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=2000,
+                        help="velocità di valutazione del prompt del modello finto")
+    parser.add_argument("--max-tokens", type=int, default=32, help="token per risposta di chat")
+    parser.add_argument("--max-queue", type=int, default=64, help="SCHEDULER_MAX_QUEUE")
+    parser.add_argument("--response-cache", type=int, default=0, help="RESPONSE_CACHE_SIZE (0 = disattivata)")
+    parser.add_argument("--pdf-pages", type=int, default=8)
+    parser.add_argument("--emails", type=int, default=200, help="messaggi nella INBOX finta")
+    parser.add_argument("--imap-latency", type=float, default=0.01, help="secondi per comando IMAP")
+    parser.add_argument("--output", help="salva i risultati in JSON")
+    parser.add_argument("--compare", help="JSON di un'esecuzione precedente")
+    parser.add_argument("--threshold", type=float, default=0.15, help="peggioramento tollerato (frazione)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit code 1 se ci sono regressioni")
+    parser.add_argument("--keep-workdir", action="store_true")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"scenari sconosciuti: {', '.join(sorted(unknown))}")
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    workdir = tempfile.mkdtemp(prefix="llamachat-bench-")
+    cwd = os.getcwd()
+    try:
+        env = start_app(args, workdir)
+        results = {
+            "meta": {
+                "commit": git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+                "app_import_s": round(env["import_s"], 3),
+            },
+            "scenarios": {},
+        }
+        for name in scenarios:
+            print(f"▶ {name}...", flush=True)
+            results["scenarios"][name] = run_scenario(name, env, args)
+        env["server"].shutdown()
+        env["imap"].stop()
+    finally:
+        os.chdir(cwd)
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    regressions = []
+    if baseline is not None:
+        rows = compare(results, baseline, args.threshold)
+        results["comparison"] = {"baseline_commit": baseline.get("meta", {}).get("commit"), "metrics": rows}
+        regressions = [r for r in rows if r["regression"]]
+        print(f"\nConfronto con {args.compare} ({baseline.get('meta', {}).get('commit')}): "
+              f"{len(regressions)} regressioni su {len(rows)} metriche")
+        for r in regressions:
+            change = f"{r['change']:+.0%}" if r["change"] is not None else f"{r['current'] - r['baseline']:+.1f}"
+            print(f"  ✗ {r['metric']}: {r['baseline']} → {r['current']} ({change})")
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nRisultati salvati in {output}")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
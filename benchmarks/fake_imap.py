@@ -0,0 +1,189 @@
+"""Server IMAP locale per benchmark: una INBOX generata, senza TLS.
+
+Implementa solo i comandi usati da email_reader e imap_pool (LOGIN, SELECT,
+UID SEARCH, UID FETCH di header, BODYSTRUCTURE e parti parziali, NOOP,
+LOGOUT). Accetta qualunque password tranne "wrong". Un ritardo per comando
+(`latency`) simula il round-trip verso un server remoto.
+
+    server = FakeImapServer(messages=200, latency=0.02).start()
+    # email_reader con IMAP_ALLOW_CUSTOM_SERVER=1, server="127.0.0.1", port=server.port
+"""
+import re
+import time
+import threading
+import socketserver
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+SENTENCES = (
+    "La migrazione del database è prevista per venerdì sera.",
+    "Il server di build ha esaurito lo spazio su disco durante la notte.",
+    "Allego il report delle prestazioni dell'ultimo rilascio.",
+    "Serve una revisione della pull request sul modulo di autenticazione.",
+    "La latenza dell'API è aumentata dopo l'aggiornamento del kernel.",
+    "Ricordo la riunione di pianificazione dello sprint di lunedì.",
+)
+
+_FETCH_SECTION_RE = re.compile(r"BODY\.PEEK\[([\d.]+)\](?:<(\d+)\.(\d+)>)?", re.I)
+_ARG_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+
+def make_mailbox(n, body_bytes=4096, large_every=10, attachment_every=5):
+    """Messaggi deterministici: uno ogni `large_every` ha un corpo 25 volte più grande"""
+    start = datetime(2024, 1, 1, 9, 0, tzinfo=timezone.utc)
+    messages = []
+    for uid in range(1, n + 1):
+        size = body_bytes * (25 if large_every and uid % large_every == 0 else 1)
+        text = ""
+        i = uid
+        while len(text) < size:
+            text += SENTENCES[i % len(SENTENCES)] + "\r\n"
+            i += 1
+        body = text.encode("utf-8")
+        header = (
+            f"Subject: Aggiornamento progetto #{uid}\r\n"
+            f"From: Team {uid % 7} <team{uid % 7}@example.com>\r\n"
+            f"To: bench@example.com\r\n"
+            f"Date: {format_datetime(start + timedelta(minutes=uid))}\r\n\r\n"
+        ).encode("utf-8")
+        lines = body.count(b"\n")
+        text_part = f'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "8BIT" {len(body)} {lines} NIL NIL NIL NIL)'
+        if attachment_every and uid % attachment_every == 0:
+            # Allegato dichiarato nel BODYSTRUCTURE ma mai scaricato dal client
+            attachment = ('("APPLICATION" "PDF" ("NAME" "report.pdf") NIL NIL "BASE64" 2800000 NIL '
+                          '("ATTACHMENT" ("FILENAME" "report.pdf")) NIL NIL)')
+            structure = f'({text_part}{attachment} "MIXED" ("BOUNDARY" "b{uid}") NIL NIL NIL)'
+        else:
+            structure = text_part
+        messages.append({"uid": uid, "header": header, "structure": structure, "sections": {"1": body}})
+    return messages
+
+
+def parse_uid_set(spec, max_uid):
+    uids = set()
+    for part in spec.split(","):
+        if ":" in part:
+            a, b = part.split(":", 1)
+            a = max_uid if a == "*" else int(a)
+            b = max_uid if b == "*" else int(b)
+            uids.update(range(min(a, b), max(a, b) + 1))
+        elif part:
+            uids.add(max_uid if part == "*" else int(part))
+    return uids
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode("utf-8"))
+
+    def handle(self):
+        server = self.server.owner
+        self.send("* OK [CAPABILITY IMAP4rev1] Fake IMAP pronto\r\n")
+        authenticated = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode("utf-8", errors="replace").rstrip("\r\n").split(" ", 2)
+            if len(parts) < 2:
+                continue
+            tag, command = parts[0], parts[1].upper()
+            rest = parts[2] if len(parts) > 2 else ""
+            server.commands += 1
+            if server.latency:
+                time.sleep(server.latency)
+
+            if command == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1\r\n")
+            elif command == "LOGIN":
+                args = [a or b for a, b in _ARG_RE.findall(rest)]
+                if len(args) < 2 or args[1] == "wrong":
+                    self.send(f"{tag} NO [AUTHENTICATIONFAILED] Credenziali non valide\r\n")
+                    continue
+                authenticated = True
+            elif command == "LOGOUT":
+                self.send(f"* BYE Arrivederci\r\n{tag} OK LOGOUT completed\r\n")
+                return
+            elif command == "NOOP":
+                pass
+            elif not authenticated:
+                self.send(f"{tag} BAD Autenticazione richiesta\r\n")
+                continue
+            elif command in ("SELECT", "EXAMINE"):
+                self.send(
+                    f"* {len(server.messages)} EXISTS\r\n* 0 RECENT\r\n"
+                    f"* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid\r\n"
+                    f"* OK [UIDNEXT {len(server.messages) + 1}] Predicted next UID\r\n"
+                )
+            elif command == "CLOSE":
+                pass
+            elif command == "UID":
+                self.uid_command(tag, rest, server)
+                continue
+            else:
+                self.send(f"{tag} BAD Comando non supportato\r\n")
+                continue
+            self.send(f"{tag} OK {command} completed\r\n")
+
+    def uid_command(self, tag, rest, server):
+        sub, _, args = rest.partition(" ")
+        sub = sub.upper()
+        max_uid = len(server.messages)
+        if sub == "SEARCH":
+            criteria = args.split()
+            uids = range(1, max_uid + 1)
+            if len(criteria) >= 2 and criteria[-2].upper() == "UID":
+                uids = sorted(u for u in parse_uid_set(criteria[-1], max_uid) if 1 <= u <= max_uid)
+            self.send("* SEARCH" + "".join(f" {u}" for u in uids) + "\r\n")
+        elif sub == "FETCH":
+            spec, _, items = args.partition(" ")
+            for uid in sorted(parse_uid_set(spec, max_uid)):
+                if 1 <= uid <= max_uid:
+                    self.send_fetch(server.messages[uid - 1], items)
+        else:
+            self.send(f"{tag} BAD UID {sub} non supportato\r\n")
+            return
+        self.send(f"{tag} OK UID {sub} completed\r\n")
+
+    def send_fetch(self, message, items):
+        out = [f"* {message['uid']} FETCH (UID {message['uid']}".encode()]
+        upper = items.upper()
+        if "HEADER.FIELDS" in upper:
+            header = message["header"]
+            out.append(f" BODY[HEADER.FIELDS (SUBJECT FROM TO DATE)] {{{len(header)}}}\r\n".encode() + header)
+        for section, offset, length in _FETCH_SECTION_RE.findall(items):
+            data = message["sections"].get(section, b"")
+            if offset:
+                data = data[int(offset):int(offset) + int(length)]
+                out.append(f" BODY[{section}]<{offset}> {{{len(data)}}}\r\n".encode() + data)
+            else:
+                out.append(f" BODY[{section}] {{{len(data)}}}\r\n".encode() + data)
+        if "BODYSTRUCTURE" in upper:
+            out.append(f" BODYSTRUCTURE {message['structure']}".encode())
+        out.append(b")\r\n")
+        self.send(b"".join(out))
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeImapServer:
+    def __init__(self, messages=200, latency=0.0, host="127.0.0.1", port=0, uidvalidity=1, **mailbox):
+        self.messages = make_mailbox(messages, **mailbox)
+        self.latency = latency
+        self.uidvalidity = uidvalidity
+        self.commands = 0
+        self._server = _Server((host, port), _Handler)
+        self._server.owner = self
+        self.host, self.port = self._server.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-imap", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
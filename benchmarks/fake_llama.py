@@ -0,0 +1,105 @@
+"""Modello finto al posto di llama_cpp.Llama per benchmark e test di carico.
+
+Deterministico: la risposta dipende solo dal prompt. Simula i due costi di
+llama.cpp con dei sleep: la valutazione del prompt (PROMPT_TOKENS_PER_SECOND)
+e il decode (TOKENS_PER_SECOND). Come il modello vero, elabora una richiesta
+alla volta. install() registra un modulo `llama_cpp` finto in sys.modules:
+va chiamato prima che l'app carichi il modello.
+"""
+import sys
+import time
+import types
+import zlib
+import threading
+
+# Velocità simulate (modificabili prima di avviare il carico)
+TOKENS_PER_SECOND = 20.0
+PROMPT_TOKENS_PER_SECOND = 400.0
+
+# Byte per token: circa quanto un tokenizer BPE su testo italiano/inglese
+BYTES_PER_TOKEN = 4
+
+WORDS = (
+    "il", "server", "usa", "una", "cache", "per", "ridurre", "la", "latenza", "delle",
+    "richieste", "e", "il", "database", "indicizza", "le", "tabelle", "con", "un", "albero",
+    "B", "mentre", "lo", "scheduler", "distribuisce", "i", "thread", "sulla", "CPU", "quando",
+    "la", "memoria", "è", "piena", "il", "kernel", "libera", "pagine", "dal", "disco",
+)
+
+
+class FakeLlama:
+    """Stessa interfaccia di llama_cpp.Llama usata dall'app (chiamata, tokenize, ...)"""
+
+    def __init__(self, model_path=None, verbose=False, **params):
+        self.model_path = model_path
+        self.params = params
+        self.calls = 0
+        self.cache = None
+        self._lock = threading.Lock()
+
+    # ---------------------------------------------------
+    # TOKENIZER
+    # ---------------------------------------------------
+    def tokenize(self, text, add_bos=True, special=False):
+        # Reversibile: ogni token è un blocco di byte preceduto da 0x01
+        tokens = [int.from_bytes(b"\x01" + text[i:i + BYTES_PER_TOKEN], "big")
+                  for i in range(0, len(text), BYTES_PER_TOKEN)]
+        return ([1] if add_bos else []) + tokens
+
+    def detokenize(self, tokens):
+        out = bytearray()
+        for token in tokens:
+            if token > 1:
+                out += token.to_bytes((token.bit_length() + 7) // 8, "big")[1:]
+        return bytes(out)
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def close(self):
+        pass
+
+    # ---------------------------------------------------
+    # GENERAZIONE
+    # ---------------------------------------------------
+    def __call__(self, prompt, max_tokens=16, stream=False, **params):
+        if stream:
+            return self._stream(prompt, max_tokens)
+        text = "".join(self._stream_text(prompt, max_tokens))
+        n_prompt = len(self.tokenize(prompt.encode("utf-8")))
+        n_out = len(self._words(prompt, max_tokens))
+        return {
+            "choices": [{"text": text, "index": 0, "finish_reason": "length"}],
+            "usage": {"prompt_tokens": n_prompt, "completion_tokens": n_out,
+                      "total_tokens": n_prompt + n_out},
+        }
+
+    def _words(self, prompt, max_tokens):
+        seed = zlib.crc32(prompt.encode("utf-8"))
+        return [WORDS[(seed + i * 7) % len(WORDS)] for i in range(max(0, max_tokens or 16))]
+
+    def _stream_text(self, prompt, max_tokens):
+        with self._lock:
+            self.calls += 1
+            n_prompt = len(self.tokenize(prompt.encode("utf-8")))
+            time.sleep(n_prompt / PROMPT_TOKENS_PER_SECOND)
+            for word in self._words(prompt, max_tokens):
+                time.sleep(1 / TOKENS_PER_SECOND)
+                yield " " + word
+
+    def _stream(self, prompt, max_tokens):
+        for text in self._stream_text(prompt, max_tokens):
+            yield {"choices": [{"text": text, "index": 0, "finish_reason": None}]}
+
+
+def install(tokens_per_second=None, prompt_tokens_per_second=None):
+    """Sostituisce llama_cpp con questo modulo (anche se llama_cpp è installato)"""
+    global TOKENS_PER_SECOND, PROMPT_TOKENS_PER_SECOND
+    if tokens_per_second:
+        TOKENS_PER_SECOND = float(tokens_per_second)
+    if prompt_tokens_per_second:
+        PROMPT_TOKENS_PER_SECOND = float(prompt_tokens_per_second)
+    module = types.ModuleType("llama_cpp")
+    module.Llama = FakeLlama
+    sys.modules["llama_cpp"] = module
+    return module
@@ -0,0 +1,97 @@
+"""Documenti di prova generati al volo (PDF e DOCX), deterministici.
+
+Non servono librerie: il PDF ha un flusso di testo per pagina con il font
+standard Helvetica, il DOCX contiene solo word/document.xml con i paragrafi.
+"""
+import io
+import zipfile
+from xml.sax.saxutils import escape
+
+PARAGRAPHS = (
+    "Il sistema di cache riduce la latenza delle richieste ripetute al database.",
+    "Ogni nodo del cluster Kubernetes esegue un agente che raccoglie le metriche.",
+    "La pipeline di integrazione continua compila, testa e pubblica le immagini Docker.",
+    "Il protocollo TCP garantisce la consegna ordinata dei segmenti tra i due host.",
+    "Gli indici B-tree accelerano le query per intervallo sulle colonne ordinate.",
+    "Il garbage collector libera la memoria degli oggetti non più raggiungibili.",
+    "Le API REST espongono le risorse del servizio con metodi HTTP standard.",
+)
+
+
+def _paragraphs(n, offset=0):
+    return [PARAGRAPHS[(offset + i) % len(PARAGRAPHS)] for i in range(n)]
+
+
+def _pdf_text(text):
+    return text.encode("latin-1", errors="replace").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def make_pdf(pages=10, lines_per_page=40, seed=0):
+    """PDF con `pages` pagine di testo estraibile; `seed` cambia il contenuto"""
+    objects = []   # contenuto degli oggetti 1..n
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    pages_id = add(None)
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    kids = []
+    for p in range(pages):
+        lines = [b"BT /F1 10 Tf 50 800 Td 12 TL"]
+        lines.append(b"(" + _pdf_text(f"Documento {seed} - pagina {p + 1}") + b") Tj")
+        for text in _paragraphs(lines_per_page, offset=seed + p):
+            lines.append(b"T* (" + _pdf_text(text) + b") Tj")
+        lines.append(b"ET")
+        stream = b"\n".join(lines)
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        kids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (pages_id, font, content)
+        ))
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id
+    objects[pages_id - 1] = (b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % k for k in kids)
+                             + b"] /Count %d >>" % len(kids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % i + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+              % (len(objects) + 1, catalog, xref))
+    return out.getvalue()
+
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+</Types>"""
+
+RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+
+def make_docx(paragraphs=400, seed=0):
+    """DOCX con `paragraphs` paragrafi; `seed` cambia il contenuto"""
+    texts = [f"Documento {seed}"] + _paragraphs(paragraphs, offset=seed)
+    body = "".join(f"<w:p><w:r><w:t>{escape(text)}</w:t></w:r></w:p>" for text in texts)
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f"<w:body>{body}</w:body></w:document>")
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", CONTENT_TYPES)
+        z.writestr("_rels/.rels", RELS)
+        z.writestr("word/document.xml", document)
+    return out.getvalue()
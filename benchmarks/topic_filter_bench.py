@@ -0,0 +1,106 @@
+"""Microbenchmark e accuratezza del filtro degli argomenti.
+
+Confronta la vecchia ricerca per sottostringa con TopicFilter sul set di
+domande in benchmarks/data/topic_questions.tsv (italiano e inglese).
+
+    python benchmarks/topic_filter_bench.py [--keywords FILE] [--min-score N] [--iterations N]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from topic_filter import TopicFilter
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "topic_questions.tsv")
+
+# Lista e controllo usati prima del filtro compilato
+LEGACY_KEYWORDS = [
+    "software", "programmazione", "python", "javascript", "java", "c++", "c#", "rust",
+    "react", "next.js", "node", "backend", "frontend", "full stack", "database", "sql",
+    "mysql", "postgres", "mongodb", "server", "linux", "windows", "ubuntu",
+    "docker", "kubernetes", "devops", "ci/cd", "git", "github", "gitlab",
+    "network", "rete", "tcp", "udp", "http", "tls", "api",
+    "ai", "intelligenza artificiale", "llm", "machine learning",
+    "hardware", "cpu", "gpu", "ram", "ssd",
+]
+
+def legacy_is_allowed(text):
+    t = text.lower()
+    return any(kw in t for kw in LEGACY_KEYWORDS)
+
+def load_questions(path=DATA_FILE):
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            label, lang, text = line.rstrip("\n").split("\t", 2)
+            questions.append((label == "1", lang, text))
+    return questions
+
+def accuracy(check, questions):
+    result = {"errors": []}
+    for lang in sorted({q[1] for q in questions}) + ["all"]:
+        subset = [q for q in questions if lang == "all" or q[1] == lang]
+        tp = sum(1 for label, _, text in subset if label and check(text))
+        fp = sum(1 for label, _, text in subset if not label and check(text))
+        fn = sum(1 for label, _, text in subset if label and not check(text))
+        correct = sum(1 for label, _, text in subset if check(text) == label)
+        result[lang] = {
+            "accuracy": round(correct / len(subset), 3),
+            "precision": round(tp / (tp + fp), 3) if tp + fp else None,
+            "recall": round(tp / (tp + fn), 3) if tp + fn else None,
+            "n": len(subset),
+        }
+    result["errors"] = [text for label, _, text in questions if check(text) != label]
+    return result
+
+def timing(check, questions, iterations):
+    texts = [q[2] for q in questions]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for text in texts:
+            check(text)
+    elapsed = time.perf_counter() - start
+    return round(elapsed / (iterations * len(texts)) * 1e6, 3)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keywords", help="file di parole chiave (default: lista integrata)")
+    parser.add_argument("--min-score", type=float, default=1.0)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--data", default=DATA_FILE)
+    parser.add_argument("--json", action="store_true", help="stampa i risultati in JSON")
+    args = parser.parse_args()
+
+    questions = load_questions(args.data)
+    topic_filter = TopicFilter(args.keywords, min_score=args.min_score)
+    # Testo lungo: il filtro gira su tutto il messaggio dell'utente
+    long_text = " ".join(q[2] for q in questions) * 10
+
+    results = {}
+    for name, check in (("legacy", legacy_is_allowed), ("compiled", topic_filter.is_allowed)):
+        results[name] = {
+            "us_per_question": timing(check, questions, args.iterations),
+            "us_long_text": timing(check, [(True, "all", long_text)], max(1, args.iterations // 20)),
+            **accuracy(check, questions),
+        }
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    for name, r in results.items():
+        print(f"{name}: {r['us_per_question']} µs/domanda, {r['us_long_text']} µs/testo lungo")
+        for lang in ("it", "en", "all"):
+            m = r[lang]
+            print(f"  {lang}: accuratezza {m['accuracy']}  precisione {m['precision']}  richiamo {m['recall']}  (n={m['n']})")
+        for text in r["errors"]:
+            print(f"  ✗ {text}")
+
+if __name__ == "__main__":
+    main()
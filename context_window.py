@@ -0,0 +1,169 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from scheduler import PRIORITY_BATCH, SchedulerFullError
+
+# Token aggiuntivi per messaggio ("User: ", "\n", ...)
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_PROMPT = """Riassumi in italiano, in modo conciso e tecnico, la conversazione seguente.
+Conserva nomi, versioni, comandi e decisioni prese.
+
+{previous}{turns}
+
+Riassunto:"""
+
+
+class ContextManager:
+    """Finestra di contesto con budget di token e riassunto incrementale.
+
+    Tiene gli ultimi turni che stanno nel budget; i turni più vecchi vengono
+    ripiegati in un riassunto persistente, aggiornato in background solo quando
+    la finestra scorre (mai rigenerato da zero a ogni turno).
+    """
+
+    def __init__(self, llm, store, scheduler, budget_tokens, summary_max_tokens=256,
+                 fold_target=0.6, fold_trigger=0.85, cache_size=20000):
+        self.llm = llm
+        self.store = store
+        self.scheduler = scheduler
+        # Intero o funzione senza argomenti (budget che segue il contesto del modello corrente)
+        self.budget_tokens = budget_tokens
+        self.summary_max_tokens = summary_max_tokens
+        # Quando si ripiega, la finestra scende al 60% del budget: i turni
+        # successivi non ripiegano di nuovo e il prefisso del prompt resta stabile
+        self.fold_target = fold_target
+        # Il riassunto parte già all'85% del budget: i turni da ripiegare restano
+        # nella finestra finché il riassunto non li copre
+        self.fold_trigger = fold_trigger
+        self._counts = OrderedDict()
+        self._cache_size = cache_size
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    # ---------------------------------------------------
+    # CONTEGGIO TOKEN
+    # ---------------------------------------------------
+    def count_tokens(self, text):
+        """Token di un testo, con cache per contenuto"""
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                return self._counts[key]
+        n = len(self.llm.tokenize(text.encode("utf-8"), add_bos=False))
+        with self._lock:
+            self._counts[key] = n
+            while len(self._counts) > self._cache_size:
+                self._counts.popitem(last=False)
+        return n
+
+    def message_tokens(self, message):
+        return self.count_tokens(message["text"]) + MESSAGE_OVERHEAD
+
+    # ---------------------------------------------------
+    # FINESTRA
+    # ---------------------------------------------------
+    def budget(self):
+        return self.budget_tokens() if callable(self.budget_tokens) else self.budget_tokens
+
+    def select(self, conv_id, history, reserved_tokens=0):
+        """Restituisce (riassunto, messaggi_recenti) entro il budget.
+
+        `reserved_tokens` è lo spazio già occupato (system prompt).
+        """
+        summary, upto = self.store.get_summary(conv_id)
+        upto = min(upto, len(history))
+        budget = self.budget() - reserved_tokens
+        if summary:
+            budget -= self.count_tokens(summary) + MESSAGE_OVERHEAD
+
+        start = self._window_start(history, upto, budget)
+        if self._window_start(history, upto, int(budget * self.fold_trigger)) > upto:
+            # La finestra è quasi piena: si ripiega fino al fold_target
+            fold_end = max(start, self._window_start(history, upto, int(budget * self.fold_target)))
+            fold_end = min(fold_end, len(history) - 1)
+            self._schedule_fold(conv_id, history[upto:fold_end], summary, fold_end)
+
+        window = history[start:]
+        if window:
+            # Anche la sola domanda può superare il budget: si tiene inizio e fine
+            others = sum(self.message_tokens(m) for m in window[:-1])
+            window[-1] = self._truncate(window[-1], budget - others - MESSAGE_OVERHEAD)
+        return summary, window
+
+    def _window_start(self, history, upto, budget):
+        # Scorre dal fondo: l'ultimo messaggio (la domanda) è sempre incluso
+        used = 0
+        start = len(history)
+        for i in range(len(history) - 1, upto - 1, -1):
+            used += self.message_tokens(history[i])
+            if used > budget and i < len(history) - 1:
+                break
+            start = i
+        return start
+
+    def _truncate(self, message, max_tokens):
+        if self.message_tokens(message) - MESSAGE_OVERHEAD <= max_tokens:
+            return message
+        tokens = self.llm.tokenize(message["text"].encode("utf-8"), add_bos=False)
+        marker = "\n[...]\n"
+        keep = max(max_tokens - self.count_tokens(marker), 0)
+        n_tail = keep // 2
+        head, tail = tokens[:keep - n_tail], tokens[len(tokens) - n_tail:] if n_tail else []
+        text = (self.llm.detokenize(head).decode("utf-8", errors="ignore") + marker
+                + self.llm.detokenize(tail).decode("utf-8", errors="ignore"))
+        return dict(message, text=text)
+
+    # ---------------------------------------------------
+    # RIASSUNTO INCREMENTALE
+    # ---------------------------------------------------
+    def _schedule_fold(self, conv_id, turns, previous, new_upto):
+        if not turns:
+            return
+        with self._lock:
+            if conv_id in self._pending:
+                return
+            self._pending.add(conv_id)
+
+        def fold():
+            try:
+                text = self.summarize(previous, turns)
+                if text:
+                    self.store.set_summary(conv_id, text, new_upto)
+            finally:
+                with self._lock:
+                    self._pending.discard(conv_id)
+
+        def dropped(job, exc):
+            with self._lock:
+                self._pending.discard(conv_id)
+
+        try:
+            self.scheduler.submit(fold, priority=PRIORITY_BATCH, on_drop=dropped)
+        except SchedulerFullError:
+            # Si riprova al prossimo turno
+            with self._lock:
+                self._pending.discard(conv_id)
+
+    def summarize(self, previous, turns):
+        """Nuovo riassunto = riassunto precedente + turni ripiegati"""
+        lines = []
+        for m in turns:
+            role = "User" if m["role"] == "user" else "Assistant"
+            lines.append(f"{role}: {m['text']}")
+        prev = f"Riassunto precedente:\n{previous}\n\nNuovi turni:\n" if previous else ""
+        prompt = SUMMARY_PROMPT.format(previous=prev, turns="\n".join(lines))
+
+        # I turni ripiegati possono superare il contesto: si taglia la parte più vecchia
+        max_prompt = self.budget() - self.summary_max_tokens
+        tokens = self.llm.tokenize(prompt.encode("utf-8"))
+        if len(tokens) > max_prompt:
+            head = len(self.llm.tokenize(SUMMARY_PROMPT.split("{previous}")[0].encode("utf-8")))
+            tokens = tokens[:head] + tokens[len(tokens) - (max_prompt - head):]
+            prompt = self.llm.detokenize(tokens).decode("utf-8", errors="ignore")
+
+        out = self.llm(prompt, max_tokens=self.summary_max_tokens, temperature=0.3,
+                       stop=["\nUser:", "\nAssistant:"])
+        return out["choices"][0]["text"].strip()
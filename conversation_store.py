@@ -0,0 +1,410 @@
+import os
+import json
+import base64
+import sqlite3
+import threading
+import time
+
+# ---------------------------------------------------
+# BACKEND DI STORAGE DELLE CONVERSAZIONI
+# ---------------------------------------------------
+class BaseConversationStore:
+    """Interfaccia comune dei backend di storage"""
+
+    def create(self, conv_id, title):
+        raise NotImplementedError
+
+    def append(self, conv_id, role, text, ts=None):
+        raise NotImplementedError
+
+    def get(self, conv_id):
+        """Restituisce {"title", "messages"} oppure None"""
+        raise NotImplementedError
+
+    def load_all(self):
+        """Restituisce {conv_id: {"title", "messages"}} (costoso, solo per export)"""
+        raise NotImplementedError
+
+    def list_summaries(self, limit=None, cursor=None):
+        """Restituisce (items, next_cursor) ordinati per last_ts decrescente.
+
+        Ogni item è {"id", "title", "last_ts", "message_count"}.
+        """
+        raise NotImplementedError
+
+    def version(self):
+        """Contatore che cambia a ogni scrittura (usato per l'ETag della lista)"""
+        raise NotImplementedError
+
+    def get_summary(self, conv_id):
+        """Restituisce (riassunto, indice del primo messaggio non riassunto)"""
+        raise NotImplementedError
+
+    def set_summary(self, conv_id, summary, upto):
+        raise NotImplementedError
+
+    def is_empty(self):
+        raise NotImplementedError
+
+    def import_conversations(self, convs):
+        """Importa un dict in formato conversations.json (sostituisce le conversazioni con lo stesso id)"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonConversationStore(BaseConversationStore):
+    """Backend storico: un unico file JSON riscritto a ogni modifica"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({}, f)
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save(self, data):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    def create(self, conv_id, title):
+        with self._lock:
+            convs = self._load()
+            convs[conv_id] = {"title": title, "messages": []}
+            self._save(convs)
+
+    def append(self, conv_id, role, text, ts=None):
+        with self._lock:
+            convs = self._load()
+            if conv_id not in convs:
+                convs[conv_id] = {"title": "Chat", "messages": []}
+            convs[conv_id]["messages"].append({
+                "role": role,
+                "text": text,
+                "ts": ts or time.time()
+            })
+            self._save(convs)
+
+    def get(self, conv_id):
+        with self._lock:
+            return self._load().get(conv_id)
+
+    def load_all(self):
+        with self._lock:
+            return self._load()
+
+    def list_summaries(self, limit=None, cursor=None):
+        items = [
+            {
+                "id": k,
+                "title": v["title"],
+                "last_ts": v["messages"][-1]["ts"] if v["messages"] else 0,
+                "message_count": len(v["messages"]),
+            }
+            for k, v in self.load_all().items()
+        ]
+        items.sort(key=lambda x: (x["last_ts"], x["id"]), reverse=True)
+        if cursor:
+            after = decode_cursor(cursor)
+            items = [i for i in items if (i["last_ts"], i["id"]) < after]
+        return paginate(items, limit)
+
+    def version(self):
+        return os.stat(self.path).st_mtime_ns
+
+    def get_summary(self, conv_id):
+        conv = self.get(conv_id) or {}
+        return conv.get("summary", ""), conv.get("summary_upto", 0)
+
+    def set_summary(self, conv_id, summary, upto):
+        with self._lock:
+            convs = self._load()
+            if conv_id in convs:
+                convs[conv_id]["summary"] = summary
+                convs[conv_id]["summary_upto"] = upto
+                self._save(convs)
+
+    def is_empty(self):
+        return not self.load_all()
+
+    def import_conversations(self, convs):
+        with self._lock:
+            data = self._load()
+            for conv_id, conv in convs.items():
+                messages = conv.get("messages", [])
+                created = messages[0]["ts"] if messages else time.time()
+                data[conv_id] = {
+                    "title": conv.get("title", "Chat"),
+                    "messages": [{"role": m["role"], "text": m["text"], "ts": m.get("ts", created)}
+                                 for m in messages],
+                }
+            self._save(data)
+        return len(convs)
+
+
+class SQLiteConversationStore(BaseConversationStore):
+    """Backend SQLite in WAL: append O(1), letture concorrenti, scritture serializzate"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        created_ts REAL NOT NULL,
+        last_ts REAL NOT NULL DEFAULT 0,
+        message_count INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conv_id TEXT NOT NULL REFERENCES conversations(id),
+        role TEXT NOT NULL,
+        text TEXT NOT NULL,
+        ts REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_conv ON messages(conv_id, id);
+    CREATE TABLE IF NOT EXISTS summaries (
+        conv_id TEXT PRIMARY KEY REFERENCES conversations(id),
+        summary TEXT NOT NULL,
+        upto INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self._conn()
+        self._upgrade_schema(conn)
+        conn.executescript(self.SCHEMA)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_last ON conversations(last_ts DESC, id DESC)")
+        conn.commit()
+
+    def _upgrade_schema(self, conn):
+        # Database creati prima dell'indice riassuntivo: aggiunge le colonne e le ricalcola
+        cols = [r[1] for r in conn.execute("PRAGMA table_info(conversations)")]
+        if not cols or "last_ts" in cols:
+            return
+        with conn:
+            conn.execute("ALTER TABLE conversations ADD COLUMN last_ts REAL NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+            self._rebuild_index(conn)
+
+    def _rebuild_index(self, conn, conv_ids=None):
+        where = ""
+        params = ()
+        if conv_ids is not None:
+            where = f"WHERE id IN ({','.join('?' * len(conv_ids))})"
+            params = tuple(conv_ids)
+        conn.execute(f"""
+            UPDATE conversations SET
+                last_ts = COALESCE((SELECT MAX(ts) FROM messages WHERE conv_id = conversations.id), 0),
+                message_count = (SELECT COUNT(*) FROM messages WHERE conv_id = conversations.id)
+            {where}
+        """, params)
+
+    def _bump_version(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    def _conn(self):
+        # Una connessione per thread: sqlite3 non condivide le connessioni tra thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def create(self, conv_id, title):
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "INSERT INTO conversations (id, title, created_ts) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET title = excluded.title",
+                    (conv_id, title, time.time()),
+                )
+                self._bump_version(conn)
+
+    def append(self, conv_id, role, text, ts=None):
+        ts = ts or time.time()
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO conversations (id, title, created_ts) VALUES (?, ?, ?)",
+                    (conv_id, "Chat", ts),
+                )
+                conn.execute(
+                    "INSERT INTO messages (conv_id, role, text, ts) VALUES (?, ?, ?, ?)",
+                    (conv_id, role, text, ts),
+                )
+                # Indice riassuntivo aggiornato nella stessa transazione dell'append
+                conn.execute(
+                    "UPDATE conversations SET last_ts = MAX(last_ts, ?), message_count = message_count + 1 "
+                    "WHERE id = ?",
+                    (ts, conv_id),
+                )
+                self._bump_version(conn)
+
+    def get(self, conv_id):
+        conn = self._conn()
+        row = conn.execute("SELECT title FROM conversations WHERE id = ?", (conv_id,)).fetchone()
+        if row is None:
+            return None
+        rows = conn.execute(
+            "SELECT role, text, ts FROM messages WHERE conv_id = ? ORDER BY id", (conv_id,)
+        ).fetchall()
+        return {
+            "title": row[0],
+            "messages": [{"role": r, "text": t, "ts": ts} for r, t, ts in rows],
+        }
+
+    def load_all(self):
+        conn = self._conn()
+        convs = {
+            conv_id: {"title": title, "messages": []}
+            for conv_id, title in conn.execute("SELECT id, title FROM conversations ORDER BY created_ts")
+        }
+        for conv_id, role, text, ts in conn.execute(
+            "SELECT conv_id, role, text, ts FROM messages ORDER BY id"
+        ):
+            convs.setdefault(conv_id, {"title": "Chat", "messages": []})["messages"].append(
+                {"role": role, "text": text, "ts": ts}
+            )
+        return convs
+
+    def list_summaries(self, limit=None, cursor=None):
+        sql = "SELECT id, title, last_ts, message_count FROM conversations"
+        params = []
+        if cursor:
+            last_ts, conv_id = decode_cursor(cursor)
+            sql += " WHERE (last_ts < ? OR (last_ts = ? AND id < ?))"
+            params += [last_ts, last_ts, conv_id]
+        sql += " ORDER BY last_ts DESC, id DESC"
+        if limit:
+            # Un elemento in più per sapere se esiste una pagina successiva
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        items = [
+            {"id": i, "title": t, "last_ts": ts, "message_count": n}
+            for i, t, ts, n in self._conn().execute(sql, params)
+        ]
+        return paginate(items, limit)
+
+    def version(self):
+        return self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def get_summary(self, conv_id):
+        row = self._conn().execute(
+            "SELECT summary, upto FROM summaries WHERE conv_id = ?", (conv_id,)
+        ).fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    def set_summary(self, conv_id, summary, upto):
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "INSERT INTO summaries (conv_id, summary, upto) VALUES (?, ?, ?) "
+                    "ON CONFLICT(conv_id) DO UPDATE SET summary = excluded.summary, upto = excluded.upto",
+                    (conv_id, summary, upto),
+                )
+
+    def is_empty(self):
+        return self._conn().execute("SELECT 1 FROM conversations LIMIT 1").fetchone() is None
+
+    def import_conversations(self, convs):
+        """Importa un dict in formato conversations.json in un'unica transazione"""
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                for conv_id, conv in convs.items():
+                    messages = conv.get("messages", [])
+                    created = messages[0]["ts"] if messages else time.time()
+                    conn.execute(
+                        "INSERT INTO conversations (id, title, created_ts) VALUES (?, ?, ?) "
+                        "ON CONFLICT(id) DO UPDATE SET title = excluded.title",
+                        (conv_id, conv.get("title", "Chat"), created),
+                    )
+                    conn.execute("DELETE FROM messages WHERE conv_id = ?", (conv_id,))
+                    conn.executemany(
+                        "INSERT INTO messages (conv_id, role, text, ts) VALUES (?, ?, ?, ?)",
+                        [(conv_id, m["role"], m["text"], m.get("ts", created)) for m in messages],
+                    )
+                self._rebuild_index(conn, list(convs))
+                self._bump_version(conn)
+        return len(convs)
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# ---------------------------------------------------
+# PAGINAZIONE
+# ---------------------------------------------------
+def encode_cursor(item):
+    """Cursore opaco (last_ts, id) dell'ultimo elemento di una pagina"""
+    raw = json.dumps([item["last_ts"], item["id"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        last_ts, conv_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(last_ts), str(conv_id)
+    except Exception:
+        raise ValueError("Cursore non valido")
+
+def paginate(items, limit):
+    if not limit or len(items) <= limit:
+        return items, None
+    page = items[:limit]
+    return page, encode_cursor(page[-1])
+
+
+# ---------------------------------------------------
+# FACTORY E MIGRAZIONE
+# ---------------------------------------------------
+def open_store(backend, path):
+    """Crea il backend richiesto ("sqlite" o "json")"""
+    if backend == "json":
+        return JsonConversationStore(path)
+    if backend == "sqlite":
+        return SQLiteConversationStore(path)
+    raise ValueError(f"Backend conversazioni non supportato: {backend}")
+
+def migrate_json(json_path, store):
+    """Importa una volta sola conversations.json nello store (se lo store è vuoto)"""
+    if not os.path.exists(json_path) or not store.is_empty():
+        return 0
+    with open(json_path, "r", encoding="utf-8") as f:
+        convs = json.load(f)
+    if not convs:
+        return 0
+    count = store.import_conversations(convs)
+    print(f"✅ Migrate {count} conversazioni da {json_path}")
+    return count
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print("Uso: python conversation_store.py <conversations.json> <conversations.db>")
+        sys.exit(1)
+    migrate_json(sys.argv[1], SQLiteConversationStore(sys.argv[2]))
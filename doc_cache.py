@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+HASH_BLOCK = 1 << 20
+
+def hash_stream(file):
+    """SHA-256 del contenuto caricato, letto a blocchi; riporta il file all'inizio"""
+    h = hashlib.sha256()
+    stream = getattr(file, "stream", file)
+    stream.seek(0)
+    while True:
+        block = stream.read(HASH_BLOCK)
+        if not block:
+            break
+        h.update(block)
+    stream.seek(0)
+    return h.hexdigest()
+
+def params_key(*parts):
+    return hashlib.sha256("\0".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:16]
+
+
+class ContentCache:
+    """Cache su disco indicizzata per hash del contenuto, con budget in byte e LRU.
+
+    Un unico file SQLite con più namespace: testo estratto ("text"), riassunti
+    finali ("summary") e riassunti intermedi dei chunk ("chunk").
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        atime REAL NOT NULL,
+        PRIMARY KEY (namespace, key)
+    );
+    CREATE INDEX IF NOT EXISTS idx_entries_atime ON entries(atime);
+    """
+
+    def __init__(self, path, max_bytes=512 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._stats = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        conn.commit()
+        self._size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, namespace, outcome):
+        with self._write_lock:
+            ns = self._stats.setdefault(namespace, {"hits": 0, "misses": 0})
+            ns[outcome] += 1
+
+    def get(self, namespace, key):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None:
+            self._count(namespace, "misses")
+            return None
+        self._count(namespace, "hits")
+        with self._write_lock, conn:
+            conn.execute(
+                "UPDATE entries SET atime = ? WHERE namespace = ? AND key = ?",
+                (time.time(), namespace, key),
+            )
+        return json.loads(row[0])
+
+    def put(self, namespace, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        conn = self._conn()
+        with self._write_lock:
+            with conn:
+                old = conn.execute(
+                    "SELECT size FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+                ).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (namespace, key, value, size, atime) VALUES (?, ?, ?, ?, ?)",
+                    (namespace, key, data, size, time.time()),
+                )
+                self._size += size - (old[0] if old else 0)
+                self._evict(conn)
+
+    def _evict(self, conn):
+        # LRU: si eliminano le voci meno usate finché si rientra nel budget
+        while self._size > self.max_bytes:
+            rows = conn.execute(
+                "SELECT namespace, key, size FROM entries ORDER BY atime LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                break
+            for namespace, key, size in rows:
+                conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    break
+
+    def namespace(self, name):
+        return CacheNamespace(self, name)
+
+    def stats(self):
+        conn = self._conn()
+        entries = dict(conn.execute("SELECT namespace, COUNT(*) FROM entries GROUP BY namespace"))
+        return {
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "namespaces": {
+                ns: {"entries": entries.get(ns, 0), **self._stats.get(ns, {"hits": 0, "misses": 0})}
+                for ns in sorted(set(entries) | set(self._stats))
+            },
+        }
+
+
+class CacheNamespace:
+    """Vista get/put su un namespace (compatibile con SummaryCache)"""
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+
+    def get(self, key):
+        return self.cache.get(self.name, key)
+
+    def put(self, key, value):
+        self.cache.put(self.name, key, value)
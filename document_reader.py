@@ -1,20 +1,158 @@
-import pdfplumber
-import docx
+import os
+import time
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
 
-def extract_text_from_file(file):
-    filename = getattr(file, "filename", "file")
-    ext = filename.lower().split(".")[-1]
+from metrics import DOCUMENT_EXTRACT
+
+# Separatore tra le pagine di un PDF nel testo estratto
+PAGE_BREAK = "\f"
+
+# Limiti di estrazione
+MAX_PAGES = int(os.environ.get("EXTRACT_MAX_PAGES", 500))
+EXTRACT_TIMEOUT = float(os.environ.get("EXTRACT_TIMEOUT", 120))
+# Processi per l'estrazione parallela dei PDF grandi (0 = seriale)
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", 0))
+PARALLEL_MIN_PAGES = 16
+DOCX_PARAGRAPHS_PER_CHUNK = 50
+
+_pool = None
+
+class ExtractionTimeout(Exception):
+    """L'estrazione ha superato il tempo massimo"""
+
+class UnsupportedDocument(Exception):
+    """File in un formato non supportato o da cui non si riesce a estrarre il testo"""
+
+def _get_pool(workers):
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+def _extract_pdf_range(data, start, end):
+    """Eseguita nei processi worker: estrae le pagine [start, end)"""
+    import pdfplumber
+    with pdfplumber.open(BytesIO(data)) as pdf:
+        return [pdf.pages[i].extract_text() or "" for i in range(start, end)]
+
+def _check_deadline(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise ExtractionTimeout("Tempo massimo di estrazione superato")
+
+def iter_text_chunks(file, max_pages=MAX_PAGES, timeout=EXTRACT_TIMEOUT, workers=None):
+    """Estrae il testo un pezzo alla volta.
+
+    Produce dizionari {"page": n, "text": ...}: una pagina per i PDF, un gruppo
+    di paragrafi per DOCX e TXT (con "page" progressivo). Solleva
+    ExtractionTimeout se si supera `timeout` secondi e UnsupportedDocument se
+    il file non si può leggere.
+    """
+    ext = getattr(file, "filename", "file").lower().split(".")[-1]
+    chunks = _iter_chunks(file, ext, max_pages, timeout, workers)
+    # Si misura solo il tempo passato a estrarre, non quello di chi consuma i chunk
+    elapsed = 0.0
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            except (ExtractionTimeout, UnsupportedDocument):
+                raise
+            except Exception as e:
+                # Errori delle librerie di estrazione (PDF corrotto, DOCX non valido, testo non UTF-8)
+                raise UnsupportedDocument(f"Impossibile estrarre testo dal file: {e}") from e
+            finally:
+                elapsed += time.perf_counter() - t0
+            yield chunk
+    finally:
+        chunks.close()
+        DOCUMENT_EXTRACT.observe(elapsed, format=ext)
+
+def _iter_chunks(file, ext, max_pages, timeout, workers):
+    deadline = time.monotonic() + timeout if timeout else None
+    workers = EXTRACT_WORKERS if workers is None else workers
 
     if ext == "pdf":
-        with pdfplumber.open(file) as pdf:
-            return "\n".join(page.extract_text() or "" for page in pdf.pages)
-    
+        yield from _iter_pdf(file, max_pages, deadline, workers)
+        return
+
     if ext == "docx":
+        import docx
         doc = docx.Document(file)
-        return "\n".join(para.text for para in doc.paragraphs)
+        batch = []
+        n = 0
+        for para in doc.paragraphs:
+            batch.append(para.text)
+            if len(batch) >= DOCX_PARAGRAPHS_PER_CHUNK:
+                _check_deadline(deadline)
+                n += 1
+                yield {"page": n, "text": "\n".join(batch)}
+                batch = []
+        if batch:
+            yield {"page": n + 1, "text": "\n".join(batch)}
+        return
 
     if ext == "txt":
-        return file.read().decode("utf-8")
+        text = file.read().decode("utf-8")
+        for n, part in enumerate(text.split(PAGE_BREAK), 1):
+            yield {"page": n, "text": part}
+        return
+
+    raise UnsupportedDocument("Formato non supportato.")
+
+def _iter_pdf(file, max_pages, deadline, workers):
+    # Import al primo PDF: pdfplumber (e pdfminer) rallentano l'avvio
+    import pdfplumber
+    if workers and workers > 0:
+        data = file.read()
+        with pdfplumber.open(BytesIO(data)) as pdf:
+            n_pages = min(len(pdf.pages), max_pages or len(pdf.pages))
+        if n_pages >= PARALLEL_MIN_PAGES:
+            yield from _iter_pdf_parallel(data, n_pages, deadline, workers)
+            return
+        file = BytesIO(data)
+
+    with pdfplumber.open(file) as pdf:
+        for i, page in enumerate(pdf.pages):
+            if max_pages and i >= max_pages:
+                break
+            _check_deadline(deadline)
+            text = page.extract_text() or ""
+            # Libera gli oggetti di layout della pagina già letta
+            page.close()
+            yield {"page": i + 1, "text": text}
+
+def _iter_pdf_parallel(data, n_pages, deadline, workers):
+    pool = _get_pool(workers)
+    step = max(1, -(-n_pages // (workers * 4)))
+    futures = [
+        (start, pool.submit(_extract_pdf_range, data, start, min(start + step, n_pages)))
+        for start in range(0, n_pages, step)
+    ]
+    try:
+        # Si restituiscono i range in ordine, man mano che sono pronti
+        for start, future in futures:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                texts = future.result(timeout=remaining)
+            except FutureTimeout:
+                raise ExtractionTimeout("Tempo massimo di estrazione superato")
+            for offset, text in enumerate(texts):
+                yield {"page": start + offset + 1, "text": text}
+    finally:
+        for _, future in futures:
+            future.cancel()
+
+def extract_text_from_file(file):
+    chunks = iter_text_chunks(file)
+    ext = getattr(file, "filename", "file").lower().split(".")[-1]
 
-    return "Formato non supportato."
+    # Le pagine sono separate da PAGE_BREAK: il summarizer ne rispetta i confini
+    sep = "\n" if ext == "docx" else PAGE_BREAK
+    try:
+        return sep.join(c["text"] for c in chunks)
+    except UnsupportedDocument:
+        return "Formato non supportato."
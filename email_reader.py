@@ -1,9 +1,22 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response
+import os
+import json
+import threading
+from queue import Queue
 import imaplib
 import email
 from email.header import decode_header
+from email.parser import BytesFeedParser
 import re
-from datetime import datetime
+from contextlib import contextmanager
+from imap_utils import (
+    parse_fetch_response, find_section, has_attachments, uid_set,
+    walk_bodystructure, find_text_part, decoded_size,
+)
+from imap_pool import ImapConnectionPool, PoolExhaustedError, SessionStore
+from message_cache import MessageCache
+from scheduler import PRIORITY_BATCH, SchedulerFullError, SchedulerTimeoutError
+from metrics import span
 
 email_bp = Blueprint('email', __name__)
 
@@ -15,6 +28,62 @@ IMAP_SERVERS = {
     'icloud': 'imap.mail.me.com',
 }
 
+# Elementi richiesti per la lista: header essenziali e struttura (per gli allegati)
+LIST_FETCH_ITEMS = '(UID BODY.PEEK[HEADER.FIELDS (SUBJECT FROM TO DATE)] BODYSTRUCTURE)'
+
+# Lettura del corpo: si scarica solo la parte testuale, a segmenti, fino a un massimo
+BODY_SEGMENT_BYTES = int(os.environ.get("EMAIL_BODY_SEGMENT", 64 * 1024))
+BODY_MAX_BYTES = int(os.environ.get("EMAIL_BODY_MAX", 512 * 1024))
+
+# Pool di connessioni IMAP e sessioni lato server
+IMAP_MAX_PER_ACCOUNT = int(os.environ.get("IMAP_MAX_PER_ACCOUNT", 2))
+IMAP_MAX_CONNECTIONS = int(os.environ.get("IMAP_MAX_CONNECTIONS", 32))
+IMAP_IDLE_TIMEOUT = int(os.environ.get("IMAP_IDLE_TIMEOUT", 300))
+IMAP_KEEPALIVE = int(os.environ.get("IMAP_KEEPALIVE", 60))
+EMAIL_SESSION_TTL = int(os.environ.get("EMAIL_SESSION_TTL", 1800))
+# Consente server/porta IMAP arbitrari nella richiesta (es. server di test locale)
+ALLOW_CUSTOM_SERVER = os.environ.get("IMAP_ALLOW_CUSTOM_SERVER", "0") == "1"
+
+email_pool = ImapConnectionPool(
+    max_per_account=IMAP_MAX_PER_ACCOUNT,
+    max_total=IMAP_MAX_CONNECTIONS,
+    idle_timeout=IMAP_IDLE_TIMEOUT,
+    keepalive_interval=IMAP_KEEPALIVE,
+)
+sessions = SessionStore(ttl=EMAIL_SESSION_TTL)
+
+# Cache locale dei messaggi (header, corpo, allegati)
+EMAIL_CACHE_PATH = os.environ.get("EMAIL_CACHE_PATH", os.path.join(".cache", "email.db"))
+message_cache = MessageCache(EMAIL_CACHE_PATH)
+
+# Variabili globali per il modello (verranno impostate da app.py)
+llm_model = None
+llm_scheduler = None
+
+# Riassunti delle email
+EMAIL_SUMMARY_TOKENS = 200
+EMAIL_BODY_CHARS = 3000
+EMAIL_BATCH_MAX = 20
+EMAIL_QUEUE_TIMEOUT = 120
+
+EMAIL_PROMPT = """<|system|>
+Sei un assistente che crea riassunti chiari e concisi di email in italiano.
+<|end|>
+<|user|>
+Analizza questa email e fornisci un riassunto conciso in italiano:
+
+{text}
+<|end|>
+<|assistant|>
+Riassunto:"""
+
+EMAIL_GENERATION_PARAMS = {
+    "temperature": 0.5,
+    "top_p": 0.9,
+    "repeat_penalty": 1.1,
+    "stop": ["<|end|>", "\n\n\n"],
+}
+
 def clean_text(text):
     """Pulisce il testo rimuovendo caratteri speciali"""
     if text:
@@ -50,15 +119,13 @@ def get_email_body(msg):
             if "attachment" not in content_disposition:
                 if content_type == "text/plain":
                     try:
-                        body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                        body = part_text(part)
                         break
                     except:
                         pass
                 elif content_type == "text/html" and not body:
                     try:
-                        html_body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        # Rimuovi tag HTML basilari
-                        body = re.sub('<[^<]+?>', '', html_body)
+                        body = part_text(part)
                     except:
                         pass
     else:
@@ -69,131 +136,162 @@ def get_email_body(msg):
     
     return clean_text(body)
 
-def connect_imap(email_address, password, provider=None):
-    """Connette al server IMAP"""
+def part_text(part):
+    """Testo decodificato di una parte text/plain o text/html"""
+    payload = part.get_payload(decode=True) or b''
     try:
-        # Determina il server IMAP
-        if provider and provider in IMAP_SERVERS:
-            imap_server = IMAP_SERVERS[provider]
-        else:
-            # Prova a indovinare dal dominio
-            domain = email_address.split('@')[1].lower()
-            if 'gmail' in domain:
-                imap_server = IMAP_SERVERS['gmail']
-            elif 'outlook' in domain or 'hotmail' in domain:
-                imap_server = IMAP_SERVERS['outlook']
-            elif 'yahoo' in domain:
-                imap_server = IMAP_SERVERS['yahoo']
-            elif 'icloud' in domain or 'me.com' in domain:
-                imap_server = IMAP_SERVERS['icloud']
-            else:
-                return None, "Provider email non supportato"
-        
-        # Connetti
-        mail = imaplib.IMAP4_SSL(imap_server)
-        mail.login(email_address, password)
-        return mail, None
-        
+        text = payload.decode(part.get_content_charset() or 'utf-8', errors='ignore')
+    except LookupError:
+        text = payload.decode('utf-8', errors='ignore')
+    if part.get_content_type() == "text/html":
+        # Rimuovi tag HTML basilari
+        text = re.sub('<[^<]+?>', '', text)
+    return text
+
+def resolve_imap_server(email_address, provider=None, server=None, port=None):
+    """Determina (server, porta) IMAP; None se il provider non è supportato"""
+    if server:
+        return server, int(port or 993)
+    if provider and provider in IMAP_SERVERS:
+        return IMAP_SERVERS[provider], 993
+    # Prova a indovinare dal dominio
+    domain = email_address.split('@')[1].lower()
+    if 'gmail' in domain:
+        return IMAP_SERVERS['gmail'], 993
+    elif 'outlook' in domain or 'hotmail' in domain:
+        return IMAP_SERVERS['outlook'], 993
+    elif 'yahoo' in domain:
+        return IMAP_SERVERS['yahoo'], 993
+    elif 'icloud' in domain or 'me.com' in domain:
+        return IMAP_SERVERS['icloud'], 993
+    return None
+
+def get_account(data):
+    """Account della richiesta: da session_token oppure da email/password.
+
+    Restituisce (account, errore, status_http). Con email/password il login
+    viene verificato sul server (o su una connessione del pool aperta con la
+    stessa password) prima di restituire l'account: la cache locale dei
+    messaggi si legge solo per account autenticati.
+    """
+    token = data.get('session_token')
+    if token:
+        account = sessions.get(token)
+        if account is None:
+            return None, 'Sessione scaduta, effettua di nuovo l\'accesso', 401
+        return account, None, None
+    
+    email_address = data.get('email')
+    password = data.get('password')
+    if not email_address or not password:
+        return None, 'Credenziali mancanti', 400
+    
+    # Server personalizzato (es. stand-in IMAP locale) solo se abilitato
+    custom = data.get('server') if ALLOW_CUSTOM_SERVER else None
+    resolved = resolve_imap_server(email_address, data.get('provider'), custom, data.get('port'))
+    if resolved is None:
+        return None, 'Provider email non supportato', 401
+    server, port = resolved
+    account = {'email': email_address, 'password': password, 'server': server, 'port': port}
+    try:
+        with open_mailbox(account):
+            pass
+    except ImapConnectError as e:
+        return None, str(e), 401
+    except PoolExhaustedError as e:
+        return None, str(e), 503
+    except Exception as e:
+        return None, f'Errore di connessione: {str(e)}', 500
+    return account, None, None
+
+class ImapConnectError(Exception):
+    """Login o connessione IMAP fallita"""
+
+def account_key(account):
+    """Chiave dell'account per la cache (senza password)"""
+    return f"{account['email']}@{account['server']}:{account['port']}"
+
+@contextmanager
+def open_mailbox(account):
+    """Connessione dal pool con INBOX selezionata (box.conn, box.uidvalidity)"""
+    try:
+        pooled = email_pool.acquire(account['server'], account['port'],
+                                    account['email'], account['password'])
+    except PoolExhaustedError:
+        raise
     except imaplib.IMAP4.error as e:
-        return None, f"Errore di autenticazione: {str(e)}"
+        raise ImapConnectError(f"Errore di autenticazione: {str(e)}")
     except Exception as e:
-        return None, f"Errore di connessione: {str(e)}"
+        raise ImapConnectError(f"Errore di connessione: {str(e)}")
+    
+    ok = False
+    try:
+        email_pool.select(pooled, 'INBOX')
+        yield pooled
+        ok = True
+    finally:
+        email_pool.release(pooled, ok)
 
 @email_bp.route('/email/connect', methods=['POST'])
 def test_connection():
-    """Testa la connessione email"""
-    data = request.json
-    email_address = data.get('email')
-    password = data.get('password')
-    provider = data.get('provider')
+    """Testa la connessione email e apre una sessione lato server"""
+    data = request.json or {}
     
-    if not email_address or not password:
+    if not data.get('session_token') and (not data.get('email') or not data.get('password')):
         return jsonify({'error': 'Email e password richiesti'}), 400
     
-    mail, error = connect_imap(email_address, password, provider)
-    
+    account, error, status = get_account(data)
     if error:
-        return jsonify({'error': error}), 401
+        return jsonify({'error': error}), status
     
     try:
-        mail.select('INBOX')
-        status, messages = mail.search(None, 'ALL')
-        num_emails = len(messages[0].split())
-        mail.close()
-        mail.logout()
+        with open_mailbox(account) as box:
+            status, messages = box.conn.uid('SEARCH', None, 'ALL')
+            num_emails = len(messages[0].split())
+        
+        # Le richieste successive usano il token invece della password
+        token = data.get('session_token') or sessions.create(account)
         
         return jsonify({
             'success': True,
             'message': 'Connessione riuscita',
-            'total_emails': num_emails
+            'total_emails': num_emails,
+            'session_token': token
         }), 200
+    except ImapConnectError as e:
+        return jsonify({'error': str(e)}), 401
+    except PoolExhaustedError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': f'Errore lettura inbox: {str(e)}'}), 500
 
+@email_bp.route('/email/logout', methods=['POST'])
+def logout_email():
+    """Chiude la sessione e le connessioni inattive dell'account"""
+    data = request.json or {}
+    account = sessions.delete(data.get('session_token'))
+    if account:
+        email_pool.close_account(account['server'], account['port'], account['email'])
+    return jsonify({'success': True}), 200
+
+@email_bp.route('/email/stats', methods=['GET'])
+def email_stats():
+    """Stato del pool di connessioni IMAP e della cache dei messaggi"""
+    return jsonify({'pool': email_pool.stats(), 'cache': message_cache.stats()}), 200
+
 @email_bp.route('/email/list', methods=['POST'])
 def list_emails():
     """Lista le email recenti"""
-    data = request.json
-    email_address = data.get('email')
-    password = data.get('password')
-    provider = data.get('provider')
+    data = request.json or {}
     limit = data.get('limit', 10)  # Numero di email da recuperare
     
-    if not email_address or not password:
-        return jsonify({'error': 'Credenziali mancanti'}), 400
-    
-    mail, error = connect_imap(email_address, password, provider)
-    
+    account, error, status = get_account(data)
     if error:
-        return jsonify({'error': error}), 401
+        return jsonify({'error': error}), status
     
     try:
-        mail.select('INBOX')
-        
-        # Cerca tutte le email
-        status, messages = mail.search(None, 'ALL')
-        email_ids = messages[0].split()
-        
-        # Prendi le ultime N email
-        email_ids = email_ids[-limit:]
-        email_ids.reverse()  # Più recenti prima
-        
-        emails_list = []
-        
-        for email_id in email_ids:
-            try:
-                status, msg_data = mail.fetch(email_id, '(RFC822)')
-                
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        
-                        # Estrai informazioni
-                        subject = decode_mime_words(msg.get('Subject', 'Senza oggetto'))
-                        from_addr = decode_mime_words(msg.get('From', ''))
-                        date_str = msg.get('Date', '')
-                        
-                        # Parse data
-                        try:
-                            date_obj = email.utils.parsedate_to_datetime(date_str)
-                            date_formatted = date_obj.strftime('%d/%m/%Y %H:%M')
-                        except:
-                            date_formatted = date_str
-                        
-                        emails_list.append({
-                            'id': email_id.decode(),
-                            'subject': subject,
-                            'from': from_addr,
-                            'date': date_formatted,
-                            'has_attachments': any(part.get_content_disposition() == 'attachment' 
-                                                   for part in msg.walk())
-                        })
-            except Exception as e:
-                print(f"Errore parsing email {email_id}: {e}")
-                continue
-        
-        mail.close()
-        mail.logout()
+        with span("imap_sync"), open_mailbox(account) as box:
+            emails_list = sync_mailbox(box, account_key(account), limit)
         
         return jsonify({
             'success': True,
@@ -201,136 +299,454 @@ def list_emails():
             'total': len(emails_list)
         }), 200
         
+    except ImapConnectError as e:
+        return jsonify({'error': str(e)}), 401
+    except PoolExhaustedError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': f'Errore recupero email: {str(e)}'}), 500
 
+def sync_mailbox(box, key, limit):
+    """Sincronizza la cache con il server e restituisce le ultime `limit` email.
+
+    Dopo la prima volta si cercano solo gli UID oltre l'ultimo visto; gli
+    header delle email già in cache non vengono più scaricati.
+    """
+    last_uid = message_cache.begin_sync(key, box.uidvalidity)
+    
+    if last_uid:
+        # UID n:* restituisce sempre almeno l'ultimo messaggio: si filtra
+        status, messages = box.conn.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+        new_uids = [u for u in messages[0].split() if int(u) > last_uid]
+        cached = {int(m['id']) for m in message_cache.list_messages(key, box.uidvalidity, limit)}
+        if cached:
+            # Messaggi cancellati sul server: SEARCH sul solo intervallo di UID in cache (risposta di soli numeri)
+            status, messages = box.conn.uid('SEARCH', None, f'UID {min(cached)}:{last_uid}')
+            on_server = {int(u) for u in messages[0].split()}
+            gone = cached - on_server
+            if gone:
+                message_cache.remove(key, box.uidvalidity, gone)
+                cached -= gone
+        if len(cached) < limit:
+            # Cache con meno email di quelle richieste: si recuperano le più vecchie
+            status, messages = box.conn.uid('SEARCH', None, 'ALL')
+            new_uids = [u for u in messages[0].split() if int(u) not in cached]
+    else:
+        status, messages = box.conn.uid('SEARCH', None, 'ALL')
+        new_uids = messages[0].split()
+    
+    # Prendi le ultime N email
+    new_uids = new_uids[-limit:]
+    if new_uids:
+        fetched = fetch_email_list(box.conn, new_uids)
+        message_cache.put_headers(key, box.uidvalidity, fetched)
+        message_cache.end_sync(key, box.uidvalidity, max(int(u) for u in new_uids))
+    
+    return [
+        {k: m[k] for k in ('id', 'subject', 'from', 'date', 'has_attachments')}
+        for m in message_cache.list_messages(key, box.uidvalidity, limit)
+    ]
+
+def fetch_email_list(mail, uids):
+    """Header e allegati delle email indicate, con un solo FETCH"""
+    # Un solo FETCH per tutte le email: solo header e struttura, niente corpo
+    status, msg_data = mail.uid('FETCH', uid_set(uids), LIST_FETCH_ITEMS)
+    
+    emails_list = []
+    
+    for item in parse_fetch_response(msg_data):
+        try:
+            headers = email.message_from_bytes(find_section(item, 'BODY[HEADER') or b'')
+            
+            # Estrai informazioni
+            subject = decode_mime_words(headers.get('Subject', 'Senza oggetto'))
+            from_addr = decode_mime_words(headers.get('From', ''))
+            to_addr = decode_mime_words(headers.get('To', ''))
+            
+            emails_list.append({
+                'id': str(item['UID']),
+                'subject': subject,
+                'from': from_addr,
+                'to': to_addr,
+                'date': format_date(headers.get('Date', '')),
+                'has_attachments': has_attachments(item.get('BODYSTRUCTURE'))
+            })
+        except Exception as e:
+            print(f"Errore parsing email {item.get('UID')}: {e}")
+            continue
+    
+    return emails_list
+
+def format_date(date_str):
+    try:
+        date_obj = email.utils.parsedate_to_datetime(date_str)
+        return date_obj.strftime('%d/%m/%Y %H:%M')
+    except:
+        return date_str
+
+def fetch_messages(mail, email_ids):
+    """Header, corpo e allegati per UID senza scaricare il messaggio intero.
+
+    Un FETCH di header e BODYSTRUCTURE per tutti i messaggi, poi solo la parte
+    text/plain (o text/html) a segmenti di BODY_SEGMENT_BYTES, passati a un
+    BytesFeedParser; le dimensioni degli allegati vengono dal BODYSTRUCTURE.
+    La memoria usata è limitata da BODY_MAX_BYTES qualunque sia la dimensione
+    degli allegati. Restituisce {uid: messaggio}.
+    """
+    status, msg_data = mail.uid('FETCH', uid_set(email_ids), LIST_FETCH_ITEMS)
+    
+    messages = {}
+    text_parts = {}
+    for item in parse_fetch_response(msg_data):
+        if 'UID' not in item:
+            continue
+        email_id = str(item['UID'])
+        headers = email.message_from_bytes(find_section(item, 'BODY[HEADER') or b'')
+        parts = walk_bodystructure(item.get('BODYSTRUCTURE'))
+        
+        messages[email_id] = {
+            'id': email_id,
+            'subject': decode_mime_words(headers.get('Subject', 'Senza oggetto')),
+            'from': decode_mime_words(headers.get('From', '')),
+            'to': decode_mime_words(headers.get('To', '')),
+            'date': format_date(headers.get('Date', '')),
+            'body': '',
+            'attachments': [
+                {'filename': decode_mime_words(p['filename']), 'size': decoded_size(p)}
+                for p in parts if p['disposition'] == 'attachment' and p['filename']
+            ]
+        }
+        part = find_text_part(parts)
+        if part:
+            text_parts[email_id] = part
+    
+    for email_id, text in fetch_text_parts(mail, text_parts).items():
+        messages[email_id]['body'] = text
+    return messages
+
+def fetch_text_parts(mail, text_parts):
+    """Scarica e decodifica le parti testuali indicate ({uid: parte BODYSTRUCTURE})"""
+    parsers = {}
+    offsets = {}
+    for email_id, part in text_parts.items():
+        # Intestazioni sintetiche della parte: il parser decodifica transfer-encoding e charset
+        parser = BytesFeedParser()
+        parser.feed(
+            f"Content-Type: {part['type']}/{part['subtype']}; "
+            f"charset=\"{part['params'].get('charset') or 'utf-8'}\"\r\n"
+            f"Content-Transfer-Encoding: {part['encoding']}\r\n\r\n".encode('ascii', errors='ignore')
+        )
+        parsers[email_id] = parser
+        offsets[email_id] = 0
+    
+    # Primo segmento: un FETCH per ogni sezione (di solito "1" o "1.1") per tutti i messaggi
+    by_section = {}
+    for email_id, part in text_parts.items():
+        by_section.setdefault(part['section'], []).append(email_id)
+    for section, ids in by_section.items():
+        feed_segments(mail, ids, section, 0, parsers, offsets)
+    
+    # Segmenti successivi solo per le parti più grandi di un segmento
+    for email_id, part in text_parts.items():
+        limit = min(part['size'] or 0, BODY_MAX_BYTES)
+        while 0 < offsets[email_id] < limit:
+            before = offsets[email_id]
+            feed_segments(mail, [email_id], part['section'], before, parsers, offsets)
+            if offsets[email_id] == before:
+                break
+    
+    texts = {}
+    for email_id, parser in parsers.items():
+        try:
+            texts[email_id] = clean_text(part_text(parser.close()))
+        except Exception as e:
+            print(f"Errore decodifica corpo email {email_id}: {e}")
+            texts[email_id] = ''
+    return texts
+
+def feed_segments(mail, email_ids, section, offset, parsers, offsets):
+    status, msg_data = mail.uid(
+        'FETCH', uid_set(email_ids), f'(UID BODY.PEEK[{section}]<{offset}.{BODY_SEGMENT_BYTES}>)'
+    )
+    for item in parse_fetch_response(msg_data):
+        email_id = str(item.get('UID'))
+        data = find_section(item, f'BODY[{section}]')
+        if email_id in parsers and isinstance(data, bytes):
+            parsers[email_id].feed(data)
+            offsets[email_id] += len(data)
+
+def load_messages(account, email_ids):
+    """Messaggi completi: dalla cache locale se già letti, gli altri dal server.
+
+    Restituisce (uidvalidity, {uid: messaggio}); gli UID inesistenti mancano.
+    """
+    key = account_key(account)
+    email_ids = [str(e) for e in email_ids]
+    state = message_cache.mailbox_state(key)
+    messages = {}
+    if state:
+        for email_id in email_ids:
+            cached = message_cache.get_message(key, state[0], email_id)
+            if cached and cached['body'] is not None:
+                messages[email_id] = cached
+    
+    missing = [e for e in email_ids if e not in messages]
+    if state and not missing:
+        return state[0], messages
+    
+    with open_mailbox(account) as box:
+        uidvalidity = box.uidvalidity
+        if state and state[0] != uidvalidity:
+            # UIDVALIDITY cambiata: gli UID in cache non valgono più
+            messages = {}
+            missing = email_ids
+        fetched = fetch_messages(box.conn, missing) if missing else {}
+    
+    # Registra la mailbox (e la svuota se UIDVALIDITY è cambiata) prima di salvare
+    message_cache.begin_sync(key, uidvalidity)
+    # Messaggi cancellati sul server
+    message_cache.remove(key, uidvalidity, [e for e in missing if e not in fetched])
+    for email_id, message in fetched.items():
+        message_cache.put_message(key, uidvalidity, message)
+        messages[email_id] = message
+    return uidvalidity, messages
+
+def load_message(account, email_id):
+    """Un singolo messaggio completo (None se non esiste)"""
+    uidvalidity, messages = load_messages(account, [email_id])
+    return messages.get(str(email_id))
+
+# ---------------------------------------------------
+# RIASSUNTI CON LLAMA
+# ---------------------------------------------------
+def set_llm_model(model, scheduler=None):
+    """Imposta il modello LLaMA condiviso e lo scheduler che ne regola l'accesso"""
+    global llm_model, llm_scheduler
+    llm_model = model
+    llm_scheduler = scheduler
+
+def summary_params():
+    """Chiave dei parametri di generazione per la cache dei riassunti"""
+    model = os.path.basename(getattr(llm_model, "model_path", "") or "")
+    return f"{model}:{EMAIL_SUMMARY_TOKENS}:{EMAIL_BODY_CHARS}"
+
+def email_prompt(message):
+    email_text = f"Oggetto: {message['subject']}\nDa: {message['from']}\n\nContenuto:\n{message['body'][:EMAIL_BODY_CHARS]}"
+    return EMAIL_PROMPT.format(text=email_text)
+
+def generate_email_summary(message):
+    """Esegue il modello sul singolo messaggio (nel thread del worker)"""
+    output = llm_model(email_prompt(message), max_tokens=EMAIL_SUMMARY_TOKENS, **EMAIL_GENERATION_PARAMS)
+    summary = output["choices"][0]["text"].strip()
+    # Fallback se il riassunto è vuoto
+    if not summary:
+        summary = f"Email di {len(message['body'])} caratteri: {message['body'][:300]}..."
+    return summary
+
+def submit_summary(message, cancel_event=None, on_done=None):
+    """Accoda il riassunto di un messaggio con priorità batch; restituisce il job"""
+    def run():
+        summary = generate_email_summary(message)
+        if on_done:
+            on_done(message, summary)
+        return summary
+    return llm_scheduler.submit(run, priority=PRIORITY_BATCH, timeout=EMAIL_QUEUE_TIMEOUT,
+                                cancel_event=cancel_event)
+
+def summarize_message(account, uidvalidity, message):
+    """Riassunto di un messaggio, dalla cache per UID se già calcolato"""
+    if llm_model is None:
+        raise Exception("Modello LLaMA non inizializzato")
+    key = account_key(account)
+    params = summary_params()
+    summary = message_cache.get_summary(key, uidvalidity, message['id'], params)
+    if summary is not None:
+        return summary, True
+    if llm_scheduler is None:
+        summary = generate_email_summary(message)
+    else:
+        summary = submit_summary(message).wait()
+    message_cache.put_summary(key, uidvalidity, message['id'], params, summary)
+    return summary, False
+
 @email_bp.route('/email/read', methods=['POST'])
 def read_email():
     """Legge il contenuto completo di un'email"""
-    data = request.json
-    email_address = data.get('email')
-    password = data.get('password')
-    provider = data.get('provider')
+    data = request.json or {}
     email_id = data.get('email_id')
     
-    if not all([email_address, password, email_id]):
+    if not email_id:
         return jsonify({'error': 'Parametri mancanti'}), 400
     
-    mail, error = connect_imap(email_address, password, provider)
-    
+    account, error, status = get_account(data)
     if error:
-        return jsonify({'error': error}), 401
+        return jsonify({'error': error}), status
     
     try:
-        mail.select('INBOX')
+        with span("imap_fetch"):
+            message = load_message(account, email_id)
         
-        status, msg_data = mail.fetch(email_id, '(RFC822)')
+        if message is None:
+            return jsonify({'error': 'Email non trovata'}), 404
         
-        for response_part in msg_data:
-            if isinstance(response_part, tuple):
-                msg = email.message_from_bytes(response_part[1])
-                
-                # Estrai tutte le informazioni
-                subject = decode_mime_words(msg.get('Subject', 'Senza oggetto'))
-                from_addr = decode_mime_words(msg.get('From', ''))
-                to_addr = decode_mime_words(msg.get('To', ''))
-                date_str = msg.get('Date', '')
-                
-                try:
-                    date_obj = email.utils.parsedate_to_datetime(date_str)
-                    date_formatted = date_obj.strftime('%d/%m/%Y %H:%M')
-                except:
-                    date_formatted = date_str
-                
-                # Estrai corpo
-                body = get_email_body(msg)
-                
-                # Lista allegati
-                attachments = []
-                for part in msg.walk():
-                    if part.get_content_disposition() == 'attachment':
-                        filename = part.get_filename()
-                        if filename:
-                            attachments.append({
-                                'filename': decode_mime_words(filename),
-                                'size': len(part.get_payload(decode=True))
-                            })
-                
-                mail.close()
-                mail.logout()
-                
-                return jsonify({
-                    'success': True,
-                    'email': {
-                        'subject': subject,
-                        'from': from_addr,
-                        'to': to_addr,
-                        'date': date_formatted,
-                        'body': body[:5000],  # Limita a 5000 caratteri
-                        'body_length': len(body),
-                        'attachments': attachments
-                    }
-                }), 200
+        body = message['body']
         
-        return jsonify({'error': 'Email non trovata'}), 404
+        return jsonify({
+            'success': True,
+            'email': {
+                'subject': message['subject'],
+                'from': message['from'],
+                'to': message['to'],
+                'date': message['date'],
+                'body': body[:5000],  # Limita a 5000 caratteri
+                'body_length': len(body),
+                'attachments': message['attachments']
+            }
+        }), 200
         
+    except ImapConnectError as e:
+        return jsonify({'error': str(e)}), 401
+    except PoolExhaustedError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': f'Errore lettura email: {str(e)}'}), 500
 
 @email_bp.route('/email/summarize', methods=['POST'])
 def summarize_email():
     """Legge un'email e genera un riassunto con LLaMA"""
-    data = request.json
-    email_address = data.get('email')
-    password = data.get('password')
-    provider = data.get('provider')
+    data = request.json or {}
     email_id = data.get('email_id')
     
-    if not all([email_address, password, email_id]):
+    if not email_id:
         return jsonify({'error': 'Parametri mancanti'}), 400
     
-    # Prima leggi l'email
-    mail, error = connect_imap(email_address, password, provider)
-    
+    account, error, status = get_account(data)
     if error:
-        return jsonify({'error': error}), 401
+        return jsonify({'error': error}), status
     
     try:
-        mail.select('INBOX')
-        status, msg_data = mail.fetch(email_id, '(RFC822)')
+        # Prima leggi l'email (dalla cache se già letta)
+        with span("imap_fetch"):
+            uidvalidity, messages = load_messages(account, [email_id])
+        message = messages.get(str(email_id))
         
-        for response_part in msg_data:
-            if isinstance(response_part, tuple):
-                msg = email.message_from_bytes(response_part[1])
-                
-                subject = decode_mime_words(msg.get('Subject', ''))
-                from_addr = decode_mime_words(msg.get('From', ''))
-                body = get_email_body(msg)
-                
-                mail.close()
-                mail.logout()
-                
-                # Genera riassunto con LLaMA
-                # TODO: Integra qui il tuo modello LLaMA
-                email_text = f"Oggetto: {subject}\nDa: {from_addr}\n\nContenuto:\n{body[:3000]}"
-                
-                prompt = f"""Analizza questa email e fornisci un riassunto conciso in italiano:
-
-{email_text}
-
-Riassunto:"""
-                
-                # PLACEHOLDER - Sostituisci con il tuo modello
-                summary = "Riassunto dell'email generato da LLaMA. Integra qui il tuo modello."
-                
-                return jsonify({
-                    'success': True,
-                    'summary': summary,
-                    'subject': subject,
-                    'from': from_addr
-                }), 200
+        if message is None:
+            return jsonify({'error': 'Email non trovata'}), 404
+        
+        with span("summarize"):
+            summary, cached = summarize_message(account, uidvalidity, message)
         
-        return jsonify({'error': 'Email non trovata'}), 404
+        return jsonify({
+            'success': True,
+            'summary': summary,
+            'subject': message['subject'],
+            'from': message['from'],
+            'cached': cached
+        }), 200
         
+    except SchedulerFullError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': '10'}
+    except SchedulerTimeoutError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '10'}
+    except ImapConnectError as e:
+        return jsonify({'error': str(e)}), 401
+    except PoolExhaustedError as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': f'Errore: {str(e)}'}), 500
+
+@email_bp.route('/email/summarize/batch', methods=['POST'])
+def summarize_email_batch():
+    """Riassume più email in un solo job e invia i risultati via SSE appena pronti"""
+    data = request.json or {}
+    email_ids = [str(e) for e in (data.get('email_ids') or [])]
+    
+    if not email_ids:
+        return jsonify({'error': 'Parametri mancanti'}), 400
+    if len(email_ids) > EMAIL_BATCH_MAX:
+        return jsonify({'error': f'Massimo {EMAIL_BATCH_MAX} email per richiesta'}), 400
+    
+    account, error, status = get_account(data)
+    if error:
+        return jsonify({'error': error}), status
+    if llm_model is None:
+        return jsonify({'error': 'Modello LLaMA non inizializzato'}), 500
+    
+    events = Queue()
+    stop_event = threading.Event()
+    
+    def worker():
+        try:
+            # Corpi mancanti scaricati con un solo FETCH
+            uidvalidity, messages = load_messages(account, email_ids)
+            key = account_key(account)
+            params = summary_params()
+            
+            def done(message, summary):
+                message_cache.put_summary(key, uidvalidity, message['id'], params, summary)
+                events.put(summary_event(message, summary, False))
+            
+            pending = []
+            for email_id in email_ids:
+                message = messages.get(email_id)
+                if message is None:
+                    events.put({'type': 'error', 'id': email_id, 'text': 'Email non trovata'})
+                    continue
+                summary = message_cache.get_summary(key, uidvalidity, email_id, params)
+                if summary is not None:
+                    events.put(summary_event(message, summary, True))
+                elif llm_scheduler is None:
+                    done(message, generate_email_summary(message))
+                else:
+                    pending.append(message)
+            
+            # Tutti i prompt accodati insieme; ogni job invia il suo risultato appena finisce
+            jobs = []
+            for message in pending:
+                try:
+                    jobs.append((message, submit_summary(message, stop_event, done)))
+                except SchedulerFullError:
+                    if not jobs:
+                        raise
+                    # Coda batch piena: si attende il job più vecchio e si riprova
+                    wait_job(*jobs.pop(0), events)
+                    jobs.append((message, submit_summary(message, stop_event, done)))
+            for message, job in jobs:
+                wait_job(message, job, events)
+        except ImapConnectError as e:
+            events.put({'type': 'error', 'text': str(e)})
+        except Exception as e:
+            events.put({'type': 'error', 'text': str(e)})
+        finally:
+            events.put({'type': 'done'})
+    
+    threading.Thread(target=worker, daemon=True).start()
+    
+    def gen():
+        try:
+            while True:
+                item = events.get()
+                yield "data: " + json.dumps(item, ensure_ascii=False) + "\n\n"
+                if item['type'] == 'done':
+                    break
+        finally:
+            # Client disconnesso: i job ancora in coda vengono scartati
+            stop_event.set()
+    
+    return Response(gen(), mimetype='text/event-stream')
+
+def summary_event(message, summary, cached):
+    return {
+        'type': 'summary',
+        'id': message['id'],
+        'subject': message['subject'],
+        'from': message['from'],
+        'summary': summary,
+        'cached': cached
+    }
+
+def wait_job(message, job, events):
+    try:
+        job.wait()
     except Exception as e:
-        return jsonify({'error': f'Errore: {str(e)}'}), 500
\ No newline at end of file
+        events.put({'type': 'error', 'id': message['id'], 'text': str(e)})
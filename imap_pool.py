@@ -0,0 +1,284 @@
+import hmac
+import hashlib
+import imaplib
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import IMAP_COMMAND
+
+
+class PoolExhaustedError(Exception):
+    """Nessuna connessione libera entro il timeout"""
+
+
+class _PooledConnection:
+    def __init__(self, key, conn, secret):
+        self.key = key
+        self.conn = conn
+        self.secret = secret              # HMAC della password usata per il login
+        self.mailbox = None
+        self.readonly = None
+        self.uidvalidity = None
+        self.last_used = time.time()      # ultimo uso da parte di una richiesta
+        self.last_checked = time.time()   # ultimo uso o NOOP riuscito
+
+
+class ImapConnectionPool:
+    """Connessioni IMAP autenticate riusate per account (server, porta, utente).
+
+    Le connessioni inattive restano aperte fino a `idle_timeout`; un thread di
+    manutenzione invia NOOP ogni `keepalive_interval` secondi e chiude quelle
+    scadute. Alla riconnessione la mailbox viene riselezionata. Una connessione
+    inattiva si riusa solo con la stessa password del login (confrontata come
+    HMAC con una chiave del processo): altrimenti si rifà il login sul server.
+    """
+
+    def __init__(self, max_per_account=2, max_total=32, idle_timeout=300,
+                 keepalive_interval=60, acquire_timeout=30, factory=None):
+        self.max_per_account = max_per_account
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.acquire_timeout = acquire_timeout
+        # factory(server, port) -> oggetto con l'API di imaplib.IMAP4
+        self.factory = factory or default_factory
+        self._idle = {}        # key -> [ _PooledConnection ]
+        self._in_use = {}      # key -> int
+        self._cond = threading.Condition()
+        self._reaper = None
+        self._hmac_key = secrets.token_bytes(32)
+        self.created = 0
+        self.reused = 0
+
+    # ---------------------------------------------------
+    # API
+    # ---------------------------------------------------
+    @contextmanager
+    def connection(self, server, port, user, password, mailbox="INBOX", readonly=False):
+        """Presta una connessione autenticata con `mailbox` selezionata"""
+        pooled = self.acquire(server, port, user, password)
+        ok = False
+        try:
+            self.select(pooled, mailbox, readonly)
+            yield pooled.conn
+            ok = True
+        finally:
+            self.release(pooled, ok)
+
+    def select(self, pooled, mailbox="INBOX", readonly=False):
+        # Dopo una riconnessione (o cambio mailbox) serve un nuovo SELECT
+        if pooled.mailbox != mailbox or pooled.readonly != readonly:
+            pooled.conn.select(mailbox, readonly=readonly)
+            pooled.mailbox, pooled.readonly = mailbox, readonly
+            # UIDVALIDITY arriva come risposta non taggata del SELECT
+            typ, data = pooled.conn.response("UIDVALIDITY")
+            pooled.uidvalidity = int(data[0]) if data and data[0] else 0
+
+    def close_account(self, server, port, user):
+        """Chiude le connessioni inattive di un account (es. al logout)"""
+        with self._cond:
+            idle = self._idle.pop((server, port, user), [])
+        for pooled in idle:
+            _logout(pooled.conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "idle": sum(len(v) for v in self._idle.values()),
+                "in_use": sum(self._in_use.values()),
+                "accounts": len(set(self._idle) | set(k for k, v in self._in_use.items() if v)),
+                "created": self.created,
+                "reused": self.reused,
+            }
+
+    # ---------------------------------------------------
+    # INTERNI
+    # ---------------------------------------------------
+    def _total(self):
+        return sum(len(v) for v in self._idle.values()) + sum(self._in_use.values())
+
+    def acquire(self, server, port, user, password):
+        """Connessione autenticata per l'account: riusata se possibile, altrimenti nuova.
+
+        Va sempre restituita con release(); le eccezioni di login vengono propagate.
+        """
+        key = (server, port, user)
+        secret = hmac.new(self._hmac_key, password.encode("utf-8"), hashlib.sha256).digest()
+        self._start_reaper()
+        deadline = time.time() + self.acquire_timeout
+        with self._cond:
+            while True:
+                # Solo connessioni autenticate con la stessa password: le altre non provano nulla
+                idle = [p for p in self._idle.get(key, ()) if hmac.compare_digest(p.secret, secret)]
+                if idle:
+                    pooled = idle[-1]
+                    self._idle[key].remove(pooled)
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    break
+                if (self._in_use.get(key, 0) < self.max_per_account
+                        and self._total() < self.max_total):
+                    pooled = None
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    break
+                if self._total() >= self.max_total and self._evict_one_idle():
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhaustedError("Troppe connessioni IMAP aperte, riprova")
+                self._cond.wait(remaining)
+
+        try:
+            if pooled is not None:
+                # Connessione rimasta ferma a lungo: si verifica che sia ancora viva
+                if time.time() - pooled.last_checked > self.keepalive_interval:
+                    try:
+                        pooled.conn.noop()
+                        pooled.last_checked = time.time()
+                    except Exception:
+                        _logout(pooled.conn)
+                        pooled = None
+                if pooled is not None:
+                    self.reused += 1
+                    return pooled
+            conn = self.factory(server, port)
+            try:
+                conn.login(user, password)
+            except Exception:
+                _logout(conn)
+                raise
+            self.created += 1
+            return _PooledConnection(key, conn, secret)
+        except Exception:
+            with self._cond:
+                self._in_use[key] -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, pooled, ok=True):
+        """Rimette la connessione nel pool; dopo un errore (ok=False) la chiude"""
+        key = pooled.key
+        with self._cond:
+            self._in_use[key] -= 1
+            if ok:
+                pooled.last_used = pooled.last_checked = time.time()
+                self._idle.setdefault(key, []).append(pooled)
+            self._cond.notify()
+        if not ok:
+            # Stato della connessione incerto dopo un errore: meglio chiuderla
+            _logout(pooled.conn)
+
+    def _evict_one_idle(self):
+        oldest_key, oldest = None, None
+        for key, idle in self._idle.items():
+            for pooled in idle:
+                if oldest is None or pooled.last_used < oldest.last_used:
+                    oldest_key, oldest = key, pooled
+        if oldest is None:
+            return False
+        self._idle[oldest_key].remove(oldest)
+        threading.Thread(target=_logout, args=(oldest.conn,), daemon=True).start()
+        return True
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_loop, name="imap-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(min(self.keepalive_interval, self.idle_timeout) / 2)
+            now = time.time()
+            expired, stale = [], []
+            with self._cond:
+                for key, idle in self._idle.items():
+                    for pooled in list(idle):
+                        if now - pooled.last_used > self.idle_timeout:
+                            idle.remove(pooled)
+                            expired.append(pooled)
+                        elif now - pooled.last_checked > self.keepalive_interval:
+                            idle.remove(pooled)
+                            stale.append((key, pooled))
+                self._cond.notify_all()
+            for pooled in expired:
+                _logout(pooled.conn)
+            # Keepalive fuori dal lock; le connessioni vive tornano nel pool
+            for key, pooled in stale:
+                try:
+                    pooled.conn.noop()
+                    pooled.last_checked = time.time()
+                    with self._cond:
+                        self._idle.setdefault(key, []).append(pooled)
+                        self._cond.notify()
+                except Exception:
+                    _logout(pooled.conn)
+
+
+class SessionStore:
+    """Sessioni email lato server: il client invia solo il token.
+
+    La password resta in memoria nel processo (serve per riconnettersi) e la
+    sessione scade dopo `ttl` secondi di inattività.
+    """
+
+    def __init__(self, ttl=1800):
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, account):
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            self._purge()
+            self._sessions[token] = {"account": account, "expires": time.time() + self.ttl}
+        return token
+
+    def get(self, token):
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None or session["expires"] < time.time():
+                self._sessions.pop(token, None)
+                return None
+            session["expires"] = time.time() + self.ttl
+            return session["account"]
+
+    def delete(self, token):
+        with self._lock:
+            session = self._sessions.pop(token, None)
+        return session["account"] if session else None
+
+    def _purge(self):
+        now = time.time()
+        for token in [t for t, s in self._sessions.items() if s["expires"] < now]:
+            del self._sessions[token]
+
+
+class _TimedCommands:
+    """Misura il round-trip di ogni comando IMAP (UID FETCH, SELECT, NOOP...)"""
+
+    def _simple_command(self, name, *args):
+        command = f"{name} {args[0]}".upper() if name == "UID" and args else name
+        with IMAP_COMMAND.time(command=command):
+            return super()._simple_command(name, *args)
+
+
+class TimedIMAP4(_TimedCommands, imaplib.IMAP4):
+    pass
+
+
+class TimedIMAP4_SSL(_TimedCommands, imaplib.IMAP4_SSL):
+    pass
+
+
+def default_factory(server, port):
+    # Server locali (stand-in di test) senza TLS, tutti gli altri con IMAP4_SSL
+    if server in ("127.0.0.1", "localhost") and port != 993:
+        return TimedIMAP4(server, port)
+    return TimedIMAP4_SSL(server, port)
+
+def _logout(conn):
+    try:
+        conn.logout()
+    except Exception:
+        pass
@@ -0,0 +1,225 @@
+import re
+
+# ---------------------------------------------------
+# PARSING DELLE RISPOSTE FETCH
+# ---------------------------------------------------
+class Literal(bytes):
+    """Letterale IMAP ({n}\\r\\n...), restituito così com'è"""
+
+
+_LITERAL_RE = re.compile(rb"\{(\d+)\}$")
+
+
+def _segments(data):
+    """Appiattisce l'output di imaplib (bytes e tuple (testa, letterale))"""
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item[0], item[1]
+            # La testa termina con il marcatore {n}: lo si sostituisce con il letterale
+            yield _LITERAL_RE.sub(b"", head.rstrip())
+            yield Literal(literal)
+        elif item is not None:
+            yield item
+
+
+def _tokenize(data):
+    for seg in _segments(data):
+        if isinstance(seg, Literal):
+            yield seg
+            continue
+        i, n = 0, len(seg)
+        while i < n:
+            c = seg[i:i + 1]
+            if c in (b" ", b"\r", b"\n"):
+                i += 1
+            elif c in (b"(", b")"):
+                yield c
+                i += 1
+            elif c == b'"':
+                j = i + 1
+                buf = bytearray()
+                while j < n and seg[j:j + 1] != b'"':
+                    if seg[j:j + 1] == b"\\":
+                        j += 1
+                    buf += seg[j:j + 1]
+                    j += 1
+                yield ("str", bytes(buf))
+                i = j + 1
+            else:
+                # Atomo; le sezioni BODY[...] possono contenere spazi e parentesi
+                j = i
+                depth = 0
+                while j < n:
+                    ch = seg[j:j + 1]
+                    if ch == b"[":
+                        depth += 1
+                    elif ch == b"]":
+                        depth -= 1
+                    elif depth == 0 and ch in (b" ", b"(", b")", b"\r", b"\n"):
+                        break
+                    j += 1
+                yield ("atom", seg[i:j])
+                i = j
+
+
+def _parse(tokens):
+    """Costruisce liste annidate dai token; NIL diventa None"""
+    stack = [[]]
+    for tok in tokens:
+        if tok == b"(":
+            stack.append([])
+        elif tok == b")":
+            done = stack.pop()
+            stack[-1].append(done)
+        elif isinstance(tok, Literal):
+            stack[-1].append(bytes(tok))
+        else:
+            kind, value = tok
+            if kind == "atom" and value.upper() == b"NIL":
+                stack[-1].append(None)
+            elif kind == "atom":
+                stack[-1].append(value.decode("ascii", errors="replace"))
+            else:
+                stack[-1].append(value.decode("utf-8", errors="replace"))
+    while len(stack) > 1:
+        done = stack.pop()
+        stack[-1].append(done)
+    return stack[0]
+
+
+def parse_fetch_response(data):
+    """Converte la risposta di un FETCH in una lista di dict, uno per messaggio.
+
+    Le chiavi sono i nomi degli attributi in maiuscolo ("UID", "BODYSTRUCTURE",
+    "BODY[HEADER.FIELDS (SUBJECT FROM DATE)]", ...); i numeri diventano int.
+    """
+    # imaplib toglie già "* " e "FETCH"; si scartano comunque se presenti
+    items = [x for x in _parse(_tokenize(data)) if not (isinstance(x, str) and x.upper() in ("*", "FETCH"))]
+    messages = []
+    for i in range(len(items) - 1):
+        seq, attrs = items[i], items[i + 1]
+        if not (isinstance(seq, str) and seq.isdigit() and isinstance(attrs, list)):
+            continue
+        msg = {"SEQ": int(seq)}
+        for k in range(0, len(attrs) - 1, 2):
+            key = attrs[k].upper() if isinstance(attrs[k], str) else str(attrs[k])
+            msg[key] = _int(attrs[k + 1])
+        messages.append(msg)
+    return messages
+
+
+def _int(value):
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value
+
+
+def find_section(msg, prefix):
+    """Valore della prima chiave che inizia con `prefix` (es. "BODY[HEADER")"""
+    prefix = prefix.upper()
+    for key, value in msg.items():
+        if key.startswith(prefix):
+            return value
+    return None
+
+
+# ---------------------------------------------------
+# BODYSTRUCTURE
+# ---------------------------------------------------
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {
+        str(value[k]).lower(): value[k + 1]
+        for k in range(0, len(value) - 1, 2)
+        if value[k] is not None
+    }
+
+
+def walk_bodystructure(bs, section=""):
+    """Restituisce le parti foglia di un BODYSTRUCTURE con il loro numero di sezione.
+
+    Ogni parte è un dict: section, type, subtype, params, encoding, size,
+    disposition, filename.
+    """
+    if not isinstance(bs, list) or not bs:
+        return []
+
+    if isinstance(bs[0], list):
+        # multipart: (parte)(parte)... "subtype" ...
+        parts = []
+        n = 0
+        for child in bs:
+            if not isinstance(child, list):
+                break
+            n += 1
+            child_section = f"{section}.{n}" if section else str(n)
+            parts.extend(walk_bodystructure(child, child_section))
+        return parts
+
+    ctype = (bs[0] or "").lower()
+    subtype = (bs[1] or "").lower() if len(bs) > 1 else ""
+    params = _params(bs[2]) if len(bs) > 2 else {}
+    encoding = (bs[5] or "7bit").lower() if len(bs) > 5 and bs[5] else "7bit"
+    size = _int(bs[6]) if len(bs) > 6 else 0
+    size = size if isinstance(size, int) else 0
+
+    # La posizione della disposition dipende dal tipo (text ha il numero di righe)
+    if ctype == "text":
+        disp_index = 9
+    elif ctype == "message" and subtype == "rfc822":
+        disp_index = 11
+    else:
+        disp_index = 8
+    disposition = None
+    disp_params = {}
+    if len(bs) > disp_index and isinstance(bs[disp_index], list) and bs[disp_index]:
+        disposition = (bs[disp_index][0] or "").lower()
+        if len(bs[disp_index]) > 1:
+            disp_params = _params(bs[disp_index][1])
+
+    filename = disp_params.get("filename") or params.get("name")
+    return [{
+        "section": section or "1",
+        "type": ctype,
+        "subtype": subtype,
+        "params": params,
+        "encoding": encoding,
+        "size": size,
+        "disposition": disposition,
+        "filename": filename,
+    }]
+
+
+def has_attachments(bs):
+    return any(part["disposition"] == "attachment" for part in walk_bodystructure(bs))
+
+
+def find_text_part(parts):
+    """Parte da mostrare come corpo: text/plain, altrimenti text/html (esclusi gli allegati)"""
+    candidates = [p for p in parts if p["type"] == "text" and p["disposition"] != "attachment"]
+    for subtype in ("plain", "html"):
+        for part in candidates:
+            if part["subtype"] == subtype:
+                return part
+    return None
+
+
+def decoded_size(part):
+    """Dimensione stimata dopo la decodifica (BODYSTRUCTURE riporta i byte codificati)"""
+    if part["encoding"] == "base64":
+        # Righe MIME da 76 caratteri + CRLF: 78 byte codificati ogni 57 decodificati
+        return part["size"] * 57 // 78
+    return part["size"]
+
+
+def uid_set(uids):
+    """Insieme di UID compatto per FETCH: intervalli contigui come a:b"""
+    uids = sorted(int(u) for u in uids)
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(f"{a}:{b}" if a != b else str(a) for a, b in ranges)
@@ -0,0 +1,280 @@
+import json
+import time
+import base64
+import socket
+import select
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+from scheduler import (
+    PRIORITY_INTERACTIVE, PRIORITY_BATCH, SchedulerFullError, SchedulerTimeoutError,
+)
+
+# Priorità sul server di inferenza: la chat passa prima dei riassunti
+ROUTE_PRIORITY = {"chat": PRIORITY_INTERACTIVE}
+
+
+class InferenceError(Exception):
+    """Il server di inferenza ha risposto con un errore o non è raggiungibile"""
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+class InferenceClient:
+    """Client del server di inferenza (inference_server.py).
+
+    Espone la stessa interfaccia di ModelRegistry usata dall'app (route,
+    route_model, set_route, stats, load_async): i worker web non caricano
+    modelli e il server serializza le richieste di tutti i worker con le sue
+    priorità. `url` è unix:///percorso/socket oppure http://host:porta.
+    """
+
+    def __init__(self, url, timeout=600, route_ttl=2.0):
+        parts = urlsplit(url)
+        if parts.scheme == "unix":
+            self._connect = lambda: UnixHTTPConnection(parts.path, timeout=timeout)
+        elif parts.scheme == "http":
+            self._connect = lambda: http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        else:
+            raise ValueError(f"URL del server di inferenza non valido: {url}")
+        self.url = url
+        self.route_ttl = route_ttl
+        self._local = threading.local()
+        self._routes = {}
+        self._routes_at = 0.0
+
+    # ---------------------------------------------------
+    # TRASPORTO
+    # ---------------------------------------------------
+    def _open(self, method, path, payload=None):
+        conn = self._connect()
+        body = json.dumps(payload) if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            return conn, conn.getresponse()
+        except OSError as e:
+            conn.close()
+            raise InferenceError(f"Server di inferenza non raggiungibile: {e}")
+
+    def request(self, method, path, payload=None, idempotent=True):
+        """Richiesta JSON su una connessione persistente del thread.
+
+        Se la connessione riusata è stata chiusa dal server (keep-alive scaduto)
+        si riprova una volta; una richiesta non idempotente (una completion, che
+        il server rigenererebbe da capo) si riprova solo se l'invio stesso è fallito.
+        """
+        for attempt in (0, 1):
+            conn = getattr(self._local, "conn", None)
+            if conn is not None and _closed_by_peer(conn):
+                conn.close()
+                conn = None
+            reused = conn is not None
+            if conn is None:
+                conn = self._local.conn = self._connect()
+            body = json.dumps(payload) if payload is not None else None
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                self._local.conn = None
+                if attempt or not reused or (sent and not idempotent):
+                    raise InferenceError(f"Server di inferenza non raggiungibile: {e}")
+        result = json.loads(data) if data else {}
+        if resp.status >= 400:
+            raise _error(resp.status, result)
+        return result
+
+    # ---------------------------------------------------
+    # INTERFACCIA DI ModelRegistry
+    # ---------------------------------------------------
+    def route(self, route):
+        return RemoteModel(self, route, ROUTE_PRIORITY.get(route, PRIORITY_BATCH))
+
+    def routes(self):
+        now = time.monotonic()
+        if now - self._routes_at > self.route_ttl:
+            self._routes = self.request("GET", "/v1/routes")
+            self._routes_at = now
+        return self._routes
+
+    def route_model(self, route):
+        routes = self.routes()
+        if route not in routes:
+            # Route mai usata dal server: la registra e ne ottiene il modello
+            routes = self._routes = self.request("GET", f"/v1/routes?route={route}")
+        return routes.get(route)
+
+    def set_route(self, route, name):
+        self.request("POST", "/v1/routes", {"route": route, "model": name})
+        self._routes_at = 0.0
+
+    def stats(self):
+        return self.request("GET", "/v1/models")
+
+    def load_async(self, name):
+        def run():
+            try:
+                self.request("POST", "/v1/models/load", {"model": name})
+            except Exception as e:
+                print(f"❌ Caricamento modello {name} sul server di inferenza fallito: {e}")
+        threading.Thread(target=run, name="model-loader", daemon=True).start()
+
+    def params(self, name):
+        now = time.monotonic()
+        if now - getattr(self, "_stats_at", 0.0) > self.route_ttl:
+            self._stats = self.stats()
+            self._stats_at = now
+        return self._stats["models"].get(name, {}).get("params", {})
+
+    def n_ctx(self, name):
+        return self.params(name).get("n_ctx")
+
+    def set_model_params(self, name, params):
+        return self.request("POST", "/v1/models/params", {"model": name, "params": params})["params"]
+
+    def pin_prefix(self, route, text, retry_interval=2.0):
+        """Chiede al server di tenere in cache KV il prefisso comune dei prompt della route.
+
+        Se il server non è ancora raggiungibile si riprova in background.
+        """
+        def run():
+            while True:
+                try:
+                    self.request("POST", "/v1/prefix", {"route": route, "text": text})
+                    return
+                except InferenceError:
+                    time.sleep(retry_interval)
+        threading.Thread(target=run, name="pin-prefix", daemon=True).start()
+
+    def health(self):
+        return self.request("GET", "/v1/health")
+
+    # ---------------------------------------------------
+    # GENERAZIONE
+    # ---------------------------------------------------
+    def complete(self, route, prompt, params, priority, timeout=None):
+        return self.request("POST", "/v1/completion", {
+            "route": route, "prompt": prompt, "params": params,
+            "priority": priority, "timeout": timeout,
+        }, idempotent=False)
+
+    def stream(self, route, prompt, params, priority, timeout=None):
+        """Chunk di llama_cpp uno per riga (NDJSON); chiudere il generatore interrompe la generazione"""
+        conn, resp = self._open("POST", "/v1/completion", {
+            "route": route, "prompt": prompt, "params": params,
+            "priority": priority, "timeout": timeout, "stream": True,
+        })
+        try:
+            if resp.status >= 400:
+                data = resp.read()
+                raise _error(resp.status, json.loads(data) if data else {})
+            while True:
+                line = resp.readline()
+                if not line:
+                    return
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise _error(chunk.get("status", 500), chunk)
+                yield chunk
+        finally:
+            # Chiudendo la connessione il server smette di generare
+            conn.close()
+
+
+class RemoteModel:
+    """Si comporta come un Llama (o RoutedModel) ma genera sul server di inferenza"""
+
+    def __init__(self, client, route, priority=PRIORITY_BATCH, queue_timeout=None):
+        self.client = client
+        self.route = route
+        self.priority = priority
+        self.queue_timeout = queue_timeout
+
+    @property
+    def model_name(self):
+        return self.client.route_model(self.route)
+
+    @property
+    def model_path(self):
+        return self.model_name or ""
+
+    @property
+    def manager(self):
+        return RemoteManager(self.client, self.route)
+
+    def __call__(self, prompt, stream=False, **params):
+        if stream:
+            return self.client.stream(self.route, prompt, params, self.priority, self.queue_timeout)
+        return self.client.complete(self.route, prompt, params, self.priority, self.queue_timeout)
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return self.client.request("POST", "/v1/tokenize", {
+            "route": self.route, "data": base64.b64encode(text).decode("ascii"),
+            "add_bos": add_bos, "special": special,
+        })["tokens"]
+
+    def detokenize(self, tokens):
+        result = self.client.request("POST", "/v1/detokenize", {"route": self.route, "tokens": list(tokens)})
+        return base64.b64decode(result["data"])
+
+
+class RemoteManager:
+    """Stato del modello della route sul server (per /readyz)"""
+
+    def __init__(self, client, route):
+        self.client = client
+        self.route = route
+
+    def stats(self):
+        try:
+            return self.client.request("GET", f"/v1/health?route={self.route}")
+        except (InferenceError, KeyError) as e:
+            return {"state": "unreachable", "error": str(e)}
+
+    @property
+    def ready(self):
+        return bool(self.stats().get("ready"))
+
+
+def _closed_by_peer(conn):
+    # Su una connessione keep-alive inattiva non arriva nulla: se il socket è leggibile
+    # il server l'ha chiusa (EOF) e la richiesta andrebbe persa
+    sock = conn.sock
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def _error(status, body):
+    message = body.get("error") or f"Errore del server di inferenza (HTTP {status})"
+    if status == 429:
+        return SchedulerFullError(message)
+    if status == 503:
+        return SchedulerTimeoutError(message)
+    if status == 404:
+        return KeyError(message)
+    if status == 400:
+        return ValueError(message)
+    return InferenceError(message)
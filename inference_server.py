@@ -0,0 +1,397 @@
+"""Server di inferenza: un processo che possiede i modelli e i core della CPU.
+
+I worker web (app.py con INFERENCE_URL) diventano client leggeri: nessuno
+carica una copia del GGUF e tutte le richieste passano da un'unica coda con
+priorità. API JSON su socket Unix o TCP, con streaming NDJSON:
+
+    POST /v1/completion   {route, prompt, params, priority, timeout, stream}
+    POST /v1/tokenize     {route, data (base64), add_bos, special}
+    POST /v1/detokenize   {route, tokens}
+    POST /v1/prefix       {route, text}   prefisso comune da tenere in cache KV
+    GET  /v1/routes, POST /v1/routes {route, model}
+    GET  /v1/models, POST /v1/models/load {model}
+    POST /v1/models/params {model, params}   override a runtime dei parametri
+    GET  /v1/health[?route=], /v1/scheduler, /metrics
+
+    python inference_server.py --socket /tmp/llamachat.sock
+    INFERENCE_URL=unix:///tmp/llamachat.sock gunicorn -w 4 app:app
+"""
+import os
+import json
+import base64
+import socket
+import argparse
+import threading
+import socketserver
+from queue import Queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import metrics
+from model_registry import ModelRegistry
+from autotune import load_profile
+from scheduler import (
+    InferenceScheduler, SchedulerFullError, SchedulerTimeoutError, JobCancelledError,
+    PRIORITY_BATCH,
+)
+
+MODELS_DIR = os.environ.get("MODELS_DIR", "./models")
+MODEL_FILENAME = os.environ.get("MODEL_FILENAME", "Phi-3-mini-4k-instruct-q4.gguf")
+MODEL_CONFIG = os.environ.get("MODEL_CONFIG", os.path.join(MODELS_DIR, "models.json"))
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("MODEL_MEMORY_BUDGET_MB", 0))
+MODEL_USE_MMAP = os.environ.get("MODEL_USE_MMAP", "1") == "1"
+MODEL_USE_MLOCK = os.environ.get("MODEL_USE_MLOCK", "0") == "1"
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "1") == "1"
+N_CTX = int(os.environ.get("N_CTX", 4096))
+TUNING_PROFILE = os.environ.get("TUNING_PROFILE", os.path.join(MODELS_DIR, "tuning.json"))
+
+# Coda condivisa da tutti i worker web
+INFERENCE_MAX_QUEUE = int(os.environ.get("INFERENCE_MAX_QUEUE", 32))
+INFERENCE_QUEUE_TIMEOUT = 120
+
+KV_CACHE_RAM_MB = int(os.environ.get("KV_CACHE_RAM_MB", 1024))
+KV_CACHE_DISK_MB = int(os.environ.get("KV_CACHE_DISK_MB", 4096))
+KV_CACHE_DIR = os.environ.get("KV_CACHE_DIR", os.path.join(".cache", "kv"))
+
+# Continuous batching (1 = disattivato): sequenze contemporanee e contesto condiviso
+BATCH_MAX_SEQUENCES = int(os.environ.get("BATCH_MAX_SEQUENCES", 1))
+BATCH_N_CTX = int(os.environ.get("BATCH_N_CTX", 8192))
+
+_END = object()
+
+
+class InferenceService:
+    """Modelli, coda e cache KV del processo di inferenza"""
+
+    def __init__(self, registry, scheduler, queue_timeout=INFERENCE_QUEUE_TIMEOUT,
+                 kv_cache_ram_mb=0, kv_cache_disk_mb=0, kv_cache_dir=None,
+                 batch_max_sequences=1, batch_n_ctx=8192):
+        self.registry = registry
+        self.scheduler = scheduler
+        self.queue_timeout = queue_timeout
+        self.kv_cache_ram_mb = kv_cache_ram_mb
+        self.kv_cache_disk_mb = kv_cache_disk_mb
+        self.kv_cache_dir = kv_cache_dir
+        self.batch_max_sequences = batch_max_sequences
+        self.batch_n_ctx = batch_n_ctx
+        self.kv_caches = {}
+        self.prefixes = {}       # route -> prefisso comune dei prompt
+        self._models = {}        # route -> RoutedModel
+        self._lock = threading.Lock()
+        if batch_max_sequences > 1:
+            # Le generazioni passano dal contesto del motore: una cache KV sul Llama non servirebbe
+            registry.on_load(self._setup_batch_engine)
+        else:
+            registry.on_load(self._setup_kv_cache)
+
+    def model(self, route):
+        with self._lock:
+            model = self._models.get(route)
+            if model is None:
+                model = self._models[route] = self.registry.route(route)
+            return model
+
+    # ---------------------------------------------------
+    # CACHE KV
+    # ---------------------------------------------------
+    def _setup_kv_cache(self, name, llm):
+        if self.kv_cache_ram_mb <= 0:
+            return
+        from kv_cache import ConversationKVCache
+        kv_cache = ConversationKVCache(
+            ram_bytes=self.kv_cache_ram_mb << 20,
+            disk_dir=os.path.join(self.kv_cache_dir, name) if self.kv_cache_dir else None,
+            disk_bytes=self.kv_cache_disk_mb << 20,
+        )
+        llm.set_cache(kv_cache)
+        self.kv_caches[name] = kv_cache
+        self._pin(name, llm)
+
+    def _pin(self, name, llm):
+        # Un solo prefisso pinnato per modello: quello della prima route che lo usa
+        for route, text in list(self.prefixes.items()):
+            if self.registry.route_model(route) == name and name in self.kv_caches:
+                n_prefix = self.kv_caches[name].warm_prefix(llm, text, llm.model_path)
+                print(f"✅ Cache KV pronta per {name} (prefisso di {route}: {n_prefix} token)")
+                return
+
+    def pin_prefix(self, route, text):
+        self.prefixes[route] = text
+        name = self.registry.route_model(route)
+        engine = self.registry.engine(name)
+        if engine is not None:
+            engine.set_prefix(text)
+        manager = self.registry.manager(name)
+        if manager.loaded and name in self.kv_caches:
+            # Modello già caricato: lo stato del prefisso si calcola in coda come un job batch
+            self.scheduler.submit(lambda: self._pin_loaded(name), priority=PRIORITY_BATCH)
+        elif manager.state == "loading":
+            # Gli hook on_load possono essere già passati senza vedere il prefisso:
+            # il job attende la fine del caricamento e lo applica
+            self.scheduler.submit(lambda: self._pin_loaded(name, route), priority=PRIORITY_BATCH)
+
+    def _pin_loaded(self, name, route=None):
+        with self.registry.use(name) as llm:
+            engine = self.registry.engine(name)
+            if route is not None and engine is not None:
+                engine.set_prefix(self.prefixes[route])
+            self._pin(name, llm)
+
+    # ---------------------------------------------------
+    # CONTINUOUS BATCHING
+    # ---------------------------------------------------
+    def _setup_batch_engine(self, name, llm):
+        from batch_engine import BatchEngine
+        params = self.registry.params(name)
+        engine = BatchEngine.from_llama(llm, max_sequences=self.batch_max_sequences, n_ctx=self.batch_n_ctx,
+                                        n_batch=params.get("n_batch", 512), n_threads=params.get("n_threads"),
+                                        n_threads_batch=params.get("n_threads_batch"))
+        for route, text in list(self.prefixes.items()):
+            if self.registry.route_model(route) == name:
+                engine.set_prefix(text)
+                break
+        self.registry.set_engine(name, engine)
+        print(f"✅ Continuous batching per {name}: {self.batch_max_sequences} sequenze, {self.batch_n_ctx} token di contesto")
+
+    # ---------------------------------------------------
+    # GENERAZIONE
+    # ---------------------------------------------------
+    def complete(self, route, prompt, params, priority, timeout):
+        llm = self.model(route)
+        job = self.scheduler.submit(lambda: llm(prompt, **params), priority=priority,
+                                    timeout=timeout or self.queue_timeout)
+        return job.wait()
+
+    def stream(self, route, prompt, params, priority, timeout, cancel_event):
+        """Coda di chunk alimentata dal job; termina con _END o con un'eccezione"""
+        llm = self.model(route)
+        out = Queue()
+
+        def run():
+            try:
+                tokens = llm(prompt, stream=True, **params)
+                try:
+                    for chunk in tokens:
+                        if cancel_event.is_set():
+                            break
+                        out.put(chunk)
+                finally:
+                    tokens.close()
+            except Exception as e:
+                out.put(e)
+            finally:
+                out.put(_END)
+
+        self.scheduler.submit(run, priority=priority, timeout=timeout or self.queue_timeout,
+                              cancel_event=cancel_event, on_drop=lambda job, exc: (out.put(exc), out.put(_END)))
+        return out
+
+
+# ---------------------------------------------------
+# HTTP
+# ---------------------------------------------------
+def error_status(exc):
+    if isinstance(exc, SchedulerFullError):
+        return 429
+    if isinstance(exc, (SchedulerTimeoutError, JobCancelledError)):
+        return 503
+    if isinstance(exc, KeyError):
+        return 404
+    if isinstance(exc, ValueError):
+        return 400
+    return 500
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def setup(self):
+        # I token vanno inviati subito, senza attendere altri dati da accorpare (solo TCP)
+        self.disable_nagle_algorithm = self.request.family != socket.AF_UNIX
+        super().setup()
+
+    def address_string(self):
+        # Sui socket Unix client_address è vuoto
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, exc):
+        message = exc.args[0] if isinstance(exc, KeyError) and exc.args else str(exc)
+        self.send_json({"error": message}, error_status(exc))
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        service = self.service
+        registry = service.registry
+        try:
+            if url.path == "/v1/routes":
+                if "route" in query:
+                    service.model(query["route"])
+                self.send_json(registry.routes())
+            elif url.path == "/v1/models":
+                self.send_json(registry.stats())
+            elif url.path == "/v1/health":
+                if "route" in query:
+                    manager = service.model(query["route"]).manager
+                    self.send_json({"ready": manager.ready, **manager.stats()})
+                else:
+                    self.send_json({"status": "ok", "routes": registry.routes()})
+            elif url.path == "/v1/scheduler":
+                self.send_json({**service.scheduler.stats(),
+                                "kv_cache": {n: c.stats() for n, c in service.kv_caches.items()}})
+            elif url.path == "/metrics":
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_json({"error": "not found"}, 404)
+        except Exception as e:
+            self.send_error_json(e)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        service = self.service
+        try:
+            data = self.read_json()
+            if path == "/v1/completion":
+                args = (data["route"], data["prompt"], data.get("params") or {},
+                        data.get("priority", PRIORITY_BATCH), data.get("timeout"))
+                if data.get("stream"):
+                    self.stream_completion(*args)
+                else:
+                    self.send_json(service.complete(*args))
+            elif path == "/v1/tokenize":
+                tokens = service.model(data["route"]).tokenize(
+                    base64.b64decode(data["data"]), add_bos=data.get("add_bos", True),
+                    special=data.get("special", False))
+                self.send_json({"tokens": list(tokens)})
+            elif path == "/v1/detokenize":
+                text = service.model(data["route"]).detokenize(data["tokens"])
+                self.send_json({"data": base64.b64encode(text).decode("ascii")})
+            elif path == "/v1/prefix":
+                service.pin_prefix(data["route"], data["text"])
+                self.send_json({"route": data["route"]})
+            elif path == "/v1/routes":
+                service.registry.set_route(data["route"], data.get("model"))
+                self.send_json(service.registry.routes())
+            elif path == "/v1/models/load":
+                service.registry.get(data["model"])
+                self.send_json(service.registry.manager(data["model"]).stats())
+            elif path == "/v1/models/params":
+                params = service.registry.set_model_params(data["model"], data.get("params"))
+                self.send_json({"model": data["model"], "params": params})
+            else:
+                self.send_json({"error": "not found"}, 404)
+        except Exception as e:
+            self.send_error_json(e)
+
+    def stream_completion(self, route, prompt, params, priority, timeout):
+        cancel_event = threading.Event()
+        out = self.service.stream(route, prompt, params, priority, timeout, cancel_event)
+        # Header solo al primo chunk: gli errori di coda arrivano come status HTTP
+        first = out.get()
+        if isinstance(first, Exception):
+            self.send_error_json(first)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        item = first
+        try:
+            while item is not _END:
+                if isinstance(item, Exception):
+                    payload = {"error": str(item), "status": error_status(item)}
+                else:
+                    payload = item
+                line = json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                item = out.get()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Client disconnesso: la generazione si ferma al prossimo token
+            cancel_event.set()
+            self.close_connection = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def build_service():
+    registry = ModelRegistry(
+        MODELS_DIR,
+        MODEL_CONFIG,
+        default_model=MODEL_FILENAME,
+        defaults={"n_ctx": N_CTX, "n_threads": 6, "n_batch": 256, "n_gpu_layers": 0,
+                  "use_mmap": MODEL_USE_MMAP, "use_mlock": MODEL_USE_MLOCK},
+        memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+        warmup_prompt="User: ciao\nAssistant:" if MODEL_WARMUP else None,
+        profile=load_profile(TUNING_PROFILE),
+    )
+    # Un worker per sequenza: i job in corso si alternano nel motore di batching
+    scheduler = InferenceScheduler(max_queue=INFERENCE_MAX_QUEUE, workers=BATCH_MAX_SEQUENCES)
+    return InferenceService(registry, scheduler, kv_cache_ram_mb=KV_CACHE_RAM_MB,
+                            kv_cache_disk_mb=KV_CACHE_DISK_MB, kv_cache_dir=KV_CACHE_DIR,
+                            batch_max_sequences=BATCH_MAX_SEQUENCES, batch_n_ctx=BATCH_N_CTX)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", help="percorso del socket Unix (alternativa a --host/--port)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--preload", default="chat", help="route da caricare all'avvio (separate da virgole)")
+    args = parser.parse_args()
+
+    service = build_service()
+    handler = type("Handler", (InferenceHandler,), {"service": service})
+    if args.socket:
+        server = UnixHTTPServer(args.socket, handler)
+        where = f"unix://{os.path.abspath(args.socket)}"
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        where = f"http://{args.host}:{args.port}"
+
+    for route in filter(None, (r.strip() for r in args.preload.split(","))):
+        service.registry.load_async(service.model(route).model_name)
+
+    print(f"✅ Server di inferenza in ascolto su {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
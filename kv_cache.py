@@ -0,0 +1,207 @@
+import os
+import json
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+
+from llama_cpp import Llama
+from llama_cpp.llama_cache import BaseLlamaCache
+
+# ---------------------------------------------------
+# CACHE KV PER PREFISSO DI TOKEN
+# ---------------------------------------------------
+class ConversationKVCache(BaseLlamaCache):
+    """Cache degli stati KV di llama.cpp indicizzata per prefisso di token.
+
+    Livello RAM con LRU e budget in byte; gli stati espulsi finiscono su disco
+    (secondo livello, anch'esso LRU con budget). Il prefisso del SYSTEM_PROMPT
+    è "pinnato": non viene mai espulso e sopravvive ai riavvii.
+    Si collega al modello con `llm.set_cache(cache)`.
+    """
+
+    def __init__(self, ram_bytes=1 << 30, disk_dir=None, disk_bytes=0):
+        super().__init__(ram_bytes)
+        self.ram_bytes = ram_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes if disk_dir else 0
+        self._ram = OrderedDict()      # key(tuple) -> LlamaState
+        self._disk = OrderedDict()     # key(tuple) -> (filename, size)
+        self._pinned_key = None
+        self._pinned_state = None
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    # ---------------------------------------------------
+    # INTERFACCIA BaseLlamaCache
+    # ---------------------------------------------------
+    @property
+    def cache_size(self):
+        return sum(state.llama_state_size for state in self._ram.values())
+
+    def _find_longest_prefix_key(self, key):
+        best_len = 0
+        best_key = None
+        candidates = list(self._ram.keys()) + list(self._disk.keys())
+        if self._pinned_key is not None:
+            candidates.append(self._pinned_key)
+        for k in candidates:
+            prefix_len = Llama.longest_token_prefix(k, key)
+            if prefix_len > best_len:
+                best_len = prefix_len
+                best_key = k
+        return best_key
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        with self._lock:
+            best = self._find_longest_prefix_key(key)
+            if best is None:
+                self.misses += 1
+                raise KeyError("Key not found")
+            self.hits += 1
+            if best == self._pinned_key:
+                return self._pinned_state
+            if best in self._ram:
+                self._ram.move_to_end(best)
+                return self._ram[best]
+            # Promozione disco -> RAM
+            state = self._read_disk(best)
+            self._store_ram(best, state)
+            return state
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key, value):
+        key = tuple(key)
+        with self._lock:
+            if not self._accepts(key):
+                return
+            # Lo stato nuovo estende quelli precedenti della stessa conversazione:
+            # i prefissi superati vengono scartati (uno stato per conversazione)
+            for old in [k for k in self._ram if len(k) <= len(key) and key[:len(k)] == k]:
+                del self._ram[old]
+            for old in [k for k in self._disk if len(k) <= len(key) and key[:len(k)] == k]:
+                self._remove_disk(old)
+            self._store_ram(key, value)
+
+    # ---------------------------------------------------
+    # SYSTEM PROMPT
+    # ---------------------------------------------------
+    def warm_prefix(self, llm, prefix_text, model_path=""):
+        """Valuta (o ripristina da disco) lo stato del prefisso condiviso e lo pinna"""
+        tokens = tuple(llm.tokenize(prefix_text.encode("utf-8")))
+        digest = hashlib.sha256(
+            (os.path.basename(model_path) + "\0" + prefix_text).encode("utf-8")
+        ).hexdigest()[:16]
+        path = os.path.join(self.disk_dir, f"prefix_{digest}.state") if self.disk_dir else None
+
+        state = None
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    state = pickle.load(f)
+            except Exception as e:
+                print(f"Stato del prefisso non leggibile, lo ricalcolo: {e}")
+        if state is None:
+            llm.reset()
+            llm.eval(list(tokens))
+            state = llm.save_state()
+            if path:
+                with open(path, "wb") as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            self._pinned_key = tokens
+            self._pinned_state = state
+        return len(tokens)
+
+    def _accepts(self, key):
+        # Con un prefisso pinnato si conservano solo i prompt di chat che lo condividono:
+        # riassunti e altri prompt one-shot non sporcano la LRU
+        if self._pinned_key is None:
+            return True
+        return Llama.longest_token_prefix(self._pinned_key, key) >= len(self._pinned_key) - 1
+
+    # ---------------------------------------------------
+    # LIVELLO RAM
+    # ---------------------------------------------------
+    def _store_ram(self, key, state):
+        self._ram[key] = state
+        self._ram.move_to_end(key)
+        while self.cache_size > self.ram_bytes and len(self._ram) > 1:
+            old_key, old_state = self._ram.popitem(last=False)
+            self._spill(old_key, old_state)
+
+    # ---------------------------------------------------
+    # LIVELLO DISCO
+    # ---------------------------------------------------
+    def _spill(self, key, state):
+        if not self.disk_bytes or state.llama_state_size > self.disk_bytes:
+            return
+        name = hashlib.sha256(repr(key).encode("ascii")).hexdigest()[:24]
+        path = os.path.join(self.disk_dir, name + ".state")
+        with open(path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Le chiavi stanno in un file separato: l'indice si ricostruisce senza leggere gli stati
+        with open(os.path.join(self.disk_dir, name + ".tokens"), "w", encoding="utf-8") as f:
+            json.dump(list(key), f)
+        self._disk[key] = (name, os.path.getsize(path))
+        while self._disk_size() > self.disk_bytes and self._disk:
+            self._remove_disk(next(iter(self._disk)))
+
+    def _read_disk(self, key):
+        name, _ = self._disk[key]
+        with open(os.path.join(self.disk_dir, name + ".state"), "rb") as f:
+            state = pickle.load(f)
+        self._remove_disk(key)
+        return state
+
+    def _remove_disk(self, key):
+        name, _ = self._disk.pop(key)
+        for ext in (".state", ".tokens"):
+            try:
+                os.remove(os.path.join(self.disk_dir, name + ext))
+            except OSError:
+                pass
+
+    def _disk_size(self):
+        return sum(size for _, size in self._disk.values())
+
+    def _load_disk_index(self):
+        # Ricostruisce l'indice dai file presenti (i più vecchi in testa alla LRU)
+        entries = []
+        for fname in os.listdir(self.disk_dir):
+            if not fname.endswith(".tokens"):
+                continue
+            name = fname[:-7]
+            path = os.path.join(self.disk_dir, name + ".state")
+            try:
+                with open(os.path.join(self.disk_dir, fname), "r", encoding="utf-8") as f:
+                    key = tuple(json.load(f))
+                entries.append((os.path.getmtime(path), key, name, os.path.getsize(path)))
+            except (OSError, ValueError):
+                continue
+        for _, key, name, size in sorted(entries):
+            self._disk[key] = (name, size)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "ram_entries": len(self._ram),
+                "ram_bytes": self.cache_size,
+                "ram_budget": self.ram_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_size(),
+                "disk_budget": self.disk_bytes,
+                "pinned_tokens": len(self._pinned_key or ()),
+            }
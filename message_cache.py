@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+class MessageCache:
+    """Cache locale dei messaggi IMAP, indicizzata per (account, UIDVALIDITY, UID).
+
+    Gli header arrivano dalla sincronizzazione della lista; corpo e metadati
+    degli allegati vengono aggiunti alla prima lettura del messaggio. Per ogni
+    mailbox si ricordano UIDVALIDITY e ultimo UID visto, così la
+    sincronizzazione successiva chiede al server solo gli UID più alti.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS mailboxes (
+        account TEXT NOT NULL,
+        mailbox TEXT NOT NULL,
+        uidvalidity INTEGER NOT NULL,
+        last_uid INTEGER NOT NULL,
+        synced_ts REAL NOT NULL,
+        PRIMARY KEY (account, mailbox)
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        account TEXT NOT NULL,
+        uidvalidity INTEGER NOT NULL,
+        uid INTEGER NOT NULL,
+        subject TEXT,
+        from_addr TEXT,
+        to_addr TEXT,
+        date TEXT,
+        has_attachments INTEGER NOT NULL DEFAULT 0,
+        body TEXT,
+        attachments TEXT,
+        PRIMARY KEY (account, uidvalidity, uid)
+    );
+    CREATE TABLE IF NOT EXISTS summaries (
+        account TEXT NOT NULL,
+        uidvalidity INTEGER NOT NULL,
+        uid INTEGER NOT NULL,
+        params TEXT NOT NULL,
+        summary TEXT NOT NULL,
+        PRIMARY KEY (account, uidvalidity, uid, params)
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---------------------------------------------------
+    # STATO DELLA MAILBOX
+    # ---------------------------------------------------
+    def mailbox_state(self, account, mailbox="INBOX"):
+        """(uidvalidity, last_uid) dell'ultima sincronizzazione, o None"""
+        row = self._conn().execute(
+            "SELECT uidvalidity, last_uid FROM mailboxes WHERE account = ? AND mailbox = ?",
+            (account, mailbox),
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def begin_sync(self, account, uidvalidity, mailbox="INBOX"):
+        """Ultimo UID già in cache; se UIDVALIDITY è cambiata la cache viene svuotata"""
+        state = self.mailbox_state(account, mailbox)
+        if state and state[0] == uidvalidity:
+            return state[1]
+        conn = self._conn()
+        with self._write_lock, conn:
+            # Gli UID della vecchia UIDVALIDITY non sono più validi
+            conn.execute("DELETE FROM messages WHERE account = ? AND uidvalidity != ?", (account, uidvalidity))
+            conn.execute("DELETE FROM summaries WHERE account = ? AND uidvalidity != ?", (account, uidvalidity))
+            conn.execute(
+                "INSERT INTO mailboxes (account, mailbox, uidvalidity, last_uid, synced_ts) VALUES (?, ?, ?, 0, ?) "
+                "ON CONFLICT(account, mailbox) DO UPDATE SET uidvalidity = excluded.uidvalidity, last_uid = 0",
+                (account, mailbox, uidvalidity, time.time()),
+            )
+        return 0
+
+    def end_sync(self, account, uidvalidity, last_uid, mailbox="INBOX"):
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.execute(
+                "UPDATE mailboxes SET last_uid = MAX(last_uid, ?), synced_ts = ? "
+                "WHERE account = ? AND mailbox = ? AND uidvalidity = ?",
+                (last_uid, time.time(), account, mailbox, uidvalidity),
+            )
+
+    # ---------------------------------------------------
+    # MESSAGGI
+    # ---------------------------------------------------
+    def put_headers(self, account, uidvalidity, messages):
+        """Salva gli header della lista (dict con id, subject, from, to, date, has_attachments)"""
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.executemany(
+                "INSERT INTO messages (account, uidvalidity, uid, subject, from_addr, to_addr, date, has_attachments) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(account, uidvalidity, uid) DO UPDATE SET subject = excluded.subject, "
+                "from_addr = excluded.from_addr, to_addr = excluded.to_addr, date = excluded.date, "
+                "has_attachments = excluded.has_attachments",
+                [
+                    (account, uidvalidity, int(m["id"]), m.get("subject"), m.get("from"),
+                     m.get("to"), m.get("date"), int(bool(m.get("has_attachments"))))
+                    for m in messages
+                ],
+            )
+
+    def put_message(self, account, uidvalidity, message):
+        """Salva un messaggio letto per intero (header, corpo e allegati)"""
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.execute(
+                "INSERT INTO messages (account, uidvalidity, uid, subject, from_addr, to_addr, date, "
+                "has_attachments, body, attachments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(account, uidvalidity, uid) DO UPDATE SET subject = excluded.subject, "
+                "from_addr = excluded.from_addr, to_addr = excluded.to_addr, date = excluded.date, "
+                "has_attachments = excluded.has_attachments, body = excluded.body, "
+                "attachments = excluded.attachments",
+                (account, uidvalidity, int(message["id"]), message.get("subject"), message.get("from"),
+                 message.get("to"), message.get("date"), int(bool(message.get("attachments"))),
+                 message.get("body"), json.dumps(message.get("attachments") or [], ensure_ascii=False)),
+            )
+
+    def get_message(self, account, uidvalidity, uid):
+        """Messaggio in cache; "body" e "attachments" sono None se mai letto"""
+        row = self._conn().execute(
+            "SELECT uid, subject, from_addr, to_addr, date, has_attachments, body, attachments "
+            "FROM messages WHERE account = ? AND uidvalidity = ? AND uid = ?",
+            (account, uidvalidity, int(uid)),
+        ).fetchone()
+        return _row_to_message(row) if row else None
+
+    def list_messages(self, account, uidvalidity, limit):
+        """Gli ultimi `limit` messaggi in cache, più recenti prima"""
+        rows = self._conn().execute(
+            "SELECT uid, subject, from_addr, to_addr, date, has_attachments, body, attachments "
+            "FROM messages WHERE account = ? AND uidvalidity = ? ORDER BY uid DESC LIMIT ?",
+            (account, uidvalidity, limit),
+        ).fetchall()
+        return [_row_to_message(r) for r in rows]
+
+    def count(self, account, uidvalidity):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM messages WHERE account = ? AND uidvalidity = ?", (account, uidvalidity)
+        ).fetchone()[0]
+
+    def remove(self, account, uidvalidity, uids):
+        """Elimina messaggi non più presenti sul server"""
+        conn = self._conn()
+        rows = [(account, uidvalidity, int(u)) for u in uids]
+        with self._write_lock, conn:
+            conn.executemany("DELETE FROM messages WHERE account = ? AND uidvalidity = ? AND uid = ?", rows)
+            conn.executemany("DELETE FROM summaries WHERE account = ? AND uidvalidity = ? AND uid = ?", rows)
+
+    # ---------------------------------------------------
+    # RIASSUNTI
+    # ---------------------------------------------------
+    def get_summary(self, account, uidvalidity, uid, params):
+        """Riassunto del messaggio per i parametri indicati (modello, lunghezza), o None"""
+        row = self._conn().execute(
+            "SELECT summary FROM summaries WHERE account = ? AND uidvalidity = ? AND uid = ? AND params = ?",
+            (account, uidvalidity, int(uid), params),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_summary(self, account, uidvalidity, uid, params, summary):
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO summaries (account, uidvalidity, uid, params, summary) VALUES (?, ?, ?, ?, ?)",
+                (account, uidvalidity, int(uid), params, summary),
+            )
+
+    def clear_account(self, account):
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.execute("DELETE FROM messages WHERE account = ?", (account,))
+            conn.execute("DELETE FROM summaries WHERE account = ?", (account,))
+            conn.execute("DELETE FROM mailboxes WHERE account = ?", (account,))
+
+    def stats(self):
+        conn = self._conn()
+        messages, with_body = conn.execute(
+            "SELECT COUNT(*), COUNT(body) FROM messages"
+        ).fetchone()
+        return {
+            "accounts": conn.execute("SELECT COUNT(*) FROM mailboxes").fetchone()[0],
+            "messages": messages,
+            "with_body": with_body,
+            "summaries": conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0],
+        }
+
+
+def _row_to_message(row):
+    uid, subject, from_addr, to_addr, date, has_att, body, attachments = row
+    return {
+        "id": str(uid),
+        "subject": subject,
+        "from": from_addr,
+        "to": to_addr,
+        "date": date,
+        "has_attachments": bool(has_att),
+        "body": body,
+        "attachments": json.loads(attachments) if attachments is not None else None,
+    }
@@ -0,0 +1,234 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Bucket (secondi) per latenze da millisecondi a minuti
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Bucket per operazioni locali veloci (storage, cache)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    """Istogramma cumulativo nel formato di Prometheus, con etichette"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        self._series = {}   # valori etichette -> [conteggi per bucket, somma, totale]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            series = [(key, list(s[0]), s[1], s[2]) for key, s in sorted(self._series.items())]
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}" for key, v in values]
+
+
+class Gauge:
+    """Valore letto al momento dello scrape da fn() (numero o {etichetta: numero})"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [f"{self.name}{_format_labels((self.label,), (k,))} {_format_value(v)}" for k, v in sorted(value.items())]
+        return [f"{self.name} {_format_value(value)}"]
+
+
+def _register(metric):
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None and not isinstance(metric, Gauge):
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, labels=()):
+    return _register(Histogram(name, help, buckets, labels))
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def gauge(name, help, fn, label=None):
+    """Registra (o sostituisce) un gauge calcolato a ogni scrape"""
+    return _register(Gauge(name, help, fn, label))
+
+
+def render():
+    """Tutte le metriche nel formato testo di Prometheus (text/plain; version=0.0.4)"""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------------------------------
+# METRICHE DEL PERCORSO CRITICO
+# ---------------------------------------------------
+HTTP_REQUEST = histogram("http_request_seconds", "Durata delle richieste HTTP",
+                         labels=("endpoint", "method", "status"))
+STAGE = histogram("stage_seconds", "Durata delle fasi di una richiesta (span)", labels=("stage",))
+LLM_PROMPT_EVAL = histogram("llm_prompt_eval_seconds", "Valutazione del prompt: dalla chiamata al primo token",
+                            labels=("model", "route"))
+LLM_GENERATION = histogram("llm_generation_seconds", "Durata completa di una generazione",
+                           labels=("model", "route"))
+LLM_TOKENS_PER_SECOND = histogram("llm_tokens_per_second", "Token generati al secondo (decode)",
+                                  buckets=RATE_BUCKETS, labels=("model", "route"))
+LLM_TOKENS = counter("llm_generated_tokens_total", "Token generati", labels=("model", "route"))
+CHAT_TTFT = histogram("chat_time_to_first_token_seconds",
+                      "Dalla richiesta /start_stream al primo token (coda inclusa)")
+QUEUE_WAIT = histogram("scheduler_queue_wait_seconds", "Attesa in coda dello scheduler di inferenza",
+                       labels=("priority",))
+STORE_LATENCY = histogram("conversation_store_seconds", "Operazioni sullo storage delle conversazioni",
+                          buckets=FAST_BUCKETS, labels=("op",))
+IMAP_COMMAND = histogram("imap_command_seconds", "Round-trip dei comandi IMAP", labels=("command",))
+DOCUMENT_EXTRACT = histogram("document_extract_seconds", "Estrazione del testo di un documento",
+                             labels=("format",))
+
+
+# ---------------------------------------------------
+# SPAN
+# ---------------------------------------------------
+_trace = threading.local()
+
+
+def start_trace():
+    _trace.spans = []
+
+
+def end_trace():
+    spans = getattr(_trace, "spans", None)
+    _trace.spans = None
+    return spans or []
+
+
+@contextmanager
+def span(stage):
+    """Misura una fase: va nell'istogramma stage_seconds e nella traccia della richiesta"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE.observe(elapsed, stage=stage)
+        spans = getattr(_trace, "spans", None)
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+def server_timing(spans, total=None):
+    """Valore dell'header Server-Timing (durate in millisecondi)"""
+    parts = [f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in spans]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class TimedProxy:
+    """Inoltra le chiamate a `target` misurando i metodi in `methods` su un istogramma"""
+
+    def __init__(self, target, metric, methods, label="op"):
+        self._target = target
+        self._metric = metric
+        self._methods = frozenset(methods)
+        self._label = label
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name not in self._methods or not callable(attr):
+            return attr
+        metric, label = self._metric, self._label
+
+        def timed(*args, **kwargs):
+            with metric.time(**{label: name}):
+                return attr(*args, **kwargs)
+        return timed
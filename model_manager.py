@@ -0,0 +1,128 @@
+import time
+import threading
+
+
+class ModelManager:
+    """Modello llama.cpp caricato al primo uso oppure in background.
+
+    Si usa come un oggetto Llama (chiamata, tokenize, ...): il primo accesso
+    attende il caricamento. llama_cpp viene importato solo allora. I pesi sono
+    mappati in memoria (use_mmap) e, se richiesto, bloccati in RAM (use_mlock).
+    Le funzioni registrate con on_load() (es. la cache KV) e il prompt di
+    riscaldamento girano prima che il modello sia visibile alle richieste.
+    """
+
+    def __init__(self, model_path, warmup_prompt=None, use_mmap=True, use_mlock=False, **params):
+        self.model_path = model_path
+        self.warmup_prompt = warmup_prompt
+        self.params = dict(params, use_mmap=use_mmap, use_mlock=use_mlock)
+        self.state = "idle"
+        self.error = None
+        self.timings = {}
+        self._llm = None
+        self._hooks = []
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    # ---------------------------------------------------
+    # CARICAMENTO
+    # ---------------------------------------------------
+    def on_load(self, fn):
+        """Registra fn(llm), chiamata a caricamento avvenuto (subito se già caricato)"""
+        self._hooks.append(fn)
+        if self._llm is not None:
+            fn(self._llm)
+
+    def get(self):
+        llm = self._llm
+        if llm is None:
+            llm = self.load()
+        return llm
+
+    def load(self):
+        with self._lock:
+            if self._llm is not None:
+                return self._llm
+            self.state = "loading"
+            self.error = None
+            try:
+                t0 = time.monotonic()
+                from llama_cpp import Llama
+                llm = Llama(model_path=self.model_path, verbose=False, **self.params)
+                self.timings["load_s"] = round(time.monotonic() - t0, 3)
+
+                for fn in self._hooks:
+                    fn(llm)
+
+                if self.warmup_prompt:
+                    # Una generazione minima porta in memoria le pagine dei pesi mappati
+                    t1 = time.monotonic()
+                    llm(self.warmup_prompt, max_tokens=1)
+                    self.timings["warmup_s"] = round(time.monotonic() - t1, 3)
+            except Exception as e:
+                self.state = "error"
+                self.error = str(e)
+                raise
+            # Pubblicato solo a riscaldamento finito: nessuna richiesta in parallelo
+            self._llm = llm
+            self.state = "ready"
+            self._ready.set()
+        print(f"✅ Modello {self.model_path} pronto in {self.timings['load_s'] + self.timings.get('warmup_s', 0):.2f}s")
+        return llm
+
+    def unload(self):
+        """Libera il modello; il prossimo accesso lo ricarica"""
+        with self._lock:
+            llm, self._llm = self._llm, None
+            self._ready.clear()
+            self.state = "idle"
+        if llm is not None and hasattr(llm, "close"):
+            llm.close()
+        return llm is not None
+
+    @property
+    def loaded(self):
+        return self._llm is not None
+
+    @property
+    def llm(self):
+        """Il Llama se caricato, altrimenti None (senza caricarlo)"""
+        return self._llm
+
+    def load_async(self):
+        """Avvia il caricamento (e il riscaldamento) in un thread in background"""
+        def run():
+            try:
+                self.load()
+            except Exception as e:
+                print(f"❌ Caricamento modello fallito: {e}")
+        threading.Thread(target=run, name="model-loader", daemon=True).start()
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def stats(self):
+        return {
+            "model_path": self.model_path,
+            "state": self.state,
+            "error": self.error,
+            "use_mmap": self.params["use_mmap"],
+            "use_mlock": self.params["use_mlock"],
+            **self.timings,
+        }
+
+    # ---------------------------------------------------
+    # INTERFACCIA DI LLAMA
+    # ---------------------------------------------------
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # Chiamato solo per attributi che il manager non ha (tokenize, set_cache, ...)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
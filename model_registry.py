@@ -0,0 +1,447 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from model_manager import ModelManager
+from metrics import LLM_PROMPT_EVAL, LLM_GENERATION, LLM_TOKENS_PER_SECOND, LLM_TOKENS
+
+# Parametri di llama.cpp impostabili per modello dal file di configurazione
+MODEL_PARAMS = ("n_ctx", "n_threads", "n_threads_batch", "n_batch", "n_gpu_layers", "use_mmap", "use_mlock")
+
+
+class ModelRegistry:
+    """Modelli GGUF trovati in `models_dir`, caricati su richiesta entro un budget di memoria.
+
+    Il file di configurazione (JSON) indica i parametri per modello e il
+    modello predefinito di ogni route:
+
+        {
+          "memory_budget_mb": 8192,
+          "routes": {"chat": "Phi-3-mini-4k-instruct-q4.gguf", "email": "qwen2-0.5b.gguf"},
+          "models": {"Phi-3-mini-4k-instruct-q4.gguf": {"n_ctx": 4096, "n_threads": 6}}
+        }
+
+    I parametri si applicano in quest'ordine: `defaults`, profilo di tuning
+    della macchina (`profile`, vedi autotune.py), file di configurazione,
+    override a runtime (set_model_params).
+
+    Oltre il budget si scarica il modello usato meno di recente tra quelli
+    senza richieste in corso. Cambiare il modello di una route (set_route o
+    modifica del file) non interrompe gli stream già avviati: tengono un
+    riferimento al vecchio modello finché non finiscono.
+    """
+
+    def __init__(self, models_dir, config_path=None, default_model=None, defaults=None,
+                 memory_budget_mb=0, warmup_prompt=None, check_interval=2.0, profile=None):
+        self.models_dir = models_dir
+        self.config_path = config_path
+        self.default_model = default_model
+        self.defaults = dict(defaults or {})
+        self.profile = dict(profile or {})
+        self.memory_budget = memory_budget_mb << 20
+        self.warmup_prompt = warmup_prompt
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._managers = {}      # nome -> ModelManager
+        self._refs = {}          # nome -> richieste in corso
+        self._last_used = {}
+        self._hooks = []
+        self._engines = {}       # nome -> motore di batching (facoltativo)
+        self._loading = {}       # nome -> caricamenti in corso (spazio prenotato nel budget)
+        self._load_done = threading.Condition(self._lock)
+        self._paths = {}
+        self._config = {}
+        self._route_overrides = {}
+        self._param_overrides = {}
+        self._known_routes = set()
+        self._config_mtime = None
+        self._checked = 0.0
+        self.refresh(force=True)
+
+    # ---------------------------------------------------
+    # CONFIGURAZIONE
+    # ---------------------------------------------------
+    def refresh(self, force=False):
+        """Riscandisce la cartella dei modelli e rilegge la configurazione se cambiata"""
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            self._checked = now
+            paths = {}
+            if os.path.isdir(self.models_dir):
+                for name in sorted(os.listdir(self.models_dir)):
+                    if name.lower().endswith(".gguf"):
+                        paths[name] = os.path.join(self.models_dir, name)
+            self._paths = paths
+
+            if not self.config_path:
+                return
+            try:
+                mtime = os.stat(self.config_path).st_mtime_ns
+            except OSError:
+                return
+            if mtime == self._config_mtime:
+                return
+            self._config_mtime = mtime
+            try:
+                with open(self.config_path, encoding="utf-8") as f:
+                    config = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Configurazione modelli non valida ({self.config_path}): {e}")
+                return
+            self._config = config
+            if "memory_budget_mb" in config:
+                self.memory_budget = int(config["memory_budget_mb"]) << 20
+            self._drop_stale()
+        print(f"✅ Configurazione modelli caricata da {self.config_path}")
+
+    def _drop_stale(self, names=None):
+        # Parametri cambiati: il modello (se non in uso) verrà ricaricato.
+        # Chi sta caricando tiene il lock del manager e dagli hook on_load chiede quello del
+        # registry: scaricarlo da qui invertirebbe l'ordine dei lock. Lo si riprova a fine caricamento
+        for name in list(names or self._managers):
+            manager = self._managers.get(name)
+            if (manager is not None and manager.params != self._params(name)
+                    and not self._refs.get(name) and name not in self._loading):
+                self._unload(name)
+                del self._managers[name]
+
+    def _params(self, name):
+        params = dict(self.defaults)
+        for layer in (self.profile.get(name, {}), self._config.get("models", {}).get(name, {}),
+                      self._param_overrides.get(name, {})):
+            params.update({k: v for k, v in layer.items() if k in MODEL_PARAMS})
+        params.setdefault("use_mmap", True)
+        params.setdefault("use_mlock", False)
+        return params
+
+    def params(self, name):
+        """Parametri di llama.cpp con cui il modello viene (o verrà) caricato"""
+        self.refresh()
+        with self._lock:
+            return self._params(name)
+
+    def n_ctx(self, name):
+        """Contesto del modello: quello effettivo se caricato, altrimenti quello configurato"""
+        with self._lock:
+            manager = self._managers.get(name)
+            llm = manager.llm if manager is not None else None
+        if llm is not None:
+            return llm.n_ctx()
+        return self.params(name).get("n_ctx")
+
+    def names(self):
+        self.refresh()
+        return list(self._paths)
+
+    def route_model(self, route):
+        """Nome del modello usato da una route (override, file, modello predefinito)"""
+        self.refresh()
+        with self._lock:
+            name = (self._route_overrides.get(route)
+                    or self._config.get("routes", {}).get(route)
+                    or self.default_model)
+            if name not in self._paths and self._paths:
+                # Modello predefinito assente: il primo disponibile
+                name = self.default_model if self.default_model in self._paths else next(iter(self._paths))
+            return name
+
+    def set_route(self, route, name):
+        """Cambia a caldo il modello di una route (None = torna alla configurazione)"""
+        self.refresh(force=True)
+        if name is not None and name not in self._paths:
+            raise KeyError(f"Modello non trovato: {name}")
+        with self._lock:
+            if name is None:
+                self._route_overrides.pop(route, None)
+            else:
+                self._route_overrides[route] = name
+
+    def set_model_params(self, name, params):
+        """Override a runtime dei parametri di un modello (None = torna a profilo e configurazione).
+
+        Il modello viene ricaricato con i nuovi parametri appena non ha
+        richieste in corso.
+        """
+        self.refresh(force=True)
+        if name not in self._paths:
+            raise KeyError(f"Modello non trovato: {name}")
+        if params is not None:
+            unknown = set(params) - set(MODEL_PARAMS)
+            if unknown:
+                raise ValueError(f"Parametri non supportati: {', '.join(sorted(unknown))}")
+        with self._lock:
+            if params is None:
+                self._param_overrides.pop(name, None)
+            else:
+                self._param_overrides[name] = dict(params)
+            self._drop_stale()
+        return self._params(name)
+
+    def routes(self):
+        with self._lock:
+            names = self._known_routes | set(self._config.get("routes", {})) | set(self._route_overrides)
+        return {route: self.route_model(route) for route in sorted(names)}
+
+    # ---------------------------------------------------
+    # CARICAMENTO
+    # ---------------------------------------------------
+    def on_load(self, fn):
+        """Registra fn(nome, llm), chiamata per ogni modello caricato"""
+        self._hooks.append(fn)
+        with self._lock:
+            for name, manager in self._managers.items():
+                manager.on_load(lambda llm, name=name: fn(name, llm))
+
+    def manager(self, name):
+        with self._lock:
+            manager = self._managers.get(name)
+            if manager is None:
+                if name not in self._paths:
+                    raise KeyError(f"Modello non trovato: {name}")
+                manager = ModelManager(self._paths[name], warmup_prompt=self.warmup_prompt, **self._params(name))
+                for fn in self._hooks:
+                    manager.on_load(lambda llm, fn=fn, name=name: fn(name, llm))
+                self._managers[name] = manager
+            return manager
+
+    def get(self, name):
+        """Modello caricato (rispettando il budget di memoria)"""
+        with self._lock:
+            # Letto sotto il lock: _drop_stale può aver appena sostituito il manager
+            manager = self.manager(name)
+            self._last_used[name] = time.monotonic()
+            # Anche se già caricato: un modello rimasto in uso può aver sforato il budget.
+            # Se non c'è spazio per colpa di altri caricamenti in corso si aspetta che finiscano
+            while not self._make_room(name) and not manager.loaded and set(self._loading) - {name}:
+                self._load_done.wait()
+            loading = not manager.loaded
+            if loading:
+                # Spazio prenotato: un caricamento in parallelo di un altro modello lo conta già
+                self._loading[name] = self._loading.get(name, 0) + 1
+        try:
+            return manager.get()
+        finally:
+            if loading:
+                with self._lock:
+                    self._loading[name] -= 1
+                    if not self._loading[name]:
+                        del self._loading[name]
+                        # Parametri cambiati durante il caricamento
+                        self._drop_stale([name])
+                    self._load_done.notify_all()
+
+    def load_async(self, name):
+        """Carica (e riscalda) un modello in background, es. all'avvio"""
+        def run():
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"❌ Caricamento modello {name} fallito: {e}")
+        threading.Thread(target=run, name="model-loader", daemon=True).start()
+
+    @contextmanager
+    def use(self, name):
+        """Presta un modello: finché è in uso non viene scaricato"""
+        with self._lock:
+            self._refs[name] = self._refs.get(name, 0) + 1
+        try:
+            yield self.get(name)
+        finally:
+            self.release(name)
+
+    def acquire(self, name):
+        with self._lock:
+            self._refs[name] = self._refs.get(name, 0) + 1
+        try:
+            return self.get(name)
+        except Exception:
+            self.release(name)
+            raise
+
+    def release(self, name):
+        with self._lock:
+            self._refs[name] -= 1
+            self._last_used[name] = time.monotonic()
+            if not self._refs[name]:
+                # Parametri cambiati mentre era in uso: si ricarica alla prossima richiesta
+                self._drop_stale([name])
+
+    def _size(self, name):
+        # I pesi mappati occupano circa quanto il file GGUF
+        try:
+            return os.path.getsize(self._paths[name])
+        except (KeyError, OSError):
+            return 0
+
+    def _make_room(self, name):
+        """Scarica modelli LRU finché `name` sta nel budget; False se non ci sta"""
+        if not self.memory_budget:
+            return True
+        needed = self._size(name)
+        loaded = [n for n, m in self._managers.items() if m.loaded and n != name and n not in self._loading]
+        # Anche i modelli in caricamento occupano il budget (ma non si possono scaricare)
+        used = sum(self._size(n) for n in set(loaded) | set(self._loading) if n != name)
+        # LRU tra i modelli senza richieste in corso
+        for victim in sorted(loaded, key=lambda n: self._last_used.get(n, 0)):
+            if used + needed <= self.memory_budget:
+                break
+            if self._refs.get(victim):
+                continue
+            if self._unload(victim):
+                used -= self._size(victim)
+                print(f"♻️ Modello {victim} scaricato per rientrare nel budget di memoria")
+        return used + needed <= self.memory_budget
+
+    def unload(self, name):
+        with self._lock:
+            manager = self._managers.get(name)
+            if manager is None or self._refs.get(name) or name in self._loading:
+                return False
+            return self._unload(name)
+
+    def _unload(self, name):
+        engine = self._engines.pop(name, None)
+        if engine is not None:
+            engine.close()
+        return self._managers[name].unload()
+
+    # ---------------------------------------------------
+    # MOTORI DI BATCHING
+    # ---------------------------------------------------
+    def set_engine(self, name, engine):
+        """Le chiamate al modello `name` passano da `engine` (es. BatchEngine) finché resta caricato"""
+        with self._lock:
+            old = self._engines.get(name)
+            self._engines[name] = engine
+        if old is not None:
+            old.close()
+
+    def engine(self, name):
+        return self._engines.get(name)
+
+    def stats(self):
+        self.refresh()
+        with self._lock:
+            models = {}
+            for name in self._paths:
+                manager = self._managers.get(name)
+                models[name] = {
+                    "size_mb": round(self._size(name) / (1 << 20), 1),
+                    "params": self._params(name),
+                    "state": manager.state if manager else "idle",
+                    "in_use": self._refs.get(name, 0),
+                    **(manager.timings if manager else {}),
+                }
+                if name in self._engines:
+                    models[name]["batching"] = self._engines[name].stats()
+            return {
+                "models_dir": self.models_dir,
+                "memory_budget_mb": self.memory_budget >> 20,
+                "loaded_mb": round(sum(self._size(n) for n, m in self._managers.items() if m.loaded) / (1 << 20), 1),
+                "routes": self.routes(),
+                "models": models,
+            }
+
+    def route(self, route):
+        with self._lock:
+            self._known_routes.add(route)
+        return RoutedModel(self, route)
+
+
+class RoutedModel:
+    """Si comporta come un Llama, ma usa il modello corrente della route a ogni chiamata.
+
+    Durante una chiamata (e per tutta la durata di uno stream) il modello è
+    in uso e non può essere scaricato; i cambi di modello valgono dalla
+    chiamata successiva.
+    """
+
+    def __init__(self, registry, route):
+        self.registry = registry
+        self.route = route
+
+    @property
+    def model_name(self):
+        return self.registry.route_model(self.route)
+
+    @property
+    def model_path(self):
+        return os.path.join(self.registry.models_dir, self.model_name or "")
+
+    @property
+    def manager(self):
+        return self.registry.manager(self.model_name)
+
+    def __call__(self, *args, **kwargs):
+        name = self.model_name
+        llm = self.registry.acquire(name)
+        # Con un motore di batching la generazione condivide i passi di decode con le altre
+        llm = self.registry.engine(name) or llm
+        labels = {"model": name, "route": self.route}
+        t0 = time.perf_counter()
+        if not kwargs.get("stream"):
+            try:
+                output = llm(*args, **kwargs)
+            finally:
+                self.registry.release(name)
+            elapsed = time.perf_counter() - t0
+            LLM_GENERATION.observe(elapsed, **labels)
+            tokens = (output.get("usage") or {}).get("completion_tokens") if isinstance(output, dict) else None
+            if tokens:
+                # Senza streaming la durata include la valutazione del prompt
+                LLM_TOKENS.inc(tokens, **labels)
+                LLM_TOKENS_PER_SECOND.observe(tokens / elapsed, **labels)
+            return output
+        try:
+            stream = llm(*args, **kwargs)
+        except Exception:
+            self.registry.release(name)
+            raise
+        return _held_stream(stream, self.registry, name, labels, t0)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        model = self.model_name
+        with self.registry.use(model) as llm:
+            attr = getattr(llm, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            # Riferimento preso per tutta la chiamata (tokenize, detokenize...): il modello non viene scaricato
+            llm = self.registry.acquire(model)
+            try:
+                return getattr(llm, name)(*args, **kwargs)
+            finally:
+                self.registry.release(model)
+        return call
+
+
+def _held_stream(stream, registry, name, labels, t0):
+    # Il riferimento al modello viene rilasciato quando lo stream finisce o viene chiuso
+    first = None
+    tokens = 0
+    try:
+        for chunk in stream:
+            if first is None:
+                first = time.perf_counter()
+                LLM_PROMPT_EVAL.observe(first - t0, **labels)
+            tokens += 1
+            yield chunk
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+        registry.release(name)
+        end = time.perf_counter()
+        LLM_GENERATION.observe(end - t0, **labels)
+        if tokens:
+            LLM_TOKENS.inc(tokens, **labels)
+        if tokens > 1 and end > first:
+            # Solo la fase di decode: il primo token arriva dopo la valutazione del prompt
+            LLM_TOKENS_PER_SECOND.observe((tokens - 1) / (end - first), **labels)
@@ -1,58 +1,163 @@
 import os
-from flask import Blueprint, request, jsonify
-from document_reader import extract_text_from_file
+import json
+import threading
+from io import BytesIO
+from queue import Queue
+from flask import Blueprint, request, jsonify, Response
+from document_reader import iter_text_chunks, ExtractionTimeout, UnsupportedDocument
+from scheduler import PRIORITY_BATCH, SchedulerFullError, SchedulerTimeoutError
+from summarizer import MapReduceSummarizer
+from doc_cache import ContentCache, hash_stream, params_key
+from retrieval import DocumentIndex
+from metrics import span
 
 # Crea il blueprint
 pdf_bp = Blueprint('pdf', __name__)
 
 # Variabile globale per il modello (verrà impostata da app.py)
 llm_model = None
+llm_scheduler = None
+summarizer = None
 
-def set_llm_model(model):
-    """Imposta il modello LLaMA da usare"""
-    global llm_model
+# Cache su disco per hash del contenuto: testo estratto, riassunti e chunk
+DOC_CACHE_PATH = os.environ.get("DOC_CACHE_PATH", os.path.join(".cache", "documents.db"))
+DOC_CACHE_MB = int(os.environ.get("DOC_CACHE_MB", 512))
+doc_cache = ContentCache(DOC_CACHE_PATH, max_bytes=DOC_CACHE_MB << 20)
+
+# Indice di ricerca sui documenti caricati, usato dalla chat per le domande successive
+RETRIEVAL_DIR = os.environ.get("RETRIEVAL_DIR", os.path.join(".cache", "retrieval"))
+document_index = DocumentIndex(RETRIEVAL_DIR)
+
+# Secondi massimi di attesa in coda per un riassunto (priorità batch)
+SUMMARY_QUEUE_TIMEOUT = 120
+
+def set_llm_model(model, scheduler=None, n_ctx=None):
+    """Imposta il modello LLaMA da usare e lo scheduler che ne regola l'accesso.
+
+    `n_ctx` (intero o funzione) è il contesto del modello: i chunk si dimensionano su questo.
+    """
+    global llm_model, llm_scheduler, summarizer
     llm_model = model
+    llm_scheduler = scheduler
+    summarizer = MapReduceSummarizer(model, scheduler, cache=doc_cache.namespace("chunk"),
+                                     queue_timeout=SUMMARY_QUEUE_TIMEOUT, n_ctx=n_ctx)
+
+def set_embedder(embedder):
+    """Attiva la ricerca semantica; i chunk già indicizzati ricevono i vettori in background"""
+    document_index.set_embedder(embedder)
+    schedule_embeddings()
+
+def schedule_embeddings():
+    # I vettori si calcolano con priorità batch: la CPU serve prima alla chat
+    if document_index.embedder is None:
+        return
+    if llm_scheduler is None:
+        threading.Thread(target=document_index.embed_pending, name="embeddings", daemon=True).start()
+        return
+    try:
+        llm_scheduler.submit(document_index.embed_pending, priority=PRIORITY_BATCH)
+    except SchedulerFullError:
+        # Restano in attesa: si riprova al prossimo documento
+        pass
+
+def index_document(file, digest, conv_id=None):
+    """Aggiunge il documento all'indice di ricerca (se nuovo) e lo collega alla conversazione"""
+    try:
+        if not document_index.has(digest):
+            pages = doc_cache.get("text", digest)
+            if pages is None:
+                getattr(file, "stream", file).seek(0)
+                pages = [chunk["text"] for chunk in iter_text_chunks(file)]
+            document_index.add(digest, pages, getattr(file, "filename", ""), conv_id)
+            schedule_embeddings()
+        elif conv_id:
+            document_index.attach(conv_id, digest)
+    except Exception as e:
+        # Il riassunto resta valido anche se l'indicizzazione fallisce
+        print(f"⚠️ Indicizzazione documento fallita: {e}")
+
+def run_llm(prompt, **params):
+    """Esegue il modello passando dallo scheduler (se presente) con priorità batch"""
+    if llm_scheduler is None:
+        return llm_model(prompt, **params)
+    return llm_scheduler.run(lambda: llm_model(prompt, **params),
+                             priority=PRIORITY_BATCH, timeout=SUMMARY_QUEUE_TIMEOUT)
 
 def generate_summary_with_llama(text, max_length=500):
-    """Genera riassunto usando il modello già caricato"""
+    """Genera il riassunto dell'intero documento (map-reduce sui chunk)"""
+    summary, _ = summarize_document([{"page": 1, "text": text}], max_length)
+    return summary
+
+def model_id():
+    return os.path.basename(getattr(llm_model, "model_path", "") or "")
+
+def cached_chunks(file, digest):
+    """Pagine del documento: dalla cache se già estratte, altrimenti dal file.
+
+    Le pagine estratte vengono salvate in cache a estrazione completata.
+    """
+    pages = doc_cache.get("text", digest)
+    if pages is not None:
+        for i, text in enumerate(pages, 1):
+            yield {"page": i, "text": text}
+        return
+    pages = []
+    for chunk in iter_text_chunks(file):
+        pages.append(chunk["text"])
+        yield chunk
+    doc_cache.put("text", digest, pages)
+
+def cached_summary(file, max_length=500, progress=None, conv_id=None):
+    """Riassunto con cache per (hash del file, parametri di generazione).
+
+    Il documento viene anche indicizzato per le domande successive nella chat.
+    """
+    digest = hash_stream(file)
+    key = digest + ":" + params_key(model_id(), max_length)
+    hit = doc_cache.get("summary", key)
+    if hit is not None:
+        index_document(file, digest, conv_id)
+        return hit["summary"], hit["original_length"], True
+    summary, original_length = summarize_document(cached_chunks(file, digest), max_length, progress)
+    if original_length:
+        doc_cache.put("summary", key, {"summary": summary, "original_length": original_length})
+        index_document(file, digest, conv_id)
+    return summary, original_length, False
+
+def summarize_document(chunks, max_length=500, progress=None):
+    """Riassume i chunk prodotti da iter_text_chunks man mano che arrivano.
+
+    Restituisce (riassunto, lunghezza del testo originale).
+    """
     if llm_model is None:
         raise Exception("Modello LLaMA non inizializzato")
     
-    # Limita il testo a 2000 caratteri per evitare overflow
-    text_sample = text[:2000] if len(text) > 2000 else text
-    
-    prompt = f"""<|system|>
-Sei un assistente che crea riassunti chiari e concisi di documenti in italiano.
-<|end|>
-<|user|>
-Leggi questo documento e fornisci un riassunto dettagliato in italiano (minimo 100 parole):
-
-{text_sample}
-<|end|>
-<|assistant|>
-Riassunto:"""
-    
+    notify = progress or (lambda event: None)
+    stats = {"length": 0, "head": ""}
+
+    def pages():
+        for chunk in chunks:
+            text = chunk["text"]
+            stats["length"] += len(text)
+            if len(stats["head"]) < 500:
+                stats["head"] += text[:500]
+            notify({"type": "page", "page": chunk["page"]})
+            yield text
+
     try:
-        output = llm_model(
-            prompt, 
-            max_tokens=400,
-            temperature=0.5,
-            top_p=0.9,
-            repeat_penalty=1.1,
-            stop=["<|end|>", "\n\n\n"]
-        )
-        
-        summary = output['choices'][0]['text'].strip()
+        summary = summarizer.summarize_pages(pages(), max_tokens=max_length, progress=notify)
         
         # Fallback se il riassunto è vuoto
-        if not summary or len(summary) < 20:
-            summary = f"Documento di {len(text)} caratteri. Contenuto principale: {text[:300]}..."
+        if stats["length"] and (not summary or len(summary) < 20):
+            summary = f"Documento di {stats['length']} caratteri. Contenuto principale: {stats['head'][:300]}..."
         
-        return summary
+        return summary, stats["length"]
         
+    except (SchedulerFullError, SchedulerTimeoutError, ExtractionTimeout, UnsupportedDocument):
+        raise
     except Exception as e:
         print(f"Errore generazione riassunto: {e}")
-        return f"Impossibile generare riassunto automatico. Testo estratto: {text[:500]}..."
+        return f"Impossibile generare riassunto automatico. Testo estratto: {stats['head'][:500]}...", stats["length"]
 
 @pdf_bp.route('/pdf/summary', methods=['POST'])
 def summarize_pdf():
@@ -66,21 +171,108 @@ def summarize_pdf():
         return jsonify({'error': 'Nome file vuoto'}), 400
     
     try:
-        # Usa document_reader per estrarre il testo
-        text = extract_text_from_file(file)
+        # Estrazione e riassunto procedono insieme, pagina per pagina
+        with span("summarize_document"):
+            summary, original_length, cached = cached_summary(
+                file, max_length=500, conv_id=request.form.get('conv_id')
+            )
         
-        if not text or text == "Formato non supportato.":
+        if not original_length:
             return jsonify({'error': 'Impossibile estrarre testo dal file'}), 400
         
-        # Genera riassunto
-        summary = generate_summary_with_llama(text, max_length=500)
-        
         return jsonify({
             'success': True,
             'summary': summary,
-            'original_length': len(text),
-            'filename': file.filename
+            'original_length': original_length,
+            'filename': file.filename,
+            'cached': cached
         }), 200
         
+    except UnsupportedDocument:
+        return jsonify({'error': 'Impossibile estrarre testo dal file'}), 400
+    except ExtractionTimeout as e:
+        return jsonify({'error': str(e)}), 504
+    except SchedulerFullError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': '10'}
+    except SchedulerTimeoutError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '10'}
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@pdf_bp.route('/pdf/summary/stream', methods=['POST'])
+def summarize_pdf_stream():
+    """Come /pdf/summary, ma invia l'avanzamento via SSE"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'Nessun file caricato'}), 400
+    
+    upload = request.files['file']
+    
+    if upload.filename == '':
+        return jsonify({'error': 'Nome file vuoto'}), 400
+    
+    # Il file va letto prima che la richiesta si chiuda
+    file = BytesIO(upload.read())
+    file.filename = upload.filename
+    conv_id = request.form.get('conv_id')
+    events = Queue()
+
+    def worker():
+        try:
+            summary, original_length, cached = cached_summary(
+                file, max_length=500, progress=events.put, conv_id=conv_id
+            )
+            if not original_length:
+                events.put({'type': 'error', 'text': 'Impossibile estrarre testo dal file'})
+                return
+            events.put({
+                'type': 'summary',
+                'summary': summary,
+                'original_length': original_length,
+                'filename': upload.filename,
+                'cached': cached
+            })
+        except UnsupportedDocument:
+            events.put({'type': 'error', 'text': 'Impossibile estrarre testo dal file'})
+        except Exception as e:
+            events.put({'type': 'error', 'text': str(e)})
+        finally:
+            events.put({'type': 'done'})
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    def gen():
+        while True:
+            item = events.get()
+            yield "data: " + json.dumps(item, ensure_ascii=False) + "\n\n"
+            if item['type'] == 'done':
+                break
+
+    return Response(gen(), mimetype='text/event-stream')
+
+@pdf_bp.route('/pdf/cache/stats', methods=['GET'])
+def pdf_cache_stats():
+    """Hit/miss e occupazione della cache dei documenti"""
+    return jsonify(doc_cache.stats()), 200
+
+@pdf_bp.route('/documents', methods=['GET'])
+def list_documents():
+    """Documenti indicizzati (di una conversazione con ?conv_id=)"""
+    return jsonify({
+        'documents': document_index.documents(request.args.get('conv_id')),
+        'stats': document_index.stats()
+    }), 200
+
+@pdf_bp.route('/documents/search', methods=['GET'])
+def search_documents():
+    """Chunk più pertinenti a una domanda: ?q=...&k=4[&conv_id=...]"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q mancante'}), 400
+    k = min(request.args.get('k', 4, type=int), 50)
+    return jsonify(document_index.search(query, k=k, conv_id=request.args.get('conv_id'))), 200
+
+@pdf_bp.route('/documents/<doc_id>', methods=['DELETE'])
+def delete_document(doc_id):
+    if not document_index.remove(doc_id):
+        return jsonify({'error': 'not found'}), 404
+    return jsonify({'deleted': doc_id}), 200
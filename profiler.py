@@ -0,0 +1,105 @@
+import sys
+import time
+import threading
+from collections import Counter
+
+# Intervallo di campionamento ammesso (secondi): sotto il millisecondo il thread occupa un core
+MIN_INTERVAL = 0.001
+MAX_INTERVAL = 1.0
+
+
+def parse_interval(value):
+    """Intervallo in secondi come float; ValueError se non è un numero in [MIN_INTERVAL, MAX_INTERVAL]"""
+    try:
+        interval = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Intervallo non valido: {value!r}")
+    if not MIN_INTERVAL <= interval <= MAX_INTERVAL:
+        raise ValueError(f"Intervallo fuori dai limiti ({MIN_INTERVAL}-{MAX_INTERVAL} s): {interval}")
+    return interval
+
+
+class SamplingProfiler:
+    """Profiler a campionamento per la produzione, disattivato di default.
+
+    Un thread legge ogni `interval` secondi lo stack di tutti gli altri thread
+    (sys._current_frames) e conta gli stack uguali. Il costo è proporzionale
+    alla frequenza di campionamento, non al lavoro dell'applicazione. Il
+    risultato è nel formato "collapsed" (frame;frame;frame conteggio) letto da
+    flamegraph.pl e speedscope.
+    """
+
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = parse_interval(interval)
+        self.max_depth = max_depth
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.samples = 0
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None):
+        if interval is not None:
+            self.interval = parse_interval(interval)
+        if self.running:
+            return False
+        self._stop.clear()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        return True
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
+
+    def collapsed(self, limit=None):
+        with self._lock:
+            items = self._stacks.most_common(limit)
+        return "\n".join(f"{stack} {count}" for stack, count in items) + "\n"
+
+    def stats(self, top=20):
+        with self._lock:
+            items = self._stacks.most_common(top)
+            samples = self.samples
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": samples,
+            "started_at": self.started_at,
+            # Frame più interno dei campioni più frequenti
+            "top": [{"stack": stack.rsplit(";", 1)[-1], "count": count} for stack, count in items],
+        }
@@ -0,0 +1,119 @@
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(text):
+    """Forma canonica della domanda: minuscole, spazi compattati, senza punteggiatura finale"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(" ?!.;:")
+
+
+def response_key(text, params):
+    h = hashlib.sha256(normalize_prompt(text).encode("utf-8"))
+    h.update(b"\0" + repr(params).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """Cache delle risposte complete per domanda normalizzata e parametri di campionamento.
+
+    Le voci scadono dopo `ttl` secondi e oltre `max_entries` si elimina la meno
+    usata. Con `embedder` (funzione testo -> vettore) una domanda non identica
+    può riusare la risposta di una domanda con similarità coseno >= `similarity`
+    e gli stessi parametri.
+    """
+
+    def __init__(self, max_entries=512, ttl=3600, embedder=None, similarity=0.92):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embedder = embedder
+        self.similarity = similarity
+        self._data = OrderedDict()   # key -> (risposta, scadenza, params, vettore)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def get(self, text, params):
+        key = response_key(text, params)
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] < now:
+                del self._data[key]
+                entry = None
+            if entry is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        if self.embedder is not None:
+            answer = self._get_similar(text, params, now)
+            if answer is not None:
+                return answer
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, text, params, answer):
+        vector = self._embed(text) if self.embedder is not None else None
+        key = response_key(text, params)
+        with self._lock:
+            self._data[key] = (answer, time.time() + self.ttl, params, vector)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def _embed(self, text):
+        import numpy as np
+        try:
+            vector = np.asarray(self.embedder(normalize_prompt(text)), dtype=np.float32)
+        except Exception as e:
+            print(f"Errore embedding cache risposte: {e}")
+            return None
+        if vector.ndim > 1:
+            # Embedding per token: si usa la media
+            vector = vector.mean(axis=0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _get_similar(self, text, params, now):
+        import numpy as np
+        vector = self._embed(text)
+        if vector is None:
+            return None
+        with self._lock:
+            candidates = [
+                (key, entry) for key, entry in self._data.items()
+                if entry[2] == params and entry[3] is not None and entry[1] >= now
+                and entry[3].shape == vector.shape
+            ]
+        if not candidates:
+            return None
+        # Similarità coseno in un'unica moltiplicazione matrice-vettore
+        scores = np.stack([entry[3] for _, entry in candidates]) @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+        key, entry = candidates[best]
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            self.similar_hits += 1
+        return entry[0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "embeddings": self.embedder is not None,
+            }
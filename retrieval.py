@@ -0,0 +1,497 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+import numpy as np
+
+# Parole troppo frequenti per distinguere un chunk dall'altro (italiano e inglese)
+STOPWORDS = frozenset("""
+il lo la i gli le un uno una di del dello della dei degli delle da dal dallo dalla dai dagli dalle
+in nel nello nella nei negli nelle su sul sullo sulla sui sugli sulle con per tra fra a al allo alla
+ai agli alle e ed o od ma che chi cui non si ci ne se come anche più è sono era essere ha hanno
+questo questa questi queste quello quella quelli quelle mi ti vi lo suo sua suoi sue loro
+the of and or to in on at by for with from as is are was were be been it its this that these those
+an not but if then than so do does did have has had can will would should what which who how
+""".split())
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Termini per BM25: parole in minuscolo, senza stopword e lettere singole"""
+    return [w for w in _WORD.findall(text.lower()) if len(w) > 1 and w not in STOPWORDS]
+
+
+def chunk_pages(pages, size=1000, overlap=150):
+    """Divide le pagine in chunk di circa `size` caratteri che si sovrappongono di `overlap`.
+
+    I chunk non attraversano le pagine (ogni estratto ha il suo numero di
+    pagina) e si tagliano preferibilmente a fine frase.
+    """
+    overlap = min(overlap, size // 4)
+    for page, text in enumerate(pages, 1):
+        text = re.sub(r"\s+", " ", text or "").strip()
+        start = 0
+        while start < len(text):
+            end = min(len(text), start + size)
+            if end < len(text):
+                cut = text.rfind(". ", start + size // 2, end)
+                if cut < 0:
+                    cut = text.rfind(" ", start + size // 2, end)
+                if cut > 0:
+                    end = cut + 1
+            chunk = text[start:end].strip()
+            if chunk:
+                yield page, chunk
+            if end >= len(text):
+                break
+            # Il chunk successivo riparte da inizio parola dentro la sovrapposizione
+            start = end - overlap
+            space = text.find(" ", start, end)
+            start = space + 1 if space >= 0 else end
+
+
+class LlamaEmbedder:
+    """Embedding a blocchi con un modello llama_cpp in modalità embedding.
+
+    `model` è un Llama o un ModelManager creato con embedding=True (caricato
+    al primo uso). I vettori restituiti sono normalizzati: il prodotto scalare
+    è la similarità del coseno.
+    """
+
+    def __init__(self, model, name=None, batch_size=8):
+        self.model = model
+        self.name = name or os.path.basename(getattr(model, "model_path", "") or "embedder")
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+
+    def embed(self, texts):
+        with self._lock:
+            vectors = self.model.embed(list(texts))
+        rows = []
+        for vector in vectors:
+            vector = np.asarray(vector, dtype=np.float32)
+            if vector.ndim == 2:
+                # Modello senza pooling: un vettore per token, si fa la media
+                vector = vector.mean(axis=0)
+            rows.append(vector)
+        matrix = np.vstack(rows)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+
+class DocumentIndex:
+    """Indice di ricerca persistente sui documenti caricati.
+
+    I chunk di testo stanno in SQLite (`index.db`) insieme alle frequenze dei
+    termini; all'avvio l'indice invertito BM25 si ricostruisce in memoria da
+    queste, senza ritokenizzare. Con un embedder i vettori dei chunk stanno in
+    una matrice float32 mappata in memoria (`embeddings.f32`, riga = id del
+    chunk) e i risultati BM25 e semantici si fondono con reciprocal rank
+    fusion. I documenti sono identificati dall'hash del contenuto e collegati
+    alle conversazioni in cui sono stati caricati.
+
+    Gli aggiornamenti sono incrementali: un documento nuovo aggiunge le sue
+    righe e le sue posting list; altri processi sullo stesso indice vedono i
+    chunk nuovi entro `check_interval` secondi.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS documents (
+        doc_id TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        chunks INTEGER NOT NULL,
+        chars INTEGER NOT NULL,
+        added REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS chunks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        doc_id TEXT NOT NULL,
+        page INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        terms TEXT NOT NULL,
+        length INTEGER NOT NULL,
+        embedded INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(doc_id);
+    CREATE INDEX IF NOT EXISTS idx_chunks_embedded ON chunks(embedded);
+    CREATE TABLE IF NOT EXISTS attachments (
+        conv_id TEXT NOT NULL,
+        doc_id TEXT NOT NULL,
+        added REAL NOT NULL,
+        PRIMARY KEY (conv_id, doc_id)
+    );
+    """
+
+    def __init__(self, path, chunk_chars=1000, chunk_overlap=150, k1=1.2, b=0.75,
+                 min_similarity=0.35, check_interval=2.0):
+        self.path = path
+        self.chunk_chars = chunk_chars
+        self.chunk_overlap = chunk_overlap
+        self.k1 = k1
+        self.b = b
+        self.min_similarity = min_similarity
+        self.check_interval = check_interval
+        self.embedder = None
+        os.makedirs(path, exist_ok=True)
+        self._db_path = os.path.join(path, "index.db")
+        self._matrix_path = os.path.join(path, "embeddings.f32")
+        self._meta_path = os.path.join(path, "embeddings.json")
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        conn.commit()
+
+        # Indice invertito: termine -> ([id dei chunk], [frequenze]); array numpy creati alla ricerca
+        self._postings = {}
+        self._arrays = {}
+        self._lengths = np.zeros(1024, dtype=np.float32)
+        self._doc_of = np.full(1024, -1, dtype=np.int32)
+        self._alive = np.zeros(1024, dtype=bool)
+        self._doc_index = {}     # doc_id -> intero usato in _doc_of
+        self._next_id = 1        # primo id di chunk non ancora caricato
+        self._total_length = 0
+        self._count = 0
+        self._checked = 0.0
+        self._matrix = None
+        self._dim = 0
+        self._catch_up(force=True)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---------------------------------------------------
+    # AGGIORNAMENTO
+    # ---------------------------------------------------
+    def has(self, doc_id):
+        return self._conn().execute("SELECT 1 FROM documents WHERE doc_id = ?", (doc_id,)).fetchone() is not None
+
+    def add(self, doc_id, pages, filename="", conv_id=None):
+        """Indicizza un documento (pagine di testo) se nuovo e lo collega alla conversazione.
+
+        Restituisce il numero di chunk aggiunti (0 se era già indicizzato).
+        """
+        added = 0
+        if not self.has(doc_id):
+            rows = []
+            chars = 0
+            for page, text in chunk_pages(pages, self.chunk_chars, self.chunk_overlap):
+                terms = {}
+                for term in tokenize(text):
+                    terms[term] = terms.get(term, 0) + 1
+                rows.append((doc_id, page, text, json.dumps(terms, ensure_ascii=False), sum(terms.values())))
+                chars += len(text)
+            conn = self._conn()
+            with self._write_lock, conn:
+                # Un altro processo può averlo indicizzato nel frattempo
+                if conn.execute("SELECT 1 FROM documents WHERE doc_id = ?", (doc_id,)).fetchone() is None:
+                    conn.executemany(
+                        "INSERT INTO chunks (doc_id, page, text, terms, length) VALUES (?, ?, ?, ?, ?)", rows
+                    )
+                    conn.execute(
+                        "INSERT INTO documents (doc_id, filename, chunks, chars, added) VALUES (?, ?, ?, ?, ?)",
+                        (doc_id, filename, len(rows), chars, time.time()),
+                    )
+                    added = len(rows)
+        if conv_id:
+            self.attach(conv_id, doc_id)
+        self._catch_up(force=True)
+        return added
+
+    def attach(self, conv_id, doc_id):
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.execute("INSERT OR IGNORE INTO attachments (conv_id, doc_id, added) VALUES (?, ?, ?)",
+                         (conv_id, doc_id, time.time()))
+
+    def remove(self, doc_id):
+        """Toglie un documento dall'indice; le sue righe restano come buchi nella matrice"""
+        conn = self._conn()
+        with self._write_lock, conn:
+            ids = [r[0] for r in conn.execute("SELECT id FROM chunks WHERE doc_id = ?", (doc_id,))]
+            conn.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+            conn.execute("DELETE FROM attachments WHERE doc_id = ?", (doc_id,))
+            removed = conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,)).rowcount
+        self._mark_removed(ids)
+        return bool(removed)
+
+    def _mark_removed(self, ids):
+        # Le posting list si compattano al prossimo uso di ogni termine (vedi _posting)
+        with self._lock:
+            for chunk_id in ids:
+                if chunk_id < len(self._alive) and self._alive[chunk_id]:
+                    self._alive[chunk_id] = False
+                    self._total_length -= int(self._lengths[chunk_id])
+                    self._count -= 1
+            self._arrays.clear()
+
+    def _catch_up(self, force=False):
+        """Allinea la memoria ai chunk aggiunti e rimossi (anche da altri processi) dall'ultimo controllo"""
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        conn = self._conn()
+        loaded = conn.execute("SELECT COUNT(*) FROM chunks WHERE id < ?", (self._next_id,)).fetchone()[0]
+        if loaded != self._count:
+            # Documenti rimossi da un altro processo: si confrontano gli id ancora presenti
+            live = {r[0] for r in conn.execute("SELECT id FROM chunks WHERE id < ?", (self._next_id,))}
+            self._mark_removed([int(i) for i in np.flatnonzero(self._alive[:self._next_id]) if int(i) not in live])
+        rows = conn.execute(
+            "SELECT id, doc_id, terms, length FROM chunks WHERE id >= ? ORDER BY id", (self._next_id,)
+        ).fetchall()
+        if not rows:
+            return
+        with self._lock:
+            self._grow(rows[-1][0] + 1)
+            for chunk_id, doc_id, terms, length in rows:
+                if chunk_id < self._next_id:
+                    continue
+                doc = self._doc_index.setdefault(doc_id, len(self._doc_index))
+                self._doc_of[chunk_id] = doc
+                self._lengths[chunk_id] = length
+                self._alive[chunk_id] = True
+                self._total_length += length
+                self._count += 1
+                for term, tf in json.loads(terms).items():
+                    ids, tfs = self._postings.setdefault(term, ([], []))
+                    ids.append(chunk_id)
+                    tfs.append(tf)
+                    self._arrays.pop(term, None)
+                self._next_id = chunk_id + 1
+
+    def _grow(self, size):
+        capacity = len(self._alive)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name, fill in (("_lengths", 0), ("_doc_of", -1), ("_alive", False)):
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    # ---------------------------------------------------
+    # EMBEDDING
+    # ---------------------------------------------------
+    def set_embedder(self, embedder):
+        """Attiva la ricerca semantica; con un modello diverso da quello dei vettori salvati si ricalcolano"""
+        try:
+            with open(self._meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        with self._lock:
+            self.embedder = embedder
+            if meta.get("model") != embedder.name:
+                self._reset_matrix()
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model": embedder.name, "dim": 0}, f)
+            else:
+                self._dim = int(meta.get("dim") or 0)
+                self._map_matrix()
+
+    def _reset_matrix(self):
+        self._matrix = None
+        self._dim = 0
+        if os.path.exists(self._matrix_path):
+            os.remove(self._matrix_path)
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.execute("UPDATE chunks SET embedded = 0")
+
+    def _map_matrix(self, rows=0):
+        """Mappa la matrice dei vettori con almeno `rows` righe (il file cresce per raddoppi)"""
+        if not self._dim:
+            return None
+        row_bytes = self._dim * 4
+        size = os.path.getsize(self._matrix_path) if os.path.exists(self._matrix_path) else 0
+        capacity = size // row_bytes
+        if rows > capacity:
+            capacity = max(1024, capacity)
+            while capacity < rows:
+                capacity *= 2
+            with open(self._matrix_path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+        if capacity == 0:
+            self._matrix = None
+        elif self._matrix is None or len(self._matrix) != capacity:
+            self._matrix = np.memmap(self._matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self._dim))
+        return self._matrix
+
+    def embed_pending(self, limit=None):
+        """Calcola i vettori dei chunk che non li hanno ancora; restituisce quanti"""
+        if self.embedder is None:
+            return 0
+        conn = self._conn()
+        done = 0
+        while limit is None or done < limit:
+            rows = conn.execute(
+                "SELECT id, text FROM chunks WHERE embedded = 0 ORDER BY id LIMIT ?", (self.embedder.batch_size,)
+            ).fetchall()
+            if not rows:
+                break
+            vectors = self.embedder.embed(text for _, text in rows)
+            ids = [chunk_id for chunk_id, _ in rows]
+            with self._lock:
+                if not self._dim:
+                    self._dim = vectors.shape[1]
+                    with open(self._meta_path, "w", encoding="utf-8") as f:
+                        json.dump({"model": self.embedder.name, "dim": self._dim}, f)
+                matrix = self._map_matrix(max(ids) + 1)
+                matrix[ids] = vectors
+                matrix.flush()
+            with self._write_lock, conn:
+                conn.executemany("UPDATE chunks SET embedded = 1 WHERE id = ?", [(i,) for i in ids])
+            done += len(rows)
+        return done
+
+    # ---------------------------------------------------
+    # RICERCA
+    # ---------------------------------------------------
+    def documents(self, conv_id=None):
+        conn = self._conn()
+        if conv_id:
+            rows = conn.execute(
+                "SELECT d.doc_id, d.filename, d.chunks, d.chars, d.added FROM documents d "
+                "JOIN attachments a ON a.doc_id = d.doc_id WHERE a.conv_id = ? ORDER BY a.added",
+                (conv_id,),
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT doc_id, filename, chunks, chars, added FROM documents ORDER BY added").fetchall()
+        return [{"doc_id": r[0], "filename": r[1], "chunks": r[2], "chars": r[3], "added": r[4]} for r in rows]
+
+    def _bm25(self, terms, n):
+        scores = np.zeros(n, dtype=np.float32)
+        if not self._count:
+            return scores
+        avgdl = self._total_length / self._count
+        for term in set(terms):
+            arrays = self._posting(term)
+            if arrays is None:
+                continue
+            ids, tfs = arrays
+            # Solo chunk vivi: df conta i documenti che esistono ancora, idf resta positivo
+            df = len(ids)
+            idf = np.log(1.0 + (self._count - df + 0.5) / (df + 0.5))
+            norm = tfs + self.k1 * (1.0 - self.b + self.b * self._lengths[ids] / avgdl)
+            scores[ids] += idf * tfs * (self.k1 + 1.0) / norm
+        return scores
+
+    def _posting(self, term):
+        """Array (id, frequenze) dei chunk vivi che contengono il termine"""
+        arrays = self._arrays.get(term)
+        if arrays is not None:
+            return arrays
+        posting = self._postings.get(term)
+        if posting is None:
+            return None
+        ids = np.array(posting[0], dtype=np.int64)
+        tfs = np.array(posting[1], dtype=np.float32)
+        live = self._alive[ids]
+        if not live.all():
+            ids, tfs = ids[live], tfs[live]
+            if not len(ids):
+                del self._postings[term]
+                return None
+            self._postings[term] = (ids.tolist(), tfs.astype(int).tolist())
+        arrays = self._arrays[term] = (ids, tfs)
+        return arrays
+
+    def search(self, query, k=4, conv_id=None, doc_ids=None):
+        """I `k` chunk più pertinenti alla domanda (tra i documenti della conversazione, se indicata)"""
+        self._catch_up()
+        if conv_id is not None:
+            doc_ids = [d["doc_id"] for d in self.documents(conv_id)]
+            if not doc_ids:
+                return []
+        terms = tokenize(query)
+        query_vector = None
+        if self.embedder is not None and self._dim:
+            query_vector = self.embedder.embed([query])[0]
+
+        with self._lock:
+            n = self._next_id
+            mask = self._alive[:n].copy()
+            if doc_ids is not None:
+                wanted = [self._doc_index[d] for d in doc_ids if d in self._doc_index]
+                mask &= np.isin(self._doc_of[:n], wanted)
+            if not mask.any():
+                return []
+            depth = max(k * 4, 20)
+            fused = np.zeros(n, dtype=np.float32)
+            scores = {}
+
+            lexical = self._bm25(terms, n)
+            lexical[~mask] = 0.0
+            self._fuse(fused, lexical, lexical > 0, depth)
+            scores["bm25"] = lexical
+
+            if query_vector is not None:
+                matrix = self._map_matrix()
+                rows = min(n, len(matrix)) if matrix is not None else 0
+                dense = np.zeros(n, dtype=np.float32)
+                if rows:
+                    dense[:rows] = np.asarray(matrix[:rows]) @ query_vector
+                self._fuse(fused, dense, mask & (dense >= self.min_similarity), depth)
+                scores["similarity"] = dense
+
+            candidates = np.flatnonzero(fused)
+            if not len(candidates):
+                return []
+            top = candidates[np.argsort(-fused[candidates], kind="stable")[:k]]
+            found = {int(i): {name: round(float(s[i]), 4) for name, s in scores.items()} for i in top}
+
+        # Testo dal database: i chunk di documenti rimossi da altri processi spariscono qui
+        marks = ",".join("?" * len(found))
+        rows = self._conn().execute(
+            f"SELECT c.id, c.doc_id, d.filename, c.page, c.text FROM chunks c "
+            f"JOIN documents d ON d.doc_id = c.doc_id WHERE c.id IN ({marks})", list(found)
+        ).fetchall()
+        by_id = {r[0]: r for r in rows}
+        results = []
+        for chunk_id in found:
+            row = by_id.get(chunk_id)
+            if row is None:
+                continue
+            results.append({"doc_id": row[1], "filename": row[2], "page": row[3], "text": row[4],
+                            "score": round(float(fused[chunk_id]), 5), **found[chunk_id]})
+        return results
+
+    @staticmethod
+    def _fuse(fused, scores, valid, depth, rrf_k=60):
+        # Reciprocal rank fusion sui primi `depth` candidati della lista
+        ids = np.flatnonzero(valid)
+        if not len(ids):
+            return
+        if len(ids) > depth:
+            ids = ids[np.argpartition(-scores[ids], depth - 1)[:depth]]
+        ranked = ids[np.argsort(-scores[ids], kind="stable")]
+        fused[ranked] += 1.0 / (rrf_k + np.arange(1, len(ranked) + 1))
+
+    def stats(self):
+        conn = self._conn()
+        documents, pending = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM documents), (SELECT COUNT(*) FROM chunks WHERE embedded = 0)"
+        ).fetchone()
+        with self._lock:
+            return {
+                "documents": documents,
+                "chunks": self._count,
+                "terms": len(self._postings),
+                "embedder": self.embedder.name if self.embedder else None,
+                "embedding_dim": self._dim,
+                "embedding_pending": pending if self.embedder else None,
+            }
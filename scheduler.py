@@ -0,0 +1,202 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from metrics import QUEUE_WAIT
+
+# Classi di priorità: numero più basso = servito prima
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BATCH: "batch",
+}
+
+
+class SchedulerFullError(Exception):
+    """Coda piena: la richiesta va rifiutata (HTTP 429)"""
+
+
+class SchedulerTimeoutError(Exception):
+    """Il job non è partito entro la sua deadline (HTTP 503)"""
+
+
+class JobCancelledError(Exception):
+    """Il job è stato annullato prima dell'esecuzione"""
+
+
+class InferenceJob:
+    """Un'unità di lavoro in attesa di usare il modello"""
+
+    def __init__(self, fn, priority, deadline, cancel_event, on_drop):
+        self.fn = fn
+        self.priority = priority
+        self.deadline = deadline
+        self.cancel_event = cancel_event or threading.Event()
+        self.on_drop = on_drop
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def expired(self, now=None):
+        return self.deadline is not None and (now or time.time()) > self.deadline
+
+    def wait(self, timeout=None):
+        """Attende la fine del job e restituisce il risultato (o rilancia l'errore)"""
+        if not self._done.wait(timeout):
+            raise SchedulerTimeoutError("Timeout in attesa del modello")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self._done.set()
+
+
+class InferenceScheduler:
+    """Serializza l'accesso all'istanza Llama condivisa.
+
+    Coda limitata con classi di priorità (chat interattiva prima dei riassunti),
+    deadline per richiesta, annullamento e backpressure quando la coda è piena.
+    """
+
+    def __init__(self, max_queue=8, max_batch_queue=None, workers=1):
+        self.max_queue = max_queue
+        # I job batch non possono occupare tutta la coda: resta spazio per la chat
+        self.max_batch_queue = max_batch_queue if max_batch_queue is not None else max(1, max_queue // 2)
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = 0
+        self._waits = {p: deque(maxlen=256) for p in PRIORITY_NAMES}
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0,
+                          "rejected": 0, "expired": 0, "cancelled": 0}
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker_loop, name=f"inference-worker-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    # ---------------------------------------------------
+    # API
+    # ---------------------------------------------------
+    def submit(self, fn, priority=PRIORITY_INTERACTIVE, timeout=None, cancel_event=None, on_drop=None):
+        """Accoda `fn` e restituisce subito l'InferenceJob.
+
+        `timeout` è il tempo massimo (secondi) di attesa in coda prima di partire;
+        `on_drop(job, exc)` viene chiamato se il job scade o viene annullato in coda.
+        """
+        deadline = time.time() + timeout if timeout else None
+        job = InferenceJob(fn, priority, deadline, cancel_event, on_drop)
+
+        with self._cond:
+            depth = len(self._heap)
+            batch_depth = sum(1 for entry in self._heap if entry[2].priority != PRIORITY_INTERACTIVE)
+            if depth >= self.max_queue or (priority != PRIORITY_INTERACTIVE and batch_depth >= self.max_batch_queue):
+                self._counters["rejected"] += 1
+                raise SchedulerFullError("Troppe richieste in coda, riprova più tardi")
+            heapq.heappush(self._heap, (priority, next(self._seq), job))
+            self._counters["submitted"] += 1
+            self._cond.notify()
+
+        return job
+
+    def run(self, fn, priority=PRIORITY_BATCH, timeout=None, cancel_event=None):
+        """Accoda `fn` e ne attende il risultato (uso bloccante)"""
+        job = self.submit(fn, priority=priority, timeout=timeout, cancel_event=cancel_event)
+        return job.wait()
+
+    def stats(self):
+        """Profondità della coda e tempi di attesa, per dimensionare le repliche"""
+        with self._cond:
+            by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+            for _, _, job in self._heap:
+                by_priority[PRIORITY_NAMES.get(job.priority, str(job.priority))] += 1
+            waits = {PRIORITY_NAMES[p]: _summarize(list(w)) for p, w in self._waits.items()}
+            oldest = min((job.enqueued_at for _, _, job in self._heap), default=None)
+            return {
+                "queue_depth": len(self._heap),
+                "queue_depth_by_priority": by_priority,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "workers": len(self._workers),
+                "oldest_wait_s": round(time.time() - oldest, 3) if oldest else 0.0,
+                "wait_s": waits,
+                **self._counters,
+            }
+
+    # ---------------------------------------------------
+    # WORKER
+    # ---------------------------------------------------
+    def _next_job(self):
+        with self._cond:
+            while True:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, job = heapq.heappop(self._heap)
+                now = time.time()
+                if job.cancelled:
+                    self._counters["cancelled"] += 1
+                    self._drop(job, JobCancelledError("Richiesta annullata"))
+                    continue
+                if job.expired(now):
+                    self._counters["expired"] += 1
+                    self._drop(job, SchedulerTimeoutError("Modello occupato, riprova più tardi"))
+                    continue
+                job.started_at = now
+                priority = job.priority if job.priority in self._waits else PRIORITY_BATCH
+                self._waits[priority].append(now - job.enqueued_at)
+                QUEUE_WAIT.observe(now - job.enqueued_at, priority=PRIORITY_NAMES[priority])
+                self._running += 1
+                return job
+
+    def _drop(self, job, exc):
+        job._finish(error=exc)
+        if job.on_drop:
+            try:
+                job.on_drop(job, exc)
+            except Exception as e:
+                print(f"Errore on_drop: {e}")
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job()
+            try:
+                result = job.fn()
+                job._finish(result=result)
+                outcome = "completed"
+            except Exception as e:
+                job._finish(error=e)
+                outcome = "failed"
+            with self._cond:
+                self._running -= 1
+                self._counters[outcome] += 1
+
+
+def _summarize(values):
+    if not values:
+        return {"count": 0, "avg": 0.0, "p95": 0.0, "max": 0.0}
+    values.sort()
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return {
+        "count": len(values),
+        "avg": round(sum(values) / len(values), 4),
+        "p95": round(p95, 4),
+        "max": round(values[-1], 4),
+    }
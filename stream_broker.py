@@ -0,0 +1,151 @@
+import json
+import time
+import itertools
+import threading
+from collections import deque
+
+
+def sse_event(event_id, payload):
+    return f"id: {event_id}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class Stream:
+    """Eventi di una generazione: buffer limitato per la ripresa con Last-Event-ID"""
+
+    def __init__(self, key, replay_size, ids):
+        self.key = key
+        self.events = deque(maxlen=replay_size)   # (id, payload)
+        self._ids = ids
+        self.finished_at = None
+        self.created_at = time.monotonic()
+        self.cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def publish(self, payload):
+        with self.cond:
+            if self.finished:
+                return
+            self.events.append((next(self._ids), payload))
+            if payload.get("type") in ("done", "error"):
+                self.finished_at = time.monotonic()
+            self.cond.notify_all()
+
+    def since(self, last_id):
+        """Eventi successivi a last_id ancora nel buffer"""
+        return [(i, p) for i, p in self.events if i > last_id]
+
+
+class StreamBroker:
+    """Pubblica gli eventi delle generazioni ai client SSE, senza polling.
+
+    Ogni conversazione ha al più uno stream corrente; chi si iscrive viene
+    svegliato a ogni evento (Condition) e riceve un commento di heartbeat se
+    non arriva nulla per `heartbeat` secondi. Gli stream finiti restano
+    disponibili per `retention` secondi (per i client che si riconnettono),
+    poi vengono rimossi; quelli mai finiti dopo `max_age` secondi.
+
+    Gli iscritti non occupano risorse oltre all'attesa sulla Condition: con un
+    server gevent/eventlet (threading patchato) un worker regge migliaia di
+    connessioni inattive, purché la generazione non giri nello stesso processo
+    (il decode di llama_cpp non cede il controllo: serve INFERENCE_URL).
+    """
+
+    def __init__(self, replay_size=4096, heartbeat=15.0, retention=60.0, max_age=3600.0, open_timeout=5.0):
+        self.replay_size = replay_size
+        self.heartbeat = heartbeat
+        self.retention = retention
+        self.max_age = max_age
+        self.open_timeout = open_timeout
+        self._streams = {}
+        # Id crescenti su tutti gli stream: un Last-Event-ID di una generazione
+        # precedente fa ricevere per intero quella nuova
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._swept = time.monotonic()
+        self.subscribers = 0
+        self.removed = 0
+
+    def open(self, key):
+        """Nuovo stream per la conversazione; il precedente resta a chi lo stava leggendo"""
+        stream = Stream(key, self.replay_size, self._ids)
+        with self._cond:
+            self._streams[key] = stream
+            self._sweep()
+            self._cond.notify_all()
+        return stream
+
+    def get(self, key):
+        with self._cond:
+            return self._streams.get(key)
+
+    def discard(self, stream):
+        with self._cond:
+            if self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._swept < min(self.retention, 5.0):
+            return
+        self._swept = now
+        for key, stream in list(self._streams.items()):
+            if (stream.finished and now - stream.finished_at > self.retention) or now - stream.created_at > self.max_age:
+                del self._streams[key]
+                self.removed += 1
+
+    def _wait_stream(self, key):
+        deadline = time.monotonic() + self.open_timeout
+        with self._cond:
+            self._sweep()
+            while key not in self._streams:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._streams[key]
+
+    def subscribe(self, key, last_event_id=0):
+        """Generatore di righe SSE; riprende dopo last_event_id se ancora nel buffer"""
+        stream = self._wait_stream(key)
+        if stream is None:
+            yield sse_event(0, {"type": "error", "text": "no stream queue"})
+            return
+
+        with self._cond:
+            self.subscribers += 1
+        try:
+            yield "retry: 2000\n\n"
+            last = last_event_id
+            while True:
+                with stream.cond:
+                    pending = stream.since(last)
+                    if not pending and not stream.finished:
+                        stream.cond.wait(self.heartbeat)
+                        pending = stream.since(last)
+                    finished = stream.finished
+                if not pending:
+                    if finished:
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                for event_id, payload in pending:
+                    yield sse_event(event_id, payload)
+                last = pending[-1][0]
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    def stats(self):
+        with self._cond:
+            streams = list(self._streams.values())
+            return {
+                "streams": len(streams),
+                "active": sum(1 for s in streams if not s.finished),
+                "subscribers": self.subscribers,
+                "removed": self.removed,
+                "replay_size": self.replay_size,
+                "heartbeat": self.heartbeat,
+            }
@@ -0,0 +1,331 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+from document_reader import PAGE_BREAK
+from scheduler import PRIORITY_BATCH, SchedulerFullError
+
+MAP_PROMPT = """<|system|>
+Sei un assistente che crea riassunti chiari e concisi di documenti in italiano.
+<|end|>
+<|user|>
+Riassumi in italiano questa parte di un documento più lungo, conservando fatti, nomi e numeri importanti:
+
+{text}
+<|end|>
+<|assistant|>
+Riassunto:"""
+
+REDUCE_PROMPT = """<|system|>
+Sei un assistente che crea riassunti chiari e concisi di documenti in italiano.
+<|end|>
+<|user|>
+Questi sono i riassunti di parti consecutive dello stesso documento. Uniscili in un unico riassunto coerente in italiano:
+
+{text}
+<|end|>
+<|assistant|>
+Riassunto:"""
+
+FINAL_PROMPT = """<|system|>
+Sei un assistente che crea riassunti chiari e concisi di documenti in italiano.
+<|end|>
+<|user|>
+Leggi questo documento e fornisci un riassunto dettagliato in italiano (minimo 100 parole, massimo circa {words} parole):
+
+{text}
+<|end|>
+<|assistant|>
+Riassunto:"""
+
+GENERATION_PARAMS = {
+    "temperature": 0.5,
+    "top_p": 0.9,
+    "repeat_penalty": 1.1,
+    "stop": ["<|end|>", "\n\n\n"],
+}
+
+
+class SummaryCache:
+    """Cache LRU in memoria dei riassunti intermedi, per hash del contenuto"""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+def content_key(kind, text, *params):
+    h = hashlib.sha256()
+    for part in (kind, text) + tuple(str(p) for p in params):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+# ---------------------------------------------------
+# CHUNKING
+# ---------------------------------------------------
+def iter_chunks(pages, count_tokens, max_tokens):
+    """Raggruppa i paragrafi delle pagine in chunk di al massimo `max_tokens` token.
+
+    Consuma `pages` (iterabile di stringhe) in modo incrementale: un chunk viene
+    prodotto appena è pieno, senza attendere il resto del documento. I tagli
+    cadono sui confini di paragrafo; solo i paragrafi più lunghi di un chunk
+    vengono spezzati per frasi (e in ultima istanza per parole).
+    """
+    current, current_tokens = [], 0
+    for page in pages:
+        for para in _paragraphs(page):
+            n = count_tokens(para)
+            if n > max_tokens:
+                if current:
+                    yield "\n".join(current)
+                    current, current_tokens = [], 0
+                yield from _split_long(para, count_tokens, max_tokens)
+                continue
+            if current and current_tokens + n > max_tokens:
+                yield "\n".join(current)
+                current, current_tokens = [], 0
+            current.append(para)
+            current_tokens += n
+    if current:
+        yield "\n".join(current)
+
+def split_into_chunks(text, count_tokens, max_tokens):
+    return list(iter_chunks(text.split(PAGE_BREAK), count_tokens, max_tokens))
+
+def _paragraphs(page):
+    parts = re.split(r"\n\s*\n", page)
+    if len(parts) == 1:
+        # pdfplumber spesso non lascia righe vuote: si usa la riga singola
+        parts = page.split("\n")
+    return [p.strip() for p in parts if p.strip()]
+
+def _split_long(para, count_tokens, max_tokens):
+    pieces = re.split(r"(?<=[.!?;])\s+", para)
+    if len(pieces) == 1:
+        pieces = para.split()
+    out, current = [], ""
+    for piece in pieces:
+        candidate = f"{current} {piece}".strip()
+        if current and count_tokens(candidate) > max_tokens:
+            out.append(current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        out.append(current)
+    return out
+
+
+# ---------------------------------------------------
+# MAP-REDUCE
+# ---------------------------------------------------
+class MapReduceSummarizer:
+    """Riassunto di documenti interi: map sui chunk, reduce gerarchico.
+
+    I riassunti dei chunk non dipendono dalla lunghezza finale richiesta, quindi
+    un nuovo riassunto dello stesso documento riusa tutto tranne l'ultimo passo.
+    """
+
+    def __init__(self, llm, scheduler=None, cache=None, chunk_tokens=1500,
+                 map_tokens=200, batch_size=4, queue_timeout=120, n_ctx=None):
+        self.llm = llm
+        self.scheduler = scheduler
+        self.cache = cache or SummaryCache()
+        self.chunk_tokens = chunk_tokens
+        # Intero o funzione senza argomenti (contesto del modello corrente della route)
+        self.n_ctx = n_ctx
+        self.map_tokens = map_tokens
+        self.batch_size = batch_size
+        self.queue_timeout = queue_timeout
+
+    def model_id(self):
+        # Nelle chiavi della cache: dopo un cambio di modello della route i riassunti si rigenerano
+        return os.path.basename(getattr(self.llm, "model_path", "") or "")
+
+    def count_tokens(self, text):
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def chunk_size(self, max_tokens):
+        """Token di testo per prompt: chunk_tokens, ridotto se il contesto del modello è più piccolo"""
+        n_ctx = self.n_ctx() if callable(self.n_ctx) else self.n_ctx
+        if not n_ctx:
+            return self.chunk_tokens
+        template = max(self.count_tokens(t.format(text="", words=0))
+                       for t in (MAP_PROMPT, REDUCE_PROMPT, FINAL_PROMPT))
+        # Margine per il BOS e le differenze di tokenizzazione ai bordi del testo
+        room = n_ctx - template - max(max_tokens, self.map_tokens) - 16
+        return max(min(self.chunk_tokens, room), 64)
+
+    def summarize(self, text, max_tokens=400):
+        return self.summarize_pages(text.split(PAGE_BREAK), max_tokens)
+
+    def summarize_pages(self, pages, max_tokens=400, progress=None):
+        """Riassume un documento consumando le pagine man mano che arrivano.
+
+        I job di map partono appena un chunk è completo, quindi estrazione e
+        generazione si sovrappongono. `progress(evento)` riceve l'avanzamento.
+        """
+        notify = progress or (lambda event: None)
+        chunk_tokens = self.chunk_size(max_tokens)
+        summaries = []
+        pending = []
+        first_chunk = None
+        n_chunks = 0
+
+        def collect():
+            for i, key, job in pending:
+                summary = _text(job.wait())
+                self.cache.put(key, summary)
+                summaries[i] = summary
+                notify({"type": "chunk_done", "done": sum(s is not None for s in summaries),
+                        "total": len(summaries)})
+            pending.clear()
+
+        def map_chunk(chunk):
+            summaries.append(None)
+            key = content_key("map", chunk, self.model_id(), self.map_tokens)
+            cached = self.cache.get(key)
+            if cached is not None:
+                summaries[-1] = cached
+                return
+            if self.scheduler is None:
+                summaries[-1] = _text(self.llm(MAP_PROMPT.format(text=chunk),
+                                               max_tokens=self.map_tokens, **GENERATION_PARAMS))
+                self.cache.put(key, summaries[-1])
+                return
+            if len(pending) >= self.batch_size:
+                collect()
+            prompt = MAP_PROMPT.format(text=chunk)
+            try:
+                job = self._submit(prompt, self.map_tokens)
+            except SchedulerFullError:
+                if not pending:
+                    raise
+                # Coda batch piena: si attendono i chunk già accodati e si riprova
+                collect()
+                job = self._submit(prompt, self.map_tokens)
+            pending.append((len(summaries) - 1, key, job))
+
+        for chunk in iter_chunks(pages, self.count_tokens, chunk_tokens):
+            n_chunks += 1
+            notify({"type": "chunk", "index": n_chunks})
+            # Il primo chunk si mappa solo quando ne arriva un secondo:
+            # un documento corto va direttamente al passo finale
+            if n_chunks == 1:
+                first_chunk = chunk
+                continue
+            if n_chunks == 2:
+                map_chunk(first_chunk)
+            map_chunk(chunk)
+        collect()
+
+        if n_chunks == 0:
+            return ""
+        if n_chunks == 1:
+            # Documento corto: un solo passaggio sul testo originale
+            return self._final(first_chunk, max_tokens)
+
+        # Reduce gerarchico finché i riassunti stanno in un solo prompt
+        while self.count_tokens("\n\n".join(summaries)) > chunk_tokens:
+            groups = list(iter_chunks(summaries, self.count_tokens, chunk_tokens))
+            if len(groups) >= len(summaries):
+                # Riassunti troppo lunghi per essere raggruppati: si accorcia ognuno in
+                # proporzione, così tutte le parti del documento restano nel prompt
+                groups = [self._truncate_all(summaries, chunk_tokens)]
+                print(f"⚠️ Riassunti parziali troncati a {chunk_tokens} token complessivi")
+                notify({"type": "truncated", "tokens": chunk_tokens})
+            notify({"type": "reduce", "groups": len(groups)})
+            summaries = self._run_cached("reduce", groups, REDUCE_PROMPT, self.map_tokens)
+
+        notify({"type": "final"})
+        return self._final("\n\n".join(summaries), max_tokens)
+
+    def _truncate_all(self, summaries, max_tokens):
+        per_summary = max(max_tokens // len(summaries) - 2, 1)
+        parts = []
+        for summary in summaries:
+            tokens = self.llm.tokenize(summary.encode("utf-8"), add_bos=False)
+            parts.append(self.llm.detokenize(tokens[:per_summary]).decode("utf-8", errors="ignore").strip())
+        return "\n\n".join(parts)
+
+    def _final(self, text, max_tokens):
+        key = content_key("final", text, self.model_id(), max_tokens)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        prompt = FINAL_PROMPT.format(text=text, words=int(max_tokens * 0.75))
+        summary = self._generate_many([prompt], max_tokens)[0]
+        self.cache.put(key, summary)
+        return summary
+
+    def _run_cached(self, kind, texts, template, max_tokens):
+        model = self.model_id()
+        keys = [content_key(kind, t, model, max_tokens) for t in texts]
+        results = [self.cache.get(k) for k in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            prompts = [template.format(text=texts[i]) for i in missing]
+            for i, summary in zip(missing, self._generate_many(prompts, max_tokens)):
+                self.cache.put(keys[i], summary)
+                results[i] = summary
+        return results
+
+    def _submit(self, prompt, max_tokens):
+        return self.scheduler.submit(
+            lambda: self.llm(prompt, max_tokens=max_tokens, **GENERATION_PARAMS),
+            priority=PRIORITY_BATCH, timeout=self.queue_timeout,
+        )
+
+    def _generate_many(self, prompts, max_tokens):
+        """Esegue i prompt a gruppi di `batch_size` job accodati insieme"""
+        if self.scheduler is None:
+            return [_text(self.llm(p, max_tokens=max_tokens, **GENERATION_PARAMS)) for p in prompts]
+
+        results = [None] * len(prompts)
+        jobs = []
+        for i, prompt in enumerate(prompts):
+            if len(jobs) >= self.batch_size:
+                for j, job in jobs:
+                    results[j] = _text(job.wait())
+                jobs = []
+            try:
+                job = self._submit(prompt, max_tokens)
+            except SchedulerFullError:
+                if not jobs:
+                    raise
+                # Coda batch piena: si attende il gruppo corrente e si riprova
+                for j, pending in jobs:
+                    results[j] = _text(pending.wait())
+                jobs = []
+                job = self._submit(prompt, max_tokens)
+            jobs.append((i, job))
+        for j, job in jobs:
+            results[j] = _text(job.wait())
+        return results
+
+
+def _text(output):
+    return output["choices"][0]["text"].strip()
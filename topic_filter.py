@@ -0,0 +1,167 @@
+import os
+import re
+import threading
+import time
+
+# Parole chiave predefinite (usate se non c'è un file per il deployment).
+# Il suffisso "*" accetta qualsiasi continuazione della parola: "programm*"
+# copre programma, programmare, programmazione, programming...
+DEFAULT_KEYWORDS = [
+    "software", "programm*", "python", "javascript", "typescript", "java", "c++", "c#", "rust",
+    "react", "next.js", "node", "node.js", "backend", "frontend", "full stack", "database", "sql",
+    "mysql", "postgres*", "mongodb", "server", "linux", "windows", "ubuntu",
+    "docker", "kubernetes", "devops", "ci/cd", "git", "github", "gitlab",
+    "network", "rete", "reti", "tcp", "udp", "http", "https", "tls", "api",
+    "ai", "intelligenza artificiale", "artificial intelligence", "llm", "machine learning",
+    "hardware", "cpu", "gpu", "ram", "ssd",
+    "informatic*", "computer", "codice", "code", "coding", "algoritm*", "algorithm*",
+    "compilat*", "compiler", "debug*", "framework", "libreria", "library", "script",
+]
+
+
+def parse_keywords(lines):
+    """Legge righe "parola" o "parola = peso"; "#" a inizio riga o dopo uno spazio introduce un commento"""
+    keywords = {}
+    for line in lines:
+        # "c#" è una parola chiave, non un commento
+        line = re.split(r"(?:^|\s)#", line, maxsplit=1)[0].strip()
+        if not line:
+            continue
+        word, sep, weight = line.partition("=")
+        word = word.strip().lower()
+        if word:
+            keywords[word] = float(weight) if sep and weight.strip() else 1.0
+    return keywords
+
+
+def compile_keywords(keywords):
+    """Un'unica regex con confini di parola per tutte le parole chiave.
+
+    Le alternative sono raggruppate per prefisso comune (un trie), così il
+    motore regex non prova ogni parola a ogni posizione. I confini sono
+    lookaround su \\w e non \\b, così funzionano anche parole che finiscono
+    con simboli ("c++", "c#", "next.js"). Il testo va passato in minuscolo.
+    """
+    trie = {}
+    for word in keywords:
+        node = trie
+        prefix = word.endswith("*")
+        for ch in (word[:-1] if prefix else word):
+            node = node.setdefault(ch, {})
+        node["*" if prefix else ""] = {}
+    if not trie:
+        return None
+    return re.compile(r"(?<!\w)" + _trie_pattern(trie) + r"(?!\w)")
+
+
+def _trie_pattern(node):
+    if "*" in node:
+        # Prefisso "xxx*": qualsiasi continuazione della parola
+        return r"\w*"
+    alternatives = [re.escape(ch) + _trie_pattern(child) for ch, child in sorted(node.items()) if ch]
+    optional = "" in node
+    if not alternatives:
+        return ""
+    if len(alternatives) == 1 and not optional:
+        return alternatives[0]
+    return "(?:" + "|".join(alternatives) + ")" + ("?" if optional else "")
+
+
+class TopicFilter:
+    """Filtro degli argomenti ammessi con regex compilata una sola volta.
+
+    Con `path` le parole chiave (e i pesi) vengono lette da file e ricaricate
+    quando il file cambia. Lo stadio a punteggio somma i pesi delle parole
+    distinte trovate: la domanda è ammessa se arriva a `min_score` (con i pesi
+    predefiniti a 1 basta una parola). Pesi negativi escludono contesti non
+    informatici.
+    """
+
+    def __init__(self, path=None, keywords=None, min_score=1.0, check_interval=2.0):
+        self.path = path
+        self.min_score = min_score
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self.reloads = 0
+        self._set(parse_keywords(keywords if keywords is not None else DEFAULT_KEYWORDS))
+        if path:
+            self.reload_if_changed(force=True)
+
+    def _set(self, weights):
+        pattern = compile_keywords(weights)
+        prefixes = {w[:-1]: v for w, v in weights.items() if w.endswith("*")}
+        # Se basta una qualsiasi parola per superare la soglia si può fermare la
+        # ricerca alla prima corrispondenza
+        positive = [v for v in weights.values() if v > 0]
+        any_match = bool(positive) and len(positive) == len(weights) and min(positive) >= self.min_score
+        # Sostituzione atomica: i thread in lettura vedono il vecchio o il nuovo stato
+        self._state = (pattern, weights, prefixes, any_match)
+
+    def reload_if_changed(self, force=False):
+        """Ricarica il file delle parole chiave se modificato (al massimo ogni check_interval s)"""
+        if not self.path:
+            return False
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return False
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                return False
+            if mtime == self._mtime:
+                return False
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    weights = parse_keywords(f)
+            except (OSError, ValueError) as e:
+                # File non valido: si tengono le parole chiave precedenti
+                print(f"⚠️ Errore nel file delle parole chiave {self.path}: {e}")
+                self._mtime = mtime
+                return False
+            self._set(weights)
+            self._mtime = mtime
+            self.reloads += 1
+        print(f"✅ Parole chiave ricaricate da {self.path} ({len(weights)} voci)")
+        return True
+
+    def matches(self, text):
+        """Parole chiave trovate nel testo: {parola chiave: peso}"""
+        self.reload_if_changed()
+        pattern, weights, prefixes, _ = self._state
+        found = {}
+        if pattern is None:
+            return found
+        for m in pattern.finditer(text.lower()):
+            word = m.group(0).lower()
+            if word in weights:
+                found[word] = weights[word]
+                continue
+            # Parola catturata da un prefisso "xxx*"
+            for prefix, weight in prefixes.items():
+                if word.startswith(prefix):
+                    found[prefix + "*"] = weight
+                    break
+        return found
+
+    def score(self, text):
+        return sum(self.matches(text).values())
+
+    def is_allowed(self, text):
+        self.reload_if_changed()
+        pattern, _, _, any_match = self._state
+        if any_match:
+            return pattern.search(text.lower()) is not None
+        return self.score(text) >= self.min_score
+
+    def stats(self):
+        weights = self._state[1]
+        return {
+            "path": self.path,
+            "keywords": len(weights),
+            "min_score": self.min_score,
+            "reloads": self.reloads,
+        }